@@ -0,0 +1,129 @@
+import json
+
+import shapely
+from shapely.affinity import affine_transform
+from shapely.geometry import Point, shape
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+from . import geometry
+
+# Vectorized containment tests of shapely 2.0, with older versions each point
+# is checked on the prepared polygon
+VECTORIZED = hasattr(shapely, "contains_xy")
+
+
+def load_geojson(source):
+    """
+    Reads the geometry of a GeoJSON, the features of a feature collection
+    are merged
+
+    :param source: GeoJSON file, GeoJSON text or GeoJSON object
+    :return: Geometry
+    :rtype: shapely.geometry.base.BaseGeometry
+    """
+    if isinstance(source, str):
+        if source.lstrip().startswith("{"):
+            source = json.loads(source)
+        else:
+            with open(source) as f:
+                source = json.load(f)
+    if source.get("type") == "FeatureCollection":
+        return unary_union([
+            shape(feature["geometry"]) for feature in source["features"] if feature.get("geometry")
+        ])
+    if source.get("type") == "Feature":
+        return shape(source["geometry"])
+    return shape(source)
+
+
+def load_area(source):
+    """
+    Returns the area of a GeoJSON
+
+    :param source: GeoJSON file, GeoJSON text or GeoJSON object
+    :return: Area
+    :rtype: Area
+    """
+    return Area(load_geojson(source))
+
+
+class Area(object):
+    """
+    Polygon of a watched area. The points are checked against the bounding
+    box of the polygon before the prepared polygon, so the points outside
+    cost the same as with a rectangular area. The points on the border are
+    outside, like on the bounding boxes.
+    """
+
+    def __init__(self, polygon):
+        """
+        Class constructor
+
+        :param polygon: Polygon or multipolygon with longitude, latitude coordinates
+        :type polygon: shapely.geometry.base.BaseGeometry
+        """
+        if polygon.is_empty or polygon.area == 0:
+            raise ValueError("The area must be a polygon")
+        self.polygon = polygon
+        self.prepared = prep(polygon)
+        if VECTORIZED:
+            shapely.prepare(self.polygon)
+        west, south, east, north = polygon.bounds
+        self.bbox = (north, east, south, west)
+        self.wkt = None
+
+    def contains(self, lat, lon):
+        """
+        Checks if a coordinate is inside the area
+
+        :param lat: Latitude
+        :param lon: Longitude
+        :return: True if the coordinate is inside
+        :rtype: bool
+        """
+        north, east, south, west = self.bbox
+        if not (north > lat > south and east > lon > west):
+            return False
+        if VECTORIZED:
+            return bool(shapely.contains_xy(self.polygon, lon, lat))
+        return self.prepared.contains(Point(lon, lat))
+
+    def contains_any(self, points):
+        """
+        Checks if any point is inside the area
+
+        :param points: Array of lat, lon rows, see bard.geometry.coordinates
+        :type points: numpy.ndarray
+        :return: True if a point is inside
+        :rtype: bool
+        """
+        points = points[geometry.in_bbox(points, self.bbox)]
+        if not len(points):
+            return False
+        if VECTORIZED:
+            return bool(shapely.contains_xy(self.polygon, points[:, 1], points[:, 0]).any())
+        return any(self.prepared.contains(Point(lon, lat)) for lat, lon in points)
+
+    def intersects(self, locations):
+        """
+        Checks if a point or a line intersects the area
+
+        :param locations: Lat, lon sequences, a single one is a point
+        :type locations: list
+        :return: True if the geometry intersects the area
+        :rtype: bool
+        """
+        return self.prepared.intersects(geometry.line([(lon, lat) for lat, lon in locations]))
+
+    def latlon_wkt(self):
+        """
+        Returns the WKT of the polygon with latitude, longitude coordinates,
+        the order of the geometries of the database cache
+
+        :return: WKT of the polygon
+        :rtype: str
+        """
+        if self.wkt is None:
+            self.wkt = affine_transform(self.polygon, [0, 1, 1, 0, 0, 0]).wkt
+        return self.wkt
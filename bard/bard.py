@@ -1,16 +1,31 @@
 from __future__ import absolute_import
-import os
+from collections import namedtuple
+import multiprocessing
 import re
+from time import sleep
 
 from configobj import ConfigObj
 import osmium
-import requests
-import gettext
-from jinja2 import Environment
 from osconf import config_from_environment
-import osmapi
-
-from .osc import OSC
+import psycopg2
+
+from .osc import OSC, SequenceState
+from .changesets import ChangesetIndex, ChangesetReplication
+from .index import BboxIndex
+from .areas import load_area
+from . import geometry
+from .matcher import TagMatcher
+from .history import ApiHistory, CacheHistory, HistoryChain, SqliteHistory
+from .writer import CacheWriter
+from .compaction import CacheCompactor
+from .metrics import Metrics, timed, write_textfile
+from .resolver import MemberResolver
+from .locations import LocationIndex
+from .lru import ELEMENT_SIZES, ElementCache, MISSING
+from .records import ChangesetRecord
+from .report import ReportRenderer, select_changesets
+from .registry import LOCALES_DIR, get_registry
+from .mail import MailgunClient
 
 from raven import Client
 from .models import *
@@ -23,6 +38,62 @@ from .models import *
 # EMAIL_LANGUAGE
 # CONFIG
 
+# Element of a change recorded by a shard, with the attributes used by add_change
+ChangedElement = namedtuple("ChangedElement", ["id", "changeset", "user", "uid"])
+
+# Osmium entity bits of the element types of the watched tags, None when the
+# osmium filters aren't available (pyosmium older than 4.0)
+if hasattr(osmium, "filter"):
+    ENTITY_BITS = {
+        "node": osmium.osm.osm_entity_bits.NODE,
+        "way": osmium.osm.osm_entity_bits.WAY,
+        "relation": osmium.osm.osm_entity_bits.RELATION,
+    }
+else:
+    ENTITY_BITS = None
+
+# Locations of a way or a relation from which they are checked with vectorized tests
+VECTORIZE_LOCATIONS = 64
+
+# Bard of the parent process and change file to process, inherited by the shard workers
+_shard_bard = None
+_shard_source = None
+
+
+def init_shard_worker():
+    """
+    Initializes a worker process forked from the parent, see ChangeHandler.init_worker
+
+    :return: None
+    """
+    _shard_bard.handler.init_worker()
+
+
+def process_shard(shard, shards, locations, file_format):
+    """
+    Process a shard of a change file on a worker process
+
+    :param shard: Number of the shard
+    :type shard: int
+    :param shards: Number of shards
+    :type shards: int
+    :param locations: Osmium index type of the location index
+    :type locations: str
+    :param file_format: Format of the content
+    :type file_format: str
+    :return: Changes with its position, element counters, history stats, cache stats, metrics and stored elements
+    :rtype: tuple
+    """
+    handler = _shard_bard.handler
+    handler.set_shard(shard, shards)
+    _shard_bard.run_handler(_shard_source, locations, file_format)
+    counters = (handler.num_nodes, handler.num_ways, handler.num_rel)
+    stored = []
+    if handler.history_store is not None:
+        stored = handler.history_store.take_stored()
+    return (handler.changes, counters, handler.get_history().get_stats(), handler.get_cache_stats(),
+            handler.collect_metrics(), stored)
+
 
 class ChangeHandler(osmium.SimpleHandler):
     """
@@ -38,14 +109,32 @@ class ChangeHandler(osmium.SimpleHandler):
         self.num_ways = 0
         self.num_rel = 0
         self.tags = {}
+        self.matcher = TagMatcher()
         self.north = 0
         self.east = 0
         self.south = 0
         self.west = 0
+        # Not named area, osmium would assemble the areas of the files for a handler with an area attribute
+        self.default_area = None
+        self.bbox_index = None
+        self.tag_areas = {}
         self.changeset = {}
+        self.tag_changesets = {}
         self.stats = {}
         self.cache = None
         self.cache_enabled = False
+        self.history = None
+        self.history_store = None
+        self.resolver = None
+        self.location_index = None
+        self.changeset_index = None
+        self.changeset_candidates = {}
+        self.prefilter = True
+        self.shard = 0
+        self.shards = 1
+        self.position = 0
+        self.changes = None
+        self.metrics = Metrics()
         self.sentry_client = Client()
 
     def set_cache(self, host, db, user, password):
@@ -61,114 +150,537 @@ class ChangeHandler(osmium.SimpleHandler):
 
         self.cache = DbCache(host, db, user, password)
         self.cache_enabled = True
+        self.history = None
+        self.resolver = None
+
+    def set_history_store(self, store):
+        """
+        Sets the local store of previous versions, the elements of the
+        processed files are stored on it
+
+        :param store: History store
+        :type store: bard.history.HistoryProvider
+        :return: None
+        """
+        self.history_store = store
+        self.history = None
+
+    def set_history(self, history):
+        """
+        Sets the provider of previous versions of the elements
+
+        :param history: Provider of previous versions
+        :type history: bard.history.HistoryChain
+        :return: None
+        """
+        self.history = history
+
+    def clear_changes(self):
+        """
+        Clears the changes found, used to process several files with the same handler
+
+        :return: None
+        """
+        self.changeset = {}
+        self.tag_changesets = {}
+        self.stats = {}
+
+    def init_worker(self):
+        """
+        Prepares the handler inherited by a worker process: the connections
+        are reopened, the counters of the parent process are reset so they
+        aren't counted again when the results of the workers are merged, and
+        the history store keeps the stored elements in memory, they are
+        written by the parent process
+
+        :return: None
+        """
+        if self.history_store is not None:
+            self.history_store.reconnect()
+            self.history_store.set_read_only(True)
+        if self.history is not None:
+            self.history.reconnect()
+            self.history.clear_stats()
+        if self.cache_enabled:
+            self.cache.elements.clear_stats()
+            self.cache.metrics.clear()
+        self.resolver = None
+        self.metrics.clear()
+
+    def set_shard(self, shard, shards):
+        """
+        Restricts the handler to the elements of a shard of the file, the
+        elements are split by id between the shards. The changes are kept
+        with the position of the element on the file, to be merged in the
+        order of the file, instead of being added to the changesets.
+
+        :param shard: Number of the shard
+        :type shard: int
+        :param shards: Number of shards
+        :type shards: int
+        :return: None
+        """
+        self.shard = shard
+        self.shards = shards
+        self.position = 0
+        self.changes = []
+        self.num_nodes = 0
+        self.num_ways = 0
+        self.num_rel = 0
+
+    def in_shard(self, element):
+        """
+        Counts the position of the element on the file and checks if the
+        element belongs to the shard of the handler
+
+        :param element: Osmium element
+        :return: True if the handler has to process the element
+        :rtype: bool
+        """
+        self.position += 1
+        return element.id % self.shards == self.shard
+
+    def set_location_index(self, index):
+        """
+        Sets the index of node locations built on a first pass over the file,
+        the locations of the ways are read from it instead of the osmium
+        location handler
+
+        :param index: Index of locations or None to use the node locations of osmium
+        :type index: bard.locations.LocationIndex
+        :return: None
+        """
+        self.location_index = index
+
+    def set_changeset_index(self, index):
+        """
+        Sets the index of the metadata of the changesets, the elements of the
+        changesets whose bounding box doesn't touch the bounding box of any
+        watched tag are skipped without checking their tags
+
+        :param index: Index of changesets or None to check all the elements
+        :type index: bard.changesets.ChangesetIndex
+        :return: None
+        """
+        self.changeset_index = index
+        self.changeset_candidates = {}
+
+    def get_filters(self):
+        """
+        Returns the osmium filters that drop the elements that can't change
+        any watched tag before they reach the callbacks: the elements without
+        tags and the element types not watched. When the elements are stored
+        on the cache or on the history store all of them are needed, so
+        nothing is dropped. The filters need pyosmium 4.0, with older
+        versions nothing is dropped either. They don't filter by location,
+        see near_watched_bboxes.
+
+        :return: Osmium filters
+        :rtype: list
+        """
+        if ENTITY_BITS is None or not self.prefilter or self.cache_enabled or self.history_store is not None:
+            return []
+        entities = osmium.osm.osm_entity_bits.NOTHING
+        for tag in self.tags.values():
+            for element_type in tag["types"]:
+                entities |= ENTITY_BITS[element_type]
+        return [osmium.filter.EntityFilter(entities), osmium.filter.EmptyTagFilter()]
 
-    def location_in_bbox(self, location):
+    def get_history(self):
+        """
+        Returns the provider of previous versions, by default asks the cache,
+        the local store and as last resort the OSM API
+
+        :return: Provider of previous versions
+        :rtype: bard.history.HistoryChain
+        """
+        if self.history is None:
+            providers = []
+            if self.cache_enabled:
+                providers.append(CacheHistory(self.cache))
+            if self.history_store is not None:
+                providers.append(self.history_store)
+            providers.append(ApiHistory())
+            self.history = HistoryChain(providers)
+        return self.history
+
+    def get_cache_stats(self):
+        """
+        Returns the counters of the in memory cache of the database cache
+
+        :return: Stats of the cache or None if the cache is not enabled
+        :rtype: dict
+        """
+        if not self.cache_enabled:
+            return None
+        return self.cache.elements.get_stats()
+
+    def collect_metrics(self):
+        """
+        Returns the time of the callbacks, the history requests, the writes
+        of the cache and the API calls of the resolver since the last call
+
+        :return: Metrics, see Metrics.to_dict
+        :rtype: dict
+        """
+        metrics = self.metrics
+        if self.cache_enabled:
+            metrics.merge(self.cache.metrics.to_dict())
+            self.cache.metrics.clear()
+        if self.resolver is not None:
+            metrics.count("resolver_api_calls", self.resolver.api_calls)
+            self.resolver.api_calls = 0
+        collected = metrics.to_dict()
+        metrics.clear()
+        return collected
+
+    def get_bbox(self):
+        """
+        Returns the default bounding box of the handler
+
+        :return: North, east, south and west of the bbox
+        :rtype: tuple
+        """
+        return self.north, self.east, self.south, self.west
+
+    def tag_bbox(self, tag_name):
+        """
+        Returns the bounding box of a watched tag, if the tag doesn't have its
+        own bounding box returns the default one
+
+        :param tag_name: Name of the tags
+        :type tag_name: str
+        :return: North, east, south and west of the bbox
+        :rtype: tuple
+        """
+        bbox = self.tags[tag_name].get("bbox")
+        if bbox is None:
+            return self.get_bbox()
+        return bbox
+
+    def get_bbox_index(self):
+        """
+        Returns the spatial index of the bounding boxes of the watched tags,
+        it's built on the first use after the tags or the bbox are changed
+
+        :return: Index of the bounding boxes by tag name
+        :rtype: BboxIndex
+        """
+        if self.bbox_index is None:
+            self.changeset_candidates = {}
+            self.bbox_index = BboxIndex()
+            self.tag_areas = {}
+            for tag_name in self.tags:
+                self.bbox_index.add(tag_name, self.tag_bbox(tag_name))
+                area = self.tag_area(tag_name)
+                if area is not None:
+                    self.tag_areas[tag_name] = area
+        return self.bbox_index
+
+    def tag_area(self, tag_name):
+        """
+        Returns the polygon of a watched tag, the tags without their own
+        bounding box use the default area
+
+        :param tag_name: Name of the tags
+        :type tag_name: str
+        :return: Area or None if the tag only has a bounding box
+        :rtype: bard.areas.Area
+        """
+        tag = self.tags[tag_name]
+        if "area" in tag:
+            return tag["area"]
+        if "bbox" in tag:
+            return None
+        return self.default_area
+
+    def in_areas(self, tag_names, lat, lon):
+        """
+        Filters the tags whose bounding box contains a coordinate to the
+        ones whose polygon, if they have it, contains the coordinate
+
+        :param tag_names: Names of the tags found on the index of bounding boxes
+        :type tag_names: set
+        :param lat: Latitude
+        :param lon: Longitude
+        :return: Names of the tags
+        :rtype: set
+        """
+        return set(
+            tag_name for tag_name in tag_names
+            if tag_name not in self.tag_areas or self.tag_areas[tag_name].contains(lat, lon)
+        )
+
+    def changeset_tags(self, changeset_id):
+        """
+        Returns the watched tags whose bounding box touches the bounding box
+        of a changeset
+
+        :param changeset_id: Id of the changeset
+        :type changeset_id: int
+        :return: Names of the tags or None if the changeset is not on the changeset index
+        :rtype: set
+        """
+        if self.changeset_index is None:
+            return None
+        index = self.get_bbox_index()
+        if changeset_id not in self.changeset_candidates:
+            if self.changeset_index.is_outside(changeset_id):
+                self.changeset_candidates[changeset_id] = set()
+            else:
+                bbox = self.changeset_index.get_bbox(changeset_id)
+                self.changeset_candidates[changeset_id] = None if bbox is None else index.query_bbox(*bbox)
+        return self.changeset_candidates[changeset_id]
+
+    def changeset_skipped(self, changeset_id):
+        """
+        Checks if the elements of a changeset can be skipped because its
+        bounding box doesn't touch the bounding box of any watched tag, the
+        skipped elements are counted on the metrics
+
+        :param changeset_id: Id of the changeset
+        :type changeset_id: int
+        :return: True if the element doesn't have to be checked
+        :rtype: bool
+        """
+        tag_names = self.changeset_tags(changeset_id)
+        if tag_names is None or tag_names:
+            return False
+        self.metrics.count("changeset_skipped")
+        return True
+
+    def near_watched_bboxes(self, locations):
+        """
+        Checks if the bounding box of the locations intersects the bounds of
+        all the watched bounding boxes, the tags of the elements far from the
+        watched areas aren't matched
+
+        :param locations: List of lat, lon tuples, long lists are reduced with NumPy
+        :return: False if no location can be inside a watched bounding box
+        :rtype: bool
+        """
+        if not locations:
+            return False
+        if len(locations) >= VECTORIZE_LOCATIONS:
+            points = geometry.coordinates(locations)
+            north, east = points.max(axis=0)
+            south, west = points.min(axis=0)
+        else:
+            lats = [lat for lat, lon in locations]
+            lons = [lon for lat, lon in locations]
+            north, east, south, west = max(lats), max(lons), min(lats), min(lons)
+        return self.get_bbox_index().intersects(north, east, south, west)
+
+    def tags_in_bbox(self, locations, tag_names):
+        """
+        Returns the watched tags whose bounding box contains any of the
+        locations, stops when all the tags are found
+
+        :param locations: Iterable of lat, lon tuples, long lists are checked against all the bounding boxes at once
+        :param tag_names: Names of the tags to check
+        :type tag_names: list
+        :return: Names of the tags with any location in its bounding box
+        :rtype: list
+        """
+        pending = set(tag_names)
+        if not pending:
+            return []
+        index = self.get_bbox_index()
+        if isinstance(locations, list) and len(locations) >= VECTORIZE_LOCATIONS:
+            names = sorted(pending)
+            points = geometry.coordinates(locations)
+            bboxes = geometry.bboxes_array([self.tag_bbox(tag_name) for tag_name in names])
+            hit = geometry.bboxes_hit(points, bboxes)
+            found = set(
+                name for name, inside in zip(names, hit)
+                if inside and (name not in self.tag_areas or self.tag_areas[name].contains_any(points))
+            )
+            return [tag_name for tag_name in tag_names if tag_name in found]
+        for lat, lon in locations:
+            found = index.query(lat, lon)
+            if self.tag_areas and found:
+                found = self.in_areas(found & pending, lat, lon)
+            pending.difference_update(found)
+            if not pending:
+                break
+        return [tag_name for tag_name in tag_names if tag_name not in pending]
+
+    def way_locations(self, nodes):
+        """
+        Yields the valid locations of the nodes of a way, the nodes without
+        location are looked up on the location index
+
+        :param nodes: Nodes of the way
+        :return: Generator of lat, lon tuples
+        """
+        for node in nodes:
+            if node.location.valid():
+                yield node.location.lat, node.location.lon
+            elif self.location_index is not None:
+                location = self.location_index.get(node.ref)
+                if location is not None:
+                    yield location
+
+    def location_in_bbox(self, location, bbox=None):
         """
         Checks if the location is in the bounding box
 
         :param location: Location
+        :param bbox: Bounding box as north, east, south, west. If not set the default bbox is used
         :return: Boolean
         """
+        return self.node_in_bbox((location.lat, location.lon), bbox)
 
-        return self.north > location.lat > self.south and self.east > location.lon > self.west
-
-    def way_in_bbox(self, nodes):
+    def way_in_bbox(self, nodes, bbox=None):
         """
         Checks if the way is in the bounding box
         :param nodes: Nodes of the way
+        :param bbox: Bounding box as north, east, south, west. If not set the default bbox is used
         :return: Booelan
         """
+        points = geometry.coordinates(list(self.way_locations(nodes)))
+        return geometry.any_in_bbox(points, bbox or self.get_bbox())
 
-        inside = False
-        x = 0
-        while not inside and x < len(nodes):
-            if nodes[x].location.valid():
-                inside = self.location_in_bbox(nodes[x].location)
-            x += 1
-        return inside
-
-    def node_in_bbox(self, node):
+    def node_in_bbox(self, node, bbox=None):
         """
         Check if a node id is in the bounding box
 
         :param node: Node
-        :type node: dict or list
+        :type node: dict, list or tuple
+        :param bbox: Bounding box as north, east, south, west. If not set the default bbox is used
         :return: True if the node is in the bounding box
         :rtype: bool
         """
+        lat, lon = geometry.point(node)
+        north, east, south, west = bbox or self.get_bbox()
+        return north > lat > south and east > lon > west
 
-        if isinstance(node, dict):
-            if 'data' in node:
-                lat = node["data"]["lat"]
-                lon = node["data"]["lon"]
+    def get_resolver(self):
+        """
+        Returns the resolver of the locations of the relation members
+
+        :return: Resolver of members
+        :rtype: bard.resolver.MemberResolver
+        """
+        if self.resolver is None:
+            if self.cache_enabled:
+                self.resolver = MemberResolver(self.cache)
             else:
-                lat = node.get("lat")
-                lon = node.get("lon")
-        elif isinstance(node, list):
-            lat = node[0]
-            lon = node[1]
-        return self.north > lat > self.south and self.east > lon > self.west
+                self.resolver = MemberResolver()
+        return self.resolver
 
-    def rel_in_bbox(self, relation):
+    def relation_locations(self, relation):
         """
-        Checks if the relation is in the bounding box
+        Yields the coordinates of the members of the relation, the members
+        of the file are read from the location index and the members missing
+        on the cache are downloaded in concurrent batches
 
-        :param relation: List of members of the relation
-        :return: True if the relation is in the bounding box
-        :rtype: bool
+        :param relation: Relation
+        :return: Generator of lat, lon tuples
+        """
+        members = []
+        for location in self.indexed_member_locations(relation, members):
+            yield location
+        if members:
+            for location in self.get_resolver().locations(members):
+                yield location
+
+    def indexed_member_locations(self, relation, missing):
+        """
+        Yields the coordinates of the members of the relation found on the
+        location index and collects the type and id of the other members
+
+        :param relation: Relation
+        :param missing: Type and id of the members not found on the index
+        :type missing: list
+        :return: Generator of lat, lon tuples
         """
-        api = osmapi.OsmApi()
         for member in relation.members:
-            if member.type == "n":
-                if self.cache_enabled:
-                    node = self.cache.get_node(member.ref)
-                    if node is None:
-                        node = api.NodeGet(member.ref)
-                    ret = self.node_in_bbox(node)
-                    if ret:
-                        return True
-            elif member.type == "w":
-                if self.cache_enabled:
-                    way = self.cache.get_way(member.ref)
-                else:
-                    way = None
-                if way is None:
-                    way = api.WayFull(member.ref)
-                    nodes = []
-                    for element in way:
-                        if element["type"] == "way":
-                            version = element["data"]["version"]
-                            tags = element["data"]["tag"]
-                        else:
-                            nodes.append([element["data"]["lat"], element["data"]["lon"]])
-                    if self.cache_enabled:
-                        self.cache.add_way(member.ref, version, nodes, tags)
-                    print("way ref:{}".format(member.ref))
-                if "coordinates" in way:
-                    nodes = way.get("coordinates", [])
-                else:
-                    nodes = way
-                for node in nodes:
-                    if isinstance(node, dict) and node.get("type") != "node":
-                        for node_id in node.get("nd", []):
-                            n = self.cache.get_node(node_id)
-                            if node is None:
-                                node = api.NodeGet(node_id)
-                            ret = self.node_in_bbox(n)
-                            if ret:
-                                return True
-                    else:
-                        ret = self.node_in_bbox(node)
-                        if ret:
-                            return True
-
-        # rel_data = api.RelationFull(relation.id)
-        # for element in rel_data:
-        #     if element["type"] == "node":
-        #         ret = self.node_in_bbox(element)
-        #         if ret:
-        #             return True
-        # return False
+            if self.location_index is not None:
+                if member.type == "n":
+                    location = self.location_index.get(member.ref)
+                    if location is not None:
+                        yield location
+                        continue
+                elif member.type == "w":
+                    locations = self.location_index.way_locations(member.ref)
+                    if locations is not None:
+                        for location in locations:
+                            yield location
+                        continue
+            missing.append((member.type, member.ref))
+
+    def relation_tags(self, relation, tag_names):
+        """
+        Returns the watched tags whose bounding box contains any member of
+        the relation
+
+        The members on the cache are checked against the bounding boxes of
+        all the tags by the database on a single query, only the members
+        missing on the cache are downloaded.
+
+        :param relation: Relation
+        :param tag_names: Names of the tags to check
+        :type tag_names: list
+        :return: Names of the tags with any member in its bounding box
+        :rtype: list
+        """
+        if not tag_names:
+            return []
+        if not self.cache_enabled:
+            return self.tags_in_bbox(self.relation_locations(relation), tag_names)
+
+        members = []
+        found = set(self.tags_in_bbox(list(self.indexed_member_locations(relation, members)), tag_names))
+        pending = [tag_name for tag_name in tag_names if tag_name not in found]
+        nodes = [ref for member_type, ref in members if member_type == "n"]
+        ways = [ref for member_type, ref in members if member_type == "w"]
+        if pending and (nodes or ways):
+            bboxes = dict((tag_name, self.tag_bbox(tag_name)) for tag_name in pending)
+            areas = dict((tag_name, self.tag_areas[tag_name]) for tag_name in pending if tag_name in self.tag_areas)
+            inside, cached_nodes, cached_ways = self.cache.members_in_bbox(nodes, ways, bboxes, areas)
+            found.update(inside)
+            pending = [tag_name for tag_name in pending if tag_name not in found]
+            missing = [
+                (member_type, ref) for member_type, ref in members
+                if (member_type == "n" and ref not in cached_nodes) or (member_type == "w" and ref not in cached_ways)
+            ]
+            if pending and missing:
+                found.update(self.tags_in_bbox(self.get_resolver().locations(missing, cached=False), pending))
+        return [tag_name for tag_name in tag_names if tag_name in found]
+
+    @timed("history")
+    def get_previous_tags(self, gid, version, elem):
+        """
+        Returns the tags of the previous version of an element
+
+        :param gid: Geometry id
+        :param version: Actual version of the element
+        :param elem: Type of element
+        :return: Tags of the previous version or None if it's not available
+        :rtype: dict
+        """
+
+        return self.get_history().get_tags(elem, gid, version - 1)
+
+    def tags_changed(self, previous_tags, actual_tags, watch_tags) -> bool:
+        """
+        Checks if the watched keys are different between two sets of tags
+
+        :param previous_tags: Tags of the previous version
+        :param actual_tags: Tags of the actual version
+        :param watch_tags: Expression of the keys to check
+        :return: True if the watched tags have changed
+        """
+        previous = {}
+        for key, value in previous_tags.items():
+            if re.match(watch_tags, key):
+                previous[key] = value
+        actual = {}
+        for key, value in actual_tags.items():
+            if re.match(watch_tags, key):
+                actual[key] = value
+        return previous != actual
 
     def has_tag_changed(self, gid, old_tags, watch_tags, version, elem) -> bool:
         """
@@ -181,34 +693,10 @@ class ChangeHandler(osmium.SimpleHandler):
         :param elem: Type of element
         """
 
-        previous_elem = {}
-        osm_api = osmapi.OsmApi()
-        if elem == 'node':
-            if self.cache_enabled:
-                previous_elem = self.cache.get_node(gid, version - 1)
-                if previous_elem is None:
-                    previous_elem = osm_api.NodeHistory(gid)[version - 1]
-            else:
-                previous_elem = osm_api.NodeHistory(gid)[version - 1]
-        elif elem == 'way':
-            previous_elem = osm_api.WayHistory(gid)[version - 1]
-        elif elem == 'relation':
-            previous_elem = osm_api.RelationHistory(gid)[version - 1]
-        if previous_elem:
-            previous_tags = previous_elem['tag']
-            out_tags = {}
-            for key, value in previous_tags.items():
-                if re.match(watch_tags, key):
-                    out_tags[key] = value
-            previous_tags = out_tags
-            out_tags = {}
-            for key, value in old_tags.items():
-                if re.match(watch_tags, key):
-                    out_tags[key] = value
-            old_tags = out_tags
-            return previous_tags != old_tags
-        else:
+        previous_tags = self.get_previous_tags(gid, version, elem)
+        if previous_tags is None:
             return False
+        return self.tags_changed(previous_tags, old_tags, watch_tags)
 
     def convert_osmium_tags_dict(self, tags):
         """
@@ -225,32 +713,124 @@ class ChangeHandler(osmium.SimpleHandler):
         Checks if the element have the key,value
 
         :param element: Element to check
-        :param key_re: Compiled re expression of key 
+        :param key_re: Compiled re expression of key
         :param value_re: Compiled re expression of value
         """
         for tag in element:
-            key = tag.k
-            value = tag.v
-            if key_re.match(key) and value_re.match(value):
+            if key_re.match(tag.k) and value_re.match(tag.v):
                 return True
         return False
 
-    def set_tags(self, name, key, value, element_types, tag_id=None):
+    def matching_tags(self, tags, elem, candidates=None) -> list:
+        """
+        Returns the watched tags that apply to the element type and match the
+        tags of the element, all the watched tags are matched in a single pass
+        over the tags
+
+        :param tags: Tags of the element
+        :param elem: Type of element
+        :param candidates: Names of the watched tags to check, if not set all are checked
+        :return: Names of the matching watched tags
+        """
+        return sorted(self.matcher.match(tags, elem, candidates))
+
+    def changed_tags(self, element, elem, tag_names) -> list:
+        """
+        Filters the watched tags to the ones changed by the element. The
+        previous version of the element is requested once for all the tags.
+
+        :param element: Osmium element
+        :param elem: Type of element
+        :param tag_names: Names of the watched tags to check
+        :return: Names of the watched tags changed
+        """
+        if not tag_names or element.deleted or element.version == 1:
+            return tag_names
+        previous_tags = self.get_previous_tags(element.id, element.version, elem)
+        if previous_tags is None:
+            return []
+        actual_tags = self.convert_osmium_tags_dict(element.tags)
+        return [
+            tag_name for tag_name in tag_names
+            if self.tags_changed(previous_tags, actual_tags, self.tags[tag_name]["key_re"])
+        ]
+
+    def record_change(self, changesets, element, tag_name, ids_key, tag_id):
+        """
+        Adds the element to the changeset record of the tag
+
+        :param changesets: Changeset records by changeset id
+        :type changesets: dict
+        :param element: Osmium element
+        :param tag_name: Name of the watched tag
+        :param ids_key: Key of the ids on the record (nids, wids or rids)
+        :param tag_id: Id of the user tags
+        :return: None
+        """
+        record = changesets.get(element.changeset)
+        if record is None:
+            record = changesets[element.changeset] = ChangesetRecord(
+                element.changeset, element.user, element.uid, tag_id)
+        record.add(ids_key, tag_name, element.id)
+
+    def add_change(self, element, tag_name, ids_key):
+        """
+        Registers the change of an element for a watched tag, the tags of the
+        configuration are added to the stats and the changesets of the report
+        and the user tags only to the changesets of its user tags
+
+        :param element: Osmium element
+        :param tag_name: Name of the watched tag
+        :param ids_key: Key of the ids on the record (nids, wids or rids)
+        :return: None
+        """
+        if self.changes is not None:
+            self.changes.append((
+                self.position,
+                ChangedElement(element.id, element.changeset, element.user, element.uid),
+                tag_name,
+                ids_key
+            ))
+            return
+        tag_id = self.tags[tag_name].get("tag_id")
+        if tag_id is not None:
+            if tag_id not in self.tag_changesets:
+                self.tag_changesets[tag_id] = {}
+            self.record_change(self.tag_changesets[tag_id], element, tag_name, ids_key, tag_id)
+            return
+        if tag_name not in self.stats:
+            self.stats[tag_name] = set()
+        self.stats[tag_name].add(element.changeset)
+        self.record_change(self.changeset, element, tag_name, ids_key, tag_id)
+
+    def set_tags(self, name, key, value, element_types, tag_id=None, bbox=None, area=None):
         """
         Sets the tags to wathc on the handler
         :param name: Name of the tags
         :param key: Key value expression
         :param value: Value expression
         :param element_types: List of element types
+        :param tag_id: Id of the user tags, its changes are not added to the changesets and the stats of the report
+        :param bbox: Bounding box of the tags as north, east, south, west. If not set the default bbox is used
+        :param area: Polygon of the tags, its bounding box replaces the bbox
+        :type area: bard.areas.Area
         :return: None
         """
         self.tags[name] = {}
         self.tags[name]["key_re"] = re.compile(key)
         self.tags[name]["value_re"] = re.compile(value)
         self.tags[name]["types"] = element_types
+        self.matcher.add(name, key, value, element_types)
         if tag_id:
             self.tags[name]["tag_id"] = tag_id
-        self.stats[name] = set()
+        if bbox is not None:
+            self.tags[name]["bbox"] = tuple(float(coord) for coord in bbox)
+        if area is not None:
+            self.tags[name]["area"] = area
+            self.tags[name]["bbox"] = area.bbox
+        self.bbox_index = None
+        if not tag_id:
+            self.stats[name] = set()
         for element in element_types:
             assert element in ("node", "way", "relation")
 
@@ -268,6 +848,31 @@ class ChangeHandler(osmium.SimpleHandler):
         self.east = float(east)
         self.south = float(south)
         self.west = float(west)
+        self.default_area = None
+        self.bbox_index = None
+
+    def set_area(self, area):
+        """
+        Sets the polygon to check, the default bounding box is the one of the polygon
+
+        :param area: Area
+        :type area: bard.areas.Area
+        :return: None
+        """
+        self.set_bbox(*area.bbox)
+        self.default_area = area
+
+    def parse_bbox(self, bbox):
+        """
+        Parses the bounding box stored on the user tags
+
+        :param bbox: Bounding box as "east,south,west,north"
+        :type bbox: str
+        :return: North, east, south and west of the bbox
+        :rtype: tuple
+        """
+        east, south, west, north = bbox.split(",")
+        return float(north), float(east), float(south), float(west)
 
     def load_bbox_from_db(self, tags_id):
         """
@@ -282,22 +887,38 @@ class ChangeHandler(osmium.SimpleHandler):
             tags_id = [tags_id]
         uts = UserTags.select(lambda ut: ut.id in tags_id)
         for ut in uts:
-            east, south, west, north = ut.bbox.split(",")
-            self.set_bbox(north, east, south, west)
-
-    def load_tags_from_db(self, tags_id):
-        """
-        Load the tags data from db
-        :param tags_id: Id of the User tags
+            bbox = self.parse_bbox(ut.bbox)
+            area = load_area(ut.geojson) if ut.geojson else None
+            if area is None:
+                self.set_bbox(*bbox)
+            else:
+                self.set_area(area)
+                bbox = area.bbox
+            for tag in self.tags.values():
+                if tag.get("tag_id") == ut.id:
+                    tag["bbox"] = bbox
+                    if area is not None:
+                        tag["area"] = area
+        self.bbox_index = None
+
+    def load_tags_from_db(self, tags_id=None):
+        """
+        Load the tags data from db, each user tags is loaded with its own
+        bounding box and element types
+        :param tags_id: Id of the User tags, if not set all the user tags are loaded
         :type tags_id: int
         :return: None
         :rtype: None
         """
 
-        if not isinstance(tags_id, list):
-            tags_id = [tags_id]
-        for user_tags in UserTags.select(lambda ut: ut.id in tags_id):
-            key, value = user_tags.tags.split("=")
+        if tags_id is None:
+            uts = UserTags.select()
+        else:
+            if not isinstance(tags_id, list):
+                tags_id = [tags_id]
+            uts = UserTags.select(lambda ut: ut.id in tags_id)
+        for user_tags in uts:
+            key, value = user_tags.tags.split("=", 1)
             element_type = []
             if user_tags.node:
                 element_type.append("node")
@@ -305,62 +926,60 @@ class ChangeHandler(osmium.SimpleHandler):
                 element_type.append("way")
             if user_tags.relation:
                 element_type.append("relation")
+            name = user_tags.description or str(user_tags.id)
+            if name in self.tags and self.tags[name].get("tag_id") != user_tags.id:
+                name = "{} ({})".format(name, user_tags.id)
             self.set_tags(
-                user_tags.description,
+                name,
                 key,
                 value,
                 element_type,
-                user_tags.id
+                user_tags.id,
+                self.parse_bbox(user_tags.bbox),
+                load_area(user_tags.geojson) if user_tags.geojson else None
             )
 
+    @db_session
+    def get_subscription_bboxes(self):
+        """
+        Returns the bounding boxes of all the user tags of the database,
+        loaded or not
+
+        :return: Bounding boxes as north, east, south, west
+        :rtype: list
+        """
+        return [self.parse_bbox(bbox) for bbox in select(ut.bbox for ut in UserTags)]
+
+    @timed("node")
     def node(self, node):
         """
         Attends the nodes in the file
 
-        :param node: Node to check 
+        :param node: Node to check
         :return: None
         """
+        if not self.in_shard(node):
+            return
         try:
 
             if self.cache_enabled:
                 self.cache.add_node(node.id, node.version, node.location.lat, node.location.lon, self.convert_osmium_tags_dict(node.tags))
-            if self.location_in_bbox(node.location):
-                for tag_name in self.tags.keys():
-                    key_re = self.tags[tag_name]["key_re"]
-                    value_re = self.tags[tag_name]["value_re"]
-                    tag_id = self.tags[tag_name].get("tag_id")
-                    if self.has_tag(node.tags, key_re, value_re):
-                        if node.deleted:
-                            add_node = True
-                        elif node.version == 1:
-                            add_node = True
-                        else:
-                            add_node = self.has_tag_changed(
-                                node.id, self.convert_osmium_tags_dict(node.tags), key_re, node.version, "node")
-                        if add_node:
-                            if tag_name in self.stats:
-                                self.stats[tag_name].add(node.changeset)
-                            else:
-                                self.stats[tag_name] = [node.changeset]
-                            if node.changeset not in self.changeset:
-                                self.changeset[node.changeset] = {
-                                    "changeset": node.changeset,
-                                    "user": node.user,
-                                    "uid": node.uid,
-                                    "nids": {tag_name: [node.id]},
-                                    "wids": {},
-                                    "rids": {},
-                                    "tag_id": tag_id
-                                }
-                            else:
-                                if tag_name not in self.changeset[node.changeset]["nids"]:
-                                    self.changeset[node.changeset]["nids"][tag_name] = []
-                                self.changeset[node.changeset]["nids"][tag_name].append(
-                                    node.id)
+            if self.history_store is not None:
+                self.history_store.store("node", node.id, node.version, self.convert_osmium_tags_dict(node.tags))
+            if node.location.valid() and not self.changeset_skipped(node.changeset):
+                candidates = self.get_bbox_index().query(node.location.lat, node.location.lon)
+                if candidates and self.tag_areas:
+                    candidates = self.in_areas(candidates, node.location.lat, node.location.lon)
+                tag_names = []
+                if candidates:
+                    tag_names = self.matching_tags(node.tags, "node", candidates)
+                for tag_name in self.changed_tags(node, "node", tag_names):
+                    self.add_change(node, tag_name, "nids")
             self.num_nodes += 1
         except Exception:
             self.sentry_client.captureException()
 
+    @timed("way")
     def way(self, way):
         """
         Attends the ways in the file
@@ -368,90 +987,47 @@ class ChangeHandler(osmium.SimpleHandler):
         :param way: Way to check
         :return: None
         """
-        if self.cache and self.cache.get_pending_nodes() > 0:
-            self.cache.commit()
+        if not self.in_shard(way):
+            return
         try:
-            if self.cache:
-                self.cache.add_way(way.id, way.version, way.nodes, self.convert_osmium_tags_dict(way.tags))
-            if self.way_in_bbox(way.nodes):
-                for tag_name in self.tags.keys():
-                    key_re = self.tags[tag_name]["key_re"]
-                    value_re = self.tags[tag_name]["value_re"]
-                    tag_id = self.tags[tag_name].get("tag_id")
-                    if self.has_tag(way.tags, key_re, value_re):
-                        if way.deleted:
-                            add_way = True
-                        elif way.version == 1:
-                            add_way = True
-                        else:
-                            add_way = self.has_tag_changed(
-                                way.id, self.convert_osmium_tags_dict(way.tags), key_re, way.version, "way")
-                        if add_way:
-                            if tag_name in self.stats:
-                                self.stats[tag_name].add(way.changeset)
-                            else:
-                                self.stats[tag_name] = [way.changeset]
-                            if way.changeset in self.changeset:
-                                if tag_name not in self.changeset[way.changeset]["wids"]:
-                                    self.changeset[way.changeset]["wids"][tag_name] = []
-                                self.changeset[way.changeset]["wids"][tag_name].append(way.id)
-                            else:
-                                self.changeset[way.changeset] = {
-                                    "changeset": way.changeset,
-                                    "user": way.user,
-                                    "uid": way.uid,
-                                    "nids": {},
-                                    "wids": {tag_name: [way.id]},
-                                    "rids": {},
-                                    "tag_id": tag_id
-                                }
+            locations = list(self.way_locations(way.nodes))
+            if self.cache and len(locations) == len(way.nodes):
+                self.cache.add_way(way.id, way.version, locations, self.convert_osmium_tags_dict(way.tags))
+            if self.history_store is not None:
+                self.history_store.store("way", way.id, way.version, self.convert_osmium_tags_dict(way.tags))
+            tag_names = []
+            if not self.changeset_skipped(way.changeset):
+                if self.near_watched_bboxes(locations):
+                    candidates = self.changeset_tags(way.changeset)
+                    tag_names = self.tags_in_bbox(locations, self.matching_tags(way.tags, "way", candidates))
+                else:
+                    self.metrics.count("location_skipped")
+            for tag_name in self.changed_tags(way, "way", tag_names):
+                self.add_change(way, tag_name, "wids")
             self.num_ways += 1
         except Exception:
             self.sentry_client.captureException()
 
+    @timed("relation")
     def relation(self, rel):
-        # print 'rel:{}'.format(self.num_rel)
-        # for member in r.members:
-        #    print member
+        """
+        Attends the relations in the file
+
+        :param rel: Relation to check
+        :return: None
+        """
+        if not self.in_shard(rel):
+            return
         try:
-            if self.cache_enabled:
-                if self.cache.get_pending_nodes > 0 or self.cache.get_pending_ways > 0:
-                    self.cache.commit()
-
-            print ("rel.id {} len:{}".format(rel.id, len(rel.members)))
-            if not rel.deleted and self.rel_in_bbox(rel):
-                for tag_name in self.tags.keys():
-                    key_re = self.tags[tag_name]["key_re"]
-                    value_re = self.tags[tag_name]["value_re"]
-                    tag_id = self.tags[tag_name].get("tag_id")
-                    if self.has_tag(rel.tags, key_re, value_re):
-                        if rel.deleted:
-                            add_rel = True
-                        elif rel.version == 1:
-                            add_rel = True
-                        else:
-                            rel_tags = self.convert_osmium_tags_dict(rel.tags)
-                            add_rel = self.has_tag_changed(rel.id, rel_tags, key_re, rel.version, "relation")
-                        if add_rel:
-                            if tag_name in self.stats:
-                                self.stats[tag_name].add(rel.changeset)
-                            else:
-                                self.stats[tag_name] = [rel.changeset]
-                            if rel.changeset in self.changeset:
-                                if tag_name not in self.changeset[rel.changeset]["rids"]:
-                                    self.changeset[rel.changeset]["rids"][tag_name] = []
-                                self.changeset[rel.changeset]["rids"][
-                                    tag_name].append(rel.id)
-                            else:
-                                self.changeset[rel.changeset] = {
-                                    "changeset": rel.changeset,
-                                    "user": rel.user,
-                                    "uid": rel.uid,
-                                    "nids": {},
-                                    "wids": {},
-                                    "rids": {tag_name: [rel.id]},
-                                    "tag_id": tag_id
-                                }
+            if self.history_store is not None:
+                self.history_store.store("relation", rel.id, rel.version, self.convert_osmium_tags_dict(rel.tags))
+
+            if not rel.deleted and not self.changeset_skipped(rel.changeset):
+                tag_names = self.relation_tags(
+                    rel, self.matching_tags(rel.tags, "relation", self.changeset_tags(rel.changeset))
+                )
+                for tag_name in self.changed_tags(rel, "relation", tag_names):
+                    self.add_change(rel, tag_name, "rids")
             self.num_rel += 1
         except Exception:
             self.sentry_client.captureException()
@@ -459,7 +1035,7 @@ class ChangeHandler(osmium.SimpleHandler):
 
 class DbCache(object):
 
-    def __init__(self, host, database, user, password):
+    def __init__(self, host, database, user, password, batch_size=10000, memory=64 * 1024 * 1024):
         """
         Class constructor
 
@@ -471,6 +1047,10 @@ class DbCache(object):
         :type user: str
         :param password: Password to connect to the databse
         :type password: str
+        :param batch_size: Nodes and ways buffered before writing them
+        :type batch_size: int
+        :param memory: Maximum memory in bytes of the in memory cache of the read and written elements
+        :type memory: int
         """
         self.host = host
         self.database = database
@@ -484,9 +1064,23 @@ class DbCache(object):
             )
         self.db.provider.converter_classes.append((Point, PointConverter))
         self.db.provider.converter_classes.append((Line, LineConverter))
+        self.batch_size = batch_size
+        self.writer = CacheWriter(self.connect)
+        self.elements = ElementCache(memory, ELEMENT_SIZES)
+        self.metrics = Metrics()
         self.pending_nodes = 0
         self.pending_ways = 0
 
+    def connect(self):
+        """
+        Opens a new connection to the database
+
+        :return: Connection
+        :rtype: psycopg2.extensions.connection
+        """
+        return psycopg2.connect(
+            host=self.host, database=self.database, user=self.user, password=self.password)
+
     @db_session
     def create_user(self, username: str, password: str) -> int:
         """
@@ -496,7 +1090,8 @@ class DbCache(object):
         commit()
         return u.id
 
-    def create_tags(self, user_id, bbox: str, description: str, tags: str, node: bool, way: bool, relation: bool)-> int:
+    def create_tags(self, user_id, bbox: str, description: str, tags: str, node: bool, way: bool, relation: bool,
+                    geojson: str=None)-> int:
         """
         Adds User tags
 
@@ -507,19 +1102,22 @@ class DbCache(object):
         :param node: It apply to node
         :param way: It apply to way
         :param relation: It appy to relation
+        :param geojson: GeoJSON of the polygon of the tags
         :return: User tag id
         """
         ut = UserTags(user=user_id, bbox=bbox, description=description,
-                      tags=tags, node=node, way=way, relation=relation)
+                      tags=tags, node=node, way=way, relation=relation, geojson=geojson)
         commit()
         return ut.id
 
+    @timed("db_write")
     def commit(self):
         """
-        Commits the data of the connection
+        Writes the pending nodes and ways and commits the data of the connection
 
         :return: None
         """
+        self.writer.flush()
         self.pending_nodes = 0
         self.pending_ways = 0
         self.db.commit()
@@ -542,16 +1140,44 @@ class DbCache(object):
         :return: None
         """
         self.initialize_postigs()
+        self.update_schema()
         from pony.orm.core import MappingError
         try:
             self.db.generate_mapping(create_tables=True)
         except:
             pass
+        self.create_indexes()
+
+    @db_session
+    def update_schema(self):
+        """
+        Adds the new columns to the tables of an existing database, the
+        tables that don't exist yet are created later with all the columns
+
+        :return: None
+        """
+        for table, column, sql_type in SCHEMA_UPDATES:
+            columns = self.db.select(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = $table",
+                {"table": table}
+            )
+            if columns and column not in columns:
+                self.db.execute("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, sql_type))
 
     @db_session
+    def create_indexes(self):
+        """
+        Creates the version and spatial indexes of the cache tables if they don't exist
+
+        :return: None
+        """
+        for sql in CACHE_INDEXES:
+            self.db.execute(sql)
+
     def add_node(self, identifier: int, version: int, x: float, y: float, tags: dict):
         """
-        Adds a node to the cache
+        Adds a node to the cache, the nodes are written in batches
 
         :param identifier: Node id
         :param version:
@@ -560,12 +1186,54 @@ class DbCache(object):
         :param tags: Tags to store
         :return: None
         """
-        if tags is None:
+        if tags == {}:
             tags = None
-        elif tags == {}:
-            tags = None
-        Cache_Node(osm_id=identifier, version=version, tag=tags, geom=(x, y))
+        self.writer.add_node(identifier, version, x, y, tags)
+        node = {
+            "data": {
+                "id": identifier,
+                "version": version,
+                "lat": x,
+                "lon": y,
+                "tag": tags
+            }
+        }
+        self.elements.put_version("node", identifier, version, node)
         self.pending_nodes += 1
+        if self.pending_nodes + self.pending_ways >= self.batch_size:
+            self.commit()
+
+    def close(self):
+        """
+        Writes the pending nodes and ways and closes the connections
+
+        :return: None
+        """
+        self.commit()
+        self.writer.close()
+        self.db.disconnect()
+
+    def compact(self, versions=2, bboxes=None, range_size=1000000, vacuum=True):
+        """
+        Removes the old versions of the elements and the elements outside
+        the bounding boxes, the in memory cache is emptied
+
+        :param versions: Versions of each element to keep
+        :type versions: int
+        :param bboxes: Bounding boxes as north, east, south, west. If not set no element is removed by its location
+        :type bboxes: list
+        :param range_size: Ids compacted on each transaction
+        :type range_size: int
+        :param vacuum: Vacuum and analyze the tables after removing the rows
+        :type vacuum: bool
+        :return: Metrics by table, see CacheCompactor.compact
+        :rtype: dict
+        """
+        self.commit()
+        compactor = CacheCompactor(self.connect, versions, bboxes, range_size)
+        metrics = compactor.compact(vacuum)
+        self.elements.clear()
+        return metrics
 
     def get_pending_nodes(self):
         """
@@ -587,20 +1255,38 @@ class DbCache(object):
     @db_session
     def get_way(self, identifier: int, version: int=None)-> dict:
         """
-        Gets the way from the cache
+        Gets the way from the cache, if version is not specified returns the last version.
+        The ways pending to be written are read from the batch, the batch isn't written
 
         :param identifier: Identifier of the way
         :param version: Version of the way
         :return: Data of the way
         """
 
+        cached = self.elements.get("way", identifier, version)
+        if cached is MISSING:
+            return None
+        if cached is not None:
+            return cached
+        pending = self.writer.get_way(identifier, version)
+        if pending is not None:
+            way_version, geom, tags = pending
+            return {
+                "data": {
+                    "id": identifier,
+                    "version": way_version,
+                    "coordinates": [list(zip(geom[0::2], geom[1::2]))],
+                    "tag": tags
+                }
+            }
         if version is None:
-            way = Cache_Way.get(osm_id=identifier)
+            way = Cache_Way.get_by_sql(
+                "SELECT * FROM cache_way WHERE osm_id = $identifier ORDER BY version DESC NULLS LAST LIMIT 1")
         else:
             way = Cache_Way.get(osm_id=identifier, version=version)
 
         if way:
-            return {"data":
+            result = {"data":
                 {
                     "id": way.osm_id,
                     "version": way.version,
@@ -608,23 +1294,50 @@ class DbCache(object):
                     "tag": way.tag
                 }
             }
+            if version is None:
+                self.elements.put_version("way", identifier, way.version, result)
+            else:
+                self.elements.put("way", identifier, version, result)
+            return result
+        self.elements.put("way", identifier, version, MISSING)
         return None
 
     @db_session
     def get_node(self, identifier: int, version: int=None)-> dict:
         """
-        Returns a node of the cache, if version is not specified returns the last version avaible
+        Returns a node of the cache, if version is not specified returns the last version avaible.
+        The last version is read with the (osm_id, version DESC NULLS LAST) index, the
+        rows without version are older than the versioned ones. The nodes pending to be
+        written are read from the batch, the batch isn't written
 
         :param identifier: Identifier of the node
         :param version: Version of the node
         :return: identifier, verison,x,y
         """
+        cached = self.elements.get("node", identifier, version)
+        if cached is MISSING:
+            return None
+        if cached is not None:
+            return cached
+        pending = self.writer.get_node(identifier, version)
+        if pending is not None:
+            node_version, x, y, tags = pending
+            return {
+                "data": {
+                    "id": identifier,
+                    "version": node_version,
+                    "lat": x,
+                    "lon": y,
+                    "tag": tags
+                }
+            }
         if version is None:
-            node = Cache_Node.get(osm_id=identifier)
+            node = Cache_Node.get_by_sql(
+                "SELECT * FROM cache_node WHERE osm_id = $identifier ORDER BY version DESC NULLS LAST LIMIT 1")
         else:
             node = Cache_Node.get(osm_id=identifier, version=version)
         if node:
-            return {
+            result = {
                 "data": {
                     "id": node.osm_id,
                     "version": node.version,
@@ -633,35 +1346,164 @@ class DbCache(object):
                     "tag": node.tag
                 }
             }
+            if version is None:
+                self.elements.put_version("node", identifier, node.version, result)
+            else:
+                self.elements.put("node", identifier, version, result)
+            return result
+        self.elements.put("node", identifier, version, MISSING)
         return None
 
     @db_session
+    def get_node_locations(self, identifiers)-> dict:
+        """
+        Returns the location of the last version of the nodes stored on the
+        cache, the nodes pending to be written are read from the batch
+
+        :param identifiers: Node ids
+        :type identifiers: list
+        :return: Latitude and longitude by node id
+        """
+        locations = {}
+        stored = []
+        for identifier in identifiers:
+            pending = self.writer.get_node(identifier)
+            if pending is None:
+                stored.append(identifier)
+            else:
+                locations[identifier] = pending[1:3]
+        identifiers = stored
+        for pos in range(0, len(identifiers), self.batch_size):
+            ids = identifiers[pos:pos + self.batch_size]
+            rows = self.db.select(
+                "SELECT DISTINCT ON (osm_id) osm_id, ST_X(geom), ST_Y(geom) FROM cache_node "
+                "WHERE osm_id = ANY($ids) ORDER BY osm_id, version DESC NULLS LAST", {"ids": ids}
+            )
+            for osm_id, lat, lon in rows:
+                locations[osm_id] = (lat, lon)
+        return locations
+
+    @db_session
+    def members_in_bbox(self, nodes, ways, bboxes, areas=None):
+        """
+        Checks on a single query which bounding boxes are intersected by the
+        last version of any of the nodes and ways, without reading its
+        geometries. The elements pending to be written are checked on the batch
+
+        :param nodes: Node ids
+        :type nodes: list
+        :param ways: Way ids
+        :type ways: list
+        :param bboxes: Bounding boxes as north, east, south, west by name
+        :type bboxes: dict
+        :param areas: Areas by name, the bounding boxes with an area are checked against its polygon
+        :type areas: dict
+        :return: Names of the bounding boxes intersected by any element, ids of the nodes and ids of the ways found on the cache
+        :rtype: tuple
+        """
+        areas = areas or {}
+        names = sorted(bboxes)
+        inside = set()
+        cached_nodes = set()
+        cached_ways = set()
+        stored_nodes = []
+        stored_ways = []
+        pending_lines = []
+        for identifier in nodes:
+            pending = self.writer.get_node(identifier)
+            if pending is None:
+                stored_nodes.append(identifier)
+            else:
+                cached_nodes.add(identifier)
+                pending_lines.append([pending[1:3]])
+        for identifier in ways:
+            pending = self.writer.get_way(identifier)
+            if pending is None:
+                stored_ways.append(identifier)
+            else:
+                cached_ways.add(identifier)
+                geom = pending[1]
+                pending_lines.append(list(zip(geom[0::2], geom[1::2])))
+        for locations in pending_lines:
+            inside.update(
+                name for name in names if name not in inside and (
+                    areas[name].intersects(locations) if name in areas
+                    else geometry.line_intersects_bbox(locations, bboxes[name])
+                )
+            )
+        if not stored_nodes and not stored_ways:
+            return inside, cached_nodes, cached_ways
+        params = {"nodes": stored_nodes, "ways": stored_ways}
+        columns = []
+        for pos, name in enumerate(names):
+            if name in areas:
+                params["area%d" % pos] = areas[name].latlon_wkt()
+                columns.append("ST_Intersects(geom, ST_GeomFromText($area{0}, 4326))".format(pos))
+            else:
+                north, east, south, west = bboxes[name]
+                params.update({
+                    "north%d" % pos: north, "east%d" % pos: east, "south%d" % pos: south, "west%d" % pos: west
+                })
+                columns.append(
+                    "ST_Intersects(geom, ST_MakeEnvelope($south{0}, $west{0}, $north{0}, $east{0}, 4326))".format(pos)
+                )
+        columns = ", ".join(columns)
+        rows = self.db.select(
+            "SELECT 'n', osm_id, " + columns + " "
+            "FROM (SELECT DISTINCT ON (osm_id) osm_id, geom FROM cache_node "
+            "WHERE osm_id = ANY($nodes) ORDER BY osm_id, version DESC NULLS LAST) AS n "
+            "UNION ALL "
+            "SELECT 'w', osm_id, " + columns + " "
+            "FROM (SELECT DISTINCT ON (osm_id) osm_id, geom FROM cache_way "
+            "WHERE osm_id = ANY($ways) ORDER BY osm_id, version DESC NULLS LAST) AS w",
+            params
+        )
+        for row in rows:
+            inside.update(name for name, intersects in zip(names, row[2:]) if intersects)
+            if row[0] == "n":
+                cached_nodes.add(row[1])
+            else:
+                cached_ways.add(row[1])
+        return inside, cached_nodes, cached_ways
+
     def add_way(self, identifier: int, version: int, nodes, tags: dict):
         """
-        Adds a way into the cache
+        Adds a way into the cache, the ways are written in batches
 
         :param identifier: identifier of the way to store
         :param version: version of the way
-        :param nodes: Nodes to store
+        :param nodes: Osmium nodes or lat, lon pairs to store
         :param tags: Tags to store
-        :return: None
+        :return: False if the way doesn't have geometry
         """
 
         geom = []
-        has_geom = False
         for node in nodes:
-            if node.location.valid():
-                geom.append( "ST_MAKEPOINT({},{})".format(node.location.lat, node.location.lon))
-                has_geom = True
+            if isinstance(node, (list, tuple)):
+                geom.extend(node[:2])
+            elif node.location.valid():
+                geom.append(node.location.lat)
+                geom.append(node.location.lon)
             else:
                 return False
 
-        if has_geom:
-            if tags and tags != {}:
-                Cache_Way(osm_id=identifier, version=version, tag=tags, geom=nodes)
-            else:
-                Cache_Way(osm_id=identifier, version=version, geom=nodes)
-            self.pending_ways += 1
+        if len(geom) < 4:
+            return False
+        if tags == {}:
+            tags = None
+        self.writer.add_way(identifier, version, geom, tags)
+        way = {
+            "data": {
+                "id": identifier,
+                "version": version,
+                "coordinates": [list(zip(geom[0::2], geom[1::2]))],
+                "tag": tags
+            }
+        }
+        self.elements.put_version("way", identifier, version, way)
+        self.pending_ways += 1
+        if self.pending_nodes + self.pending_ways >= self.batch_size:
+            self.commit()
 
 
 class Bard(object):
@@ -685,7 +1527,20 @@ class Bard(object):
         self.handler = ChangeHandler()
         self.osc_file = None
         self.changesets = []
+        self.tag_changesets = {}
         self.stats = {}
+        self.run_stats = {}
+        self.locations = None
+        self.workers = 1
+        self.processed = 0
+        self.compact_every = 0
+        self.metrics = Metrics()
+        self.metrics_textfile = None
+        self.report_limit = 1000
+        self.mailer = None
+        self.changeset_source = None
+        self.changeset_sequences = 60
+        self.changeset_replication = None
 
         if host is not None and db is not None and user is not None and password is not None:
             self.has_cache = True
@@ -694,10 +1549,9 @@ class Bard(object):
             self.has_cache = False
             self.cache = None
 
-        self.jinja_env = Environment(extensions=['jinja2.ext.i18n'])
-        pkg_dir, this_filename = os.path.split(__file__)
-        self.text_tmpl = self.get_template(os.path.join(pkg_dir, 'templates', 'text_template.txt'))
-        self.html_tmpl = self.get_template(os.path.join(pkg_dir, 'templates', 'html_template.html'))
+        self.language = 'en'
+        self.registry = get_registry()
+        self.renderers = {}
 
     def initialize_db(self):
         """
@@ -706,7 +1560,7 @@ class Bard(object):
         :return:
         """
         if self.has_cache:
-            self.cache.initialize()
+            self.handler.cache.initialize()
 
     def create_user(self, username: str, password: str)->bool:
         """
@@ -720,7 +1574,7 @@ class Bard(object):
 
     @db_session
     def create_tags(self, user: str, bbox: str, description: str, tags: str,
-                    node: str=False, way: bool=False, relation: bool=False)-> int:
+                    node: str=False, way: bool=False, relation: bool=False, geojson: str=None)-> int:
         """
         Creates a user tags
 
@@ -731,27 +1585,28 @@ class Bard(object):
         :param node: If the tags aplies to the node
         :param way: If the tags aplies to the way
         :param relation: If the tags aplies to the relation
+        :param geojson: GeoJSON of the polygon of the tags, the bounding box is still used by the other tools
+        :type geojson: str
         :return: User tags id
         :rtype: int
         """
         user_id = BardUser.get(login=user).id
-        ut = UserTags(user=user_id, bbox=bbox, description=description, tags=tags, node=node, way=way, relation=relation)
+        ut = UserTags(user=user_id, bbox=bbox, description=description, tags=tags, node=node, way=way,
+                      relation=relation, geojson=geojson)
         commit()
         return ut.id
 
-    def get_template(self, template_name):
+    def get_template(self, template_name, language=None):
         """
-        Returns the template
+        Returns the template compiled for a language
 
-        :param template_name: Template name as a string
+        :param template_name: File name of the template on the templates directory
+        :param language: Language code, by default the language of the configuration
         :return: Template
         """
-
-        url = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                           'templates', template_name)
-        with open(url) as f:
-            template_text = f.read()
-        return self.jinja_env.from_string(template_text)
+        if language is None:
+            language = self.language
+        return self.registry.get_template(template_name, language)[0]
 
     def load_config(self, config: dict=None):
         """
@@ -765,135 +1620,589 @@ class Bard(object):
         else:
             self.conf = config
 
-        languages = ['en']
+        self.language = 'en'
         if 'email' in self.conf and 'language' in self.conf['email']:
-            tmp = languages
-            tmp.append(self.conf['email']['language'])
-            languages = tmp
+            self.language = self.conf['email']['language']
         if "email" not in self.conf or "url_locales" not in self.conf["email"] :
-            dir_path = os.path.dirname(os.path.realpath(__file__))
-            url_locales = os.path.join(dir_path, '../locales')
+            self.registry = get_registry(LOCALES_DIR)
         else:
-            url_locales = self.conf["email"]["url_locales"]
-
-        lang = gettext.translation(
-            'messages',
-            localedir=url_locales,
-            languages=languages)
-        lang.install()
-        translations = gettext.translation(
-            'messages',
-            localedir=url_locales,
-            languages=languages)
-        self.jinja_env.install_gettext_translations(translations)
-
-        self.handler.set_bbox(*self.conf["area"]["bbox"])
+            self.registry = get_registry(self.conf["email"]["url_locales"])
+        self.renderers = {}
+        self.mailer = None
+
+        if self.handler.cache is not None and "cache" in self.conf and "batch_size" in self.conf["cache"]:
+            self.handler.cache.batch_size = int(self.conf["cache"]["batch_size"])
+        if self.handler.cache is not None and "cache" in self.conf and "memory" in self.conf["cache"]:
+            self.handler.cache.elements.max_size = int(self.conf["cache"]["memory"]) * 1024 * 1024
+        if "cache" in self.conf and "compact_every" in self.conf["cache"]:
+            self.compact_every = int(self.conf["cache"]["compact_every"])
+        if "metrics" in self.conf and "textfile" in self.conf["metrics"]:
+            self.metrics_textfile = self.conf["metrics"]["textfile"]
+        if "history" in self.conf and "sqlite" in self.conf["history"]:
+            self.handler.set_history_store(SqliteHistory(self.conf["history"]["sqlite"]))
+        if "process" in self.conf and "locations" in self.conf["process"]:
+            self.locations = self.conf["process"]["locations"]
+        if "process" in self.conf and "workers" in self.conf["process"]:
+            self.workers = int(self.conf["process"]["workers"])
+        if "process" in self.conf and "prefilter" in self.conf["process"]:
+            self.handler.prefilter = str(self.conf["process"]["prefilter"]).lower() in ("true", "yes", "on", "1")
+        if "process" in self.conf and "changeset_sequences" in self.conf["process"]:
+            self.changeset_sequences = int(self.conf["process"]["changeset_sequences"])
+        if "process" in self.conf and "changesets" in self.conf["process"]:
+            self.set_changesets(self.conf["process"]["changesets"])
+
+        if "geojson" in self.conf["area"]:
+            self.handler.set_area(load_area(self.conf["area"]["geojson"]))
+        else:
+            self.handler.set_bbox(*self.conf["area"]["bbox"])
         for name in self.conf["tags"]:
             key, value = self.conf["tags"][name]["tags"].split("=")
             types = self.conf["tags"][name]["type"].split(",")
             self.stats["name"] = 0
             self.handler.set_tags(name, key, value, types)
 
-    def process_file(self, filename=None):
+    @db_session
+    def load_subscriptions(self, tags_id=None):
+        """
+        Loads the user tags from the database, all of them are evaluated on
+        the same pass over the file
+
+        :param tags_id: Ids of the user tags, if not set all the user tags are loaded
+        :type tags_id: list
+        :return: None
+        """
+        self.handler.load_tags_from_db(tags_id)
+
+    def process_file(self, filename=None, locations=None, workers=None):
         """
+        Process a change file, by default the last daily diff
 
-        :param filename: 
-        :return: 
+        :param filename: Change file to process
+        :param locations: Osmium index type of the location index, when set the node locations are collected on a first pass over the file and completed with the cache
+        :type locations: str
+        :param workers: Worker processes, when greater than 1 and the previous versions are requested to the OSM API the elements are split by id between the workers
+        :type workers: int
+        :return: None
         """
         if filename is None:
             osc = OSC()
             osc.periodicty = OSC.DAYLY
-            self.osc_file = osc.get_last()
-            self.handler.apply_file(self.osc_file,
-                                    osmium.osm.osm_entity_bits.CHANGESET)
+            self.process_sequence(osc, osc.get_sequence(), locations, workers)
+        else:
+            self.apply(filename, locations, workers=workers)
+
+    def process_buffer(self, data, file_format="osc.gz", locations=None):
+        """
+        Process the content of a change file without writing it to disk
+
+        :param data: Content of the change file
+        :type data: bytes
+        :param file_format: Format of the content
+        :type file_format: str
+        :param locations: Osmium index type of the location index, see process_file
+        :type locations: str
+        :return: None
+        """
+        self.apply(data, locations, file_format)
+
+    def set_changesets(self, source):
+        """
+        Sets the source of the metadata of the changesets used to skip the
+        changesets outside the watched bounding boxes before checking their
+        elements
+
+        :param source: Changesets file (like a changesets dump) or URL of the changesets replication, None to check all the changesets
+        :type source: str
+        :return: None
+        """
+        self.changeset_source = source
+        self.changeset_replication = None
+        if source is None:
+            self.handler.set_changeset_index(None)
+            return
+        if source.startswith("http://") or source.startswith("https://"):
+            self.changeset_replication = ChangesetReplication(source)
+        self.handler.set_changeset_index(ChangesetIndex())
+
+    def update_changesets(self, start=None):
+        """
+        Loads the metadata of the changesets, the file is read once and the
+        sequences of the replication published since the last update are
+        downloaded before each change file. Only the changesets that touch the
+        default bounding box or the ones of the watched tags keep their
+        bounding box in memory, see compaction_bboxes.
+
+        :param start: Time of the start of the change file, the sequences of the replication published before it aren't downloaded
+        :type start: datetime
+        :return: Changesets read
+        :rtype: int
+        """
+        index = self.handler.changeset_index
+        index.set_bboxes(self.compaction_bboxes())
+        if self.changeset_replication is not None:
+            count = self.changeset_replication.update(index, self.changeset_sequences, start)
+        elif not len(index):
+            count = index.load(self.changeset_source)
         else:
-            self.handler.apply_file(filename,
-                                    osmium.osm.osm_entity_bits.CHANGESET)
+            return 0
+        self.handler.changeset_candidates = {}
+        return count
+
+    def apply(self, source, locations=None, file_format=None, workers=None, start=None):
+        """
+        Runs the handler over a change file or its content and collects the results
+
+        :param source: Change file or its content if the format is set
+        :param locations: Osmium index type of the location index, see process_file
+        :type locations: str
+        :param file_format: Format of the content, like "osc.gz"
+        :type file_format: str
+        :param workers: Worker processes, see process_file
+        :type workers: int
+        :param start: Time of the start of the change file, see update_changesets
+        :type start: datetime
+        :return: None
+        """
+        if locations is None:
+            locations = self.locations
+        workers = self.get_workers(workers)
+
+        if self.changeset_source is not None:
+            with self.metrics.stage("changesets"):
+                self.metrics.count("changesets_loaded", self.update_changesets(start))
+        counters = (self.handler.num_nodes, self.handler.num_ways, self.handler.num_rel)
+        with self.metrics.stage("process"):
+            if workers > 1:
+                self.apply_parallel(source, locations, file_format, workers)
+            else:
+                self.run_handler(source, locations, file_format)
+        history_stats = self.handler.get_history().get_stats()
+        cache_stats = self.handler.get_cache_stats()
+        self.metrics.merge(self.handler.collect_metrics())
+        self.metrics.count("nodes", self.handler.num_nodes - counters[0])
+        self.metrics.count("ways", self.handler.num_ways - counters[1])
+        self.metrics.count("relations", self.handler.num_rel - counters[2])
+        self.metrics.count("changesets", len(self.handler.changeset))
 
         self.changesets = self.handler.changeset
+        self.tag_changesets = self.handler.tag_changesets
         self.stats = self.handler.stats
+        self.run_stats["history"] = history_stats
+        if cache_stats is not None:
+            self.run_stats["cache"] = cache_stats
         self.stats["total"] = len(self.changesets)
 
+        self.processed += 1
+        if self.compact_every and self.handler.cache_enabled and self.processed % self.compact_every == 0:
+            self.run_stats["compaction"] = self.compact_cache()
+
+    def compaction_bboxes(self):
+        """
+        Returns the bounding boxes whose elements are kept on the cache, the
+        default one and the ones of the watched tags
+
+        :return: Bounding boxes as north, east, south, west
+        :rtype: list
+        """
+        bboxes = []
+        for bbox in [self.handler.get_bbox()] + [self.handler.tag_bbox(name) for name in self.handler.tags]:
+            if bbox != (0, 0, 0, 0) and bbox not in bboxes:
+                bboxes.append(bbox)
+        return bboxes
+
+    def compact_cache(self, versions=None, outside=None, range_size=None, vacuum=True):
+        """
+        Compacts the cache, the settings not set are read from the cache
+        section of the configuration
+
+        :param versions: Versions of each element to keep (2 by default)
+        :type versions: int
+        :param outside: Remove the elements outside all the bounding boxes of the watched tags and the user tags of the database (False by default)
+        :type outside: bool
+        :param range_size: Ids compacted on each transaction (1000000 by default)
+        :type range_size: int
+        :param vacuum: Vacuum and analyze the tables after removing the rows
+        :type vacuum: bool
+        :return: Metrics by table, see CacheCompactor.compact
+        :rtype: dict
+        """
+        conf = self.conf.get("cache", {})
+        if versions is None:
+            versions = int(conf.get("keep_versions", 2))
+        if outside is None:
+            outside = str(conf.get("compact_outside", False)).lower() in ("true", "yes", "on", "1")
+        if range_size is None:
+            range_size = int(conf.get("range_size", 1000000))
+        bboxes = None
+        if outside:
+            bboxes = self.compaction_bboxes()
+            for bbox in self.handler.get_subscription_bboxes():
+                if bbox not in bboxes:
+                    bboxes.append(bbox)
+            if not bboxes:
+                raise ValueError("There isn't any bounding box to keep")
+        return self.handler.cache.compact(versions, bboxes, range_size, vacuum)
+
+    def get_workers(self, workers=None):
+        """
+        Returns the worker processes used to process a file. Every worker
+        parses the whole file, so they only pay off when the requests of
+        previous versions wait for the OSM API. With local history providers
+        the file is processed on a single process.
+
+        :param workers: Worker processes, if not set the ones of the configuration
+        :type workers: int
+        :return: Worker processes
+        :rtype: int
+        """
+        if workers is None:
+            workers = self.workers
+        if workers > 1 and not self.handler.get_history().remote:
+            return 1
+        return workers
+
+    def run_handler(self, source, locations, file_format=None):
+        """
+        Runs the handler over a change file or its content
+
+        :param source: Change file or its content if the format is set
+        :param locations: Osmium index type of the location index, see process_file
+        :type locations: str
+        :param file_format: Format of the content, like "osc.gz"
+        :type file_format: str
+        :return: None
+        """
+        if file_format is None:
+            apply = self.handler.apply_file
+        else:
+            def apply(data, **kwargs):
+                self.handler.apply_buffer(data, file_format, **kwargs)
+
+        # The filters argument only exists since pyosmium 4.0
+        filters = self.handler.get_filters()
+        kwargs = {"filters": filters} if filters else {}
+        if locations:
+            index = LocationIndex(locations)
+            index.load(source, self.handler.cache if self.handler.cache_enabled else None, file_format)
+            self.handler.set_location_index(index)
+            apply(source, locations=False, **kwargs)
+            self.handler.set_location_index(None)
+        else:
+            apply(source, locations=True, **kwargs)
+
+        if self.handler.history_store is not None:
+            self.handler.history_store.commit()
+        if self.handler.cache_enabled:
+            self.handler.cache.commit()
+
+    def apply_parallel(self, source, locations, file_format, workers):
+        """
+        Runs a handler for each shard of the file on a pool of forked
+        processes and merges the changes of the shards in the order of the
+        file, the results are the same as the ones of a single handler. Each
+        worker parses the whole file and skips the elements of the other
+        shards, so only the work of the callbacks (matching, bounding box
+        tests and requests of previous versions and members) is split
+        between the workers. The elements stored by the workers are written
+        on the history store by this process.
+
+        :param source: Change file or its content if the format is set
+        :param locations: Osmium index type of the location index, see process_file
+        :type locations: str
+        :param file_format: Format of the content, like "osc.gz"
+        :type file_format: str
+        :param workers: Worker processes
+        :type workers: int
+        :return: None
+        """
+        global _shard_bard, _shard_source
+        if self.handler.cache_enabled:
+            self.handler.cache.close()
+        _shard_bard = self
+        _shard_source = source
+        context = multiprocessing.get_context("fork")
+        try:
+            # A process for each shard, so the counters of a worker are the ones of its shard
+            with context.Pool(workers, init_shard_worker, maxtasksperchild=1) as pool:
+                results = pool.starmap(
+                    process_shard, [(shard, workers, locations, file_format) for shard in range(workers)])
+        finally:
+            _shard_bard = None
+            _shard_source = None
+
+        changes = []
+        history = self.handler.get_history()
+        for shard_changes, counters, history_stats, cache_stats, metrics, stored in results:
+            changes.extend(shard_changes)
+            self.metrics.merge(metrics)
+            self.handler.num_nodes += counters[0]
+            self.handler.num_ways += counters[1]
+            self.handler.num_rel += counters[2]
+            history.add_stats(history_stats)
+            if cache_stats is not None:
+                self.handler.cache.elements.add_stats(cache_stats)
+            for row in stored:
+                self.handler.history_store.store(*row)
+        if self.handler.history_store is not None:
+            self.handler.history_store.commit()
+        changes.sort(key=lambda change: change[0])
+        for position, element, tag_name, ids_key in changes:
+            self.handler.add_change(element, tag_name, ids_key)
+
+    def process_sequence(self, osc, sequence, locations=None, workers=None):
+        """
+        Process a sequence of the replication system. When the change file
+        is parsed once, it is parsed from a pipe while it is downloaded and
+        decompressed, without keeping it in memory. The location index and
+        the workers parse it more than once, then the compressed file is
+        downloaded first and kept in memory.
+
+        :param osc: Replication system
+        :type osc: OSC
+        :param sequence: Sequence number
+        :type sequence: int
+        :param locations: Osmium index type of the location index, see process_file
+        :type locations: str
+        :param workers: Worker processes, see process_file
+        :type workers: int
+        :return: None
+        """
+        if locations is None:
+            locations = self.locations
+        workers = self.get_workers(workers)
+        self.osc_file = osc.get_diff_url(sequence)
+        start = None
+        if self.changeset_replication is not None:
+            start = osc.get_timestamp(sequence - 1)
+        stream = osc.stream(sequence)
+        if locations or workers > 1:
+            with self.metrics.stage("download"):
+                data = stream.read()
+            self.apply(data, locations, "osc.gz", workers, start)
+        else:
+            with stream.open() as filename:
+                self.apply(filename, locations, None, workers, start)
+
+    def follow(self, state_file, osc=None, interval=60, subscriptions=False,
+               report=False, iterations=None):
+        """
+        Follows the replication system processing every published sequence
+        after the last processed one, the last processed sequence is stored
+        on the state file so the missed sequences are processed on the next
+        run and no sequence is processed twice
+
+        :param state_file: Path of the file with the last processed sequence
+        :type state_file: str
+        :param osc: Replication system, by default the minutely diffs
+        :type osc: OSC
+        :param interval: Seconds between polls of the replication state
+        :type interval: int
+        :param subscriptions: Save the results of the user tags of each sequence
+        :type subscriptions: bool
+        :param report: Send the report of each sequence
+        :type report: bool
+        :param iterations: Polls before returning, if not set follows forever
+        :type iterations: int
+        :return: Last processed sequence
+        :rtype: int
+        """
+        if osc is None:
+            osc = OSC()
+            osc.periodicty = OSC.MINUTELY
+        state = SequenceState(state_file)
+        last = state.load()
+        poll = 0
+        while iterations is None or poll < iterations:
+            poll += 1
+            current = osc.get_sequence()
+            if last is None:
+                last = current - 1
+            for sequence in range(last + 1, current + 1):
+                self.handler.clear_changes()
+                self.process_sequence(osc, sequence)
+                if report:
+                    self.report()
+                if subscriptions:
+                    self.save_results()
+                state.save(sequence)
+                last = sequence
+                if self.metrics_textfile:
+                    self.write_metrics(self.metrics_textfile)
+            self.wait_mail()
+            if iterations is None or poll < iterations:
+                sleep(interval)
+        return last
+
+    def get_metrics(self):
+        """
+        Returns the wall time and calls of each stage and the counters of all
+        the processed files. The stages are download (only for the diffs of
+        the replication system parsed more than once, the streamed ones are
+        downloaded during the process stage), process, the node, way and relation
+        callbacks, history (the requests of previous versions), db_write,
+        render and send. The callbacks include the time of the history and
+        API requests they wait for.
+
+        :return: Stages, counters, elements per second and the stats of the history and the cache
+        :rtype: dict
+        """
+        metrics = self.metrics.to_dict()
+        counters = metrics["counters"]
+        elements = counters.get("nodes", 0) + counters.get("ways", 0) + counters.get("relations", 0)
+        seconds = metrics["stages"].get("process", {}).get("seconds")
+        if seconds:
+            metrics["elements_per_second"] = elements / seconds
+        else:
+            metrics["elements_per_second"] = 0.0
+        metrics["history"] = self.run_stats.get("history")
+        metrics["cache"] = self.run_stats.get("cache")
+        return metrics
+
+    def write_metrics(self, filename):
+        """
+        Writes the metrics on a file for the textfile collector of Prometheus
+
+        :param filename: Path of the file, it must end with .prom
+        :type filename: str
+        :return: None
+        """
+        write_textfile(filename, self.get_metrics())
+
     def generate_report_data(self)-> dict:
         """
-        Generates the data for the report
+        Generates the data for the report, when there are more changesets
+        than the limit only the ones with more changes are reported
 
         :return: Report data
         """
         from datetime import datetime
-        print("self.changesets:{}".format(self.changesets))
-        if len(self.changesets) > 1000:
-            self.changesets = self.changesets[:999]
-            self.stats[
-                'limit_exceed'] = 'Note: For performance reasons only the first 1000 changesets are displayed.'
+        changesets = self.changesets
+        if not isinstance(changesets, dict):
+            changesets = dict((record.changeset, record) for record in changesets)
+        selected = select_changesets(changesets, self.report_limit)
 
         now = datetime.now()
 
+        stats = {}
         for state in self.stats:
-            if state != "total":
-                self.stats[state] = len(set(self.stats[state]))
+            if state == "total":
+                stats[state] = self.stats[state]
+            else:
+                stats[state] = len(set(self.stats[state]))
 
         template_data = {
-            'changesets': self.changesets,
-            'stats': self.stats,
+            'changesets': selected,
+            'stats': stats,
             'date': now.strftime("%B %d, %Y"),
             'tags': sorted(list(self.conf['tags'].keys()))
         }
-        return  template_data
+        if len(selected) < len(changesets):
+            template_data['limit_exceed'] = \
+                'Note: For performance reasons only the {} changesets with more changes are displayed.'.format(
+                    self.report_limit)
+        return template_data
 
+    def get_renderer(self, language=None):
+        """
+        Returns the renderer of the reports in a language, the renderers
+        and its rendered fragments are kept between reports
+
+        :param language: Language code, by default the language of the configuration
+        :type language: str
+        :return: Renderer
+        :rtype: ReportRenderer
+        """
+        if language is None:
+            language = self.language
+        renderer = self.renderers.get(language)
+        if renderer is None:
+            renderer = self.renderers[language] = ReportRenderer(self.registry, language)
+        return renderer
+
+    @db_session
     def save_results(self):
         """
+        Saves the changesets of each user tags on a ResultTags
 
         :return: None
         :rtype: None
         """
-        report_data = self.generate_report_data()
-        for change_id, values in report_data["changesets"].items():
-            if values.get("tag_id"):
-                ResultTags(
-                    timestamp=datetime.now(),
-                    user_tags=values.get("tag_id"),
-                    changesets=values
-                )
+        now = datetime.now()
+        for tag_id, changesets in self.tag_changesets.items():
+            ResultTags(
+                timestamp=now,
+                user_tags=tag_id,
+                changesets=[record.to_dict() for record in changesets.values()]
+            )
         commit()
 
-    def report(self):
+    def get_mailer(self):
+        """
+        Returns the Mailgun client of the configuration
+
+        :return: Client or None if Mailgun isn't configured
+        :rtype: MailgunClient
         """
-        Generates the report and sends it
+        conf = self.conf.get('mailgun', {})
+        if self.mailer is None and 'domain' in conf and 'api_key' in conf:
+            self.mailer = MailgunClient(
+                conf['domain'], conf['api_key'], conf.get('api_url'),
+                workers=int(conf.get('workers', 4)),
+                retries=int(conf.get('retries', 3)),
+                backoff=float(conf.get('backoff', 1.0)),
+                timeout=float(conf.get('timeout', 30)))
+        return self.mailer
 
+    def wait_mail(self):
+        """
+        Waits until the queued reports are sent and adds the time and the
+        requests to the metrics
+
+        :return: Responses of Mailgun
+        :rtype: list
+        """
+        if self.mailer is None:
+            return []
+        before = self.mailer.get_stats()
+        try:
+            return self.mailer.wait()
+        finally:
+            after = self.mailer.get_stats()
+            self.metrics.add_time("send", after["seconds"] - before["seconds"], after["requests"] - before["requests"])
+            self.metrics.count("mails_sent", after["sent"] - before["sent"])
+            self.metrics.count("mail_failed_requests", after["failed_requests"] - before["failed_requests"])
+
+    def report(self, recipients=None, language=None):
+        """
+        Generates the report and queues it to be sent, the report is sent in
+        the background until wait_mail is called
+
+        :param recipients: Addresses or recipient variables by address, by default the recipients of the configuration
+        :param language: Language code, by default the language of the configuration
+        :type language: str
         :return: None
         """
-        template_data = self.generate_report_data()
+        now = datetime.now()
+        with self.metrics.stage("render"):
+            template_data = self.generate_report_data()
+            renderer = self.get_renderer(language)
 
-        html_version = self.html_tmpl.render(**template_data)
-        text_version = self.text_tmpl.render(**template_data)
+            html_version = renderer.render("html", template_data)
+            text_version = renderer.render("text", template_data)
 
-        if 'domain' in self.conf['mailgun'] and 'api_key' in self.conf['mailgun']:
-            if "api_url" in self.conf["mailgun"]:
-                url = self.conf["mailgun"]["api_url"]
-            else:
-                url = 'https://api.mailgun.net/v3/{0}/messages'.format(
-                    self.conf['mailgun']['domain'])
-            resp = requests.post(
-                url,
-                auth=("api", self.conf['mailgun']['api_key']),
-                data={"from": "OSM Changes <mailgun@{}>".format(
-                    self.conf['mailgun']['domain']),
-                      "to": self.conf["email"]["recipients"].split(),
-                      "subject": 'OSM building and address changes {0}'.format(
-                          now.strftime("%B %d, %Y")),
-                      "text": text_version,
-                      "html": html_version})
-            print("response:{}".format(resp.status_code))
-            print("mailgun response:{}".format(resp.content))
+        mailer = self.get_mailer()
+        if mailer is not None:
+            if recipients is None:
+                recipients = self.conf["email"]["recipients"].split()
+            mailer.send(
+                'OSM building and address changes {0}'.format(now.strftime("%B %d, %Y")),
+                text_version, html_version, recipients)
 
         file_name = 'osm_change_report_{0}.html'.format(
             now.strftime('%m-%d-%y'))
-        f_out = open(file_name, 'w')
-        f_out.write(html_version.encode('utf-8'))
-        f_out.close()
+        with open(file_name, 'w', encoding='utf-8') as f_out:
+            f_out.write(html_version)
         print('Wrote {0}'.format(file_name))
-        # os.unlink(self.osc_file)
 
 
 if __name__ == '__main__':
@@ -903,6 +2212,7 @@ if __name__ == '__main__':
         c.load_config()
         c.process_file()
         c.report()
+        c.wait_mail()
         c.save_results()
     except Exception:
         client.captureException()
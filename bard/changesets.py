@@ -0,0 +1,284 @@
+from datetime import datetime, timezone
+import math
+import sys
+
+import osmium
+import requests
+
+from .index import BboxIndex
+from .osc import OSC
+
+
+class ChangesetReader(osmium.SimpleHandler):
+    """
+    Reads the metadata of the changesets of a changesets file into an index
+    """
+
+    def __init__(self, index):
+        """
+        Class constructor
+
+        :param index: Index where the changesets are added
+        :type index: ChangesetIndex
+        """
+        osmium.SimpleHandler.__init__(self)
+        self.index = index
+        self.count = 0
+
+    def changeset(self, changeset):
+        self.count += 1
+        if changeset.open or not changeset.bounds.valid():
+            self.index.discard(changeset.id)
+            return
+        top_right = changeset.bounds.top_right
+        bottom_left = changeset.bounds.bottom_left
+        self.index.add(
+            changeset.id,
+            (top_right.lat, top_right.lon, bottom_left.lat, bottom_left.lon),
+            changeset.num_changes)
+
+
+class ChangesetIndex(object):
+    """
+    Bounding box and number of changes of the closed changesets. The
+    bounding box of a closed changeset contains all its elements, so the
+    elements of a changeset outside all the watched bounding boxes can be
+    skipped. The open changesets can still grow and aren't indexed. When the
+    watched bounding boxes are set, the changesets outside all of them only
+    keep their id.
+    """
+
+    def __init__(self):
+        """
+        Class constructor
+        """
+        self.changesets = {}
+        self.outside = set()
+        self.watched = None
+
+    def __len__(self):
+        return len(self.changesets) + len(self.outside)
+
+    def set_bboxes(self, bboxes):
+        """
+        Sets the watched bounding boxes, the changesets read after that are
+        checked against them
+
+        :param bboxes: Bounding boxes as north, east, south, west, None or empty to keep all the changesets
+        :type bboxes: list
+        :return: None
+        """
+        if not bboxes:
+            self.watched = None
+            return
+        self.watched = BboxIndex()
+        for pos, bbox in enumerate(bboxes):
+            self.watched.add(pos, bbox)
+
+    def add(self, changeset_id, bbox, num_changes):
+        """
+        Adds a closed changeset
+
+        :param changeset_id: Id of the changeset
+        :type changeset_id: int
+        :param bbox: Bounding box as north, east, south, west
+        :type bbox: tuple
+        :param num_changes: Number of changes of the changeset
+        :type num_changes: int
+        :return: None
+        """
+        if self.watched is not None and not self.watched.query_bbox(*bbox):
+            self.changesets.pop(changeset_id, None)
+            self.outside.add(changeset_id)
+            return
+        self.outside.discard(changeset_id)
+        self.changesets[changeset_id] = (bbox, num_changes)
+
+    def discard(self, changeset_id):
+        """
+        Removes a changeset, used when a changeset is read again while it's open
+
+        :param changeset_id: Id of the changeset
+        :type changeset_id: int
+        :return: None
+        """
+        self.changesets.pop(changeset_id, None)
+        self.outside.discard(changeset_id)
+
+    def is_outside(self, changeset_id):
+        """
+        Checks if a closed changeset doesn't touch any watched bounding box
+
+        :param changeset_id: Id of the changeset
+        :type changeset_id: int
+        :return: True if the changeset is outside all the watched bounding boxes
+        :rtype: bool
+        """
+        return changeset_id in self.outside
+
+    def get_bbox(self, changeset_id):
+        """
+        Returns the bounding box of a changeset
+
+        :param changeset_id: Id of the changeset
+        :type changeset_id: int
+        :return: Bounding box as north, east, south, west or None if the changeset is unknown
+        :rtype: tuple
+        """
+        changeset = self.changesets.get(changeset_id)
+        if changeset is None:
+            return None
+        return changeset[0]
+
+    def get_num_changes(self, changeset_id):
+        """
+        Returns the number of changes of a changeset
+
+        :param changeset_id: Id of the changeset
+        :type changeset_id: int
+        :return: Number of changes or None if the changeset is unknown
+        :rtype: int
+        """
+        changeset = self.changesets.get(changeset_id)
+        if changeset is None:
+            return None
+        return changeset[1]
+
+    def load(self, source, file_format=None):
+        """
+        Loads the changesets of a changesets file, like a file of the
+        changesets replication or an extract of the changesets dump. The file
+        is streamed, only the changesets that touch a watched bounding box
+        keep their bounding box in memory
+
+        :param source: Changesets file or its content if the format is set
+        :param file_format: Format of the content, like "osm.gz"
+        :type file_format: str
+        :return: Changesets read
+        :rtype: int
+        """
+        reader = ChangesetReader(self)
+        if file_format is None:
+            reader.apply_file(source)
+        else:
+            reader.apply_buffer(source, file_format)
+        return reader.count
+
+
+def parse_changeset_state(text)-> int:
+    """
+    Parses the state file of the changesets replication
+
+    :param text: Content of the state.yaml file
+    :type text: str
+    :return: Sequence number
+    """
+    for line in text.splitlines():
+        if line.startswith("sequence:"):
+            return int(line.split(":", 1)[1])
+    raise ValueError("The state doesn't have a sequence")
+
+
+def parse_changeset_time(text):
+    """
+    Parses the time of the last run of the state file of the changesets
+    replication
+
+    :param text: Content of the state.yaml file
+    :type text: str
+    :return: Time of the last run or None if the state doesn't have it
+    :rtype: datetime
+    """
+    for line in text.splitlines():
+        if line.startswith("last_run:"):
+            value = line.split(":", 1)[1].strip()
+            return datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    return None
+
+
+class ChangesetReplication(object):
+    """
+    Changesets replication system, each sequence has the changesets opened,
+    updated or closed on a minute
+    """
+
+    def __init__(self, base_url="https://planet.osm.org/replication/changesets"):
+        """
+        Class constructor
+
+        :param base_url: URL of the changesets replication
+        :type base_url: str
+        """
+        self.base_url = base_url.rstrip("/")
+        self.last_sequence = None
+
+    def get_url(self, path):
+        """
+        Returns the URL of a file of the changesets replication
+
+        :param path: Path of the file
+        :type path: str
+        :return: URL
+        :rtype: str
+        """
+        return "{}/{}".format(self.base_url, path)
+
+    def get_state(self)-> str:
+        """
+        Downloads the state file of the changesets replication
+
+        :return: Content of the state.yaml file
+        """
+        r = requests.get(self.get_url("state.yaml"))
+        r.raise_for_status()
+        return r.text
+
+    def get_sequence(self)-> int:
+        """
+        Returns the number of the last published sequence
+
+        :return: Sequence number
+        """
+        return parse_changeset_state(self.get_state())
+
+    def get_changesets(self, sequence)-> bytes:
+        """
+        Downloads the compressed changesets file of a sequence
+
+        :param sequence: Sequence number
+        :type sequence: int
+        :return: Content of the .osm.gz file
+        """
+        url = self.get_url("{}.osm.gz".format(OSC.sequence_path(sequence)))
+        sys.stderr.write('downloading {0}...\n'.format(url))
+        r = requests.get(url)
+        r.raise_for_status()
+        return r.content
+
+    def update(self, index, sequences=60, start=None):
+        """
+        Loads on the index the sequences published since the last update, at
+        most the ones published since the start of the processed change file
+
+        :param index: Index of changesets
+        :type index: ChangesetIndex
+        :param sequences: Maximum number of sequences to download when the start isn't known
+        :type sequences: int
+        :param start: Time of the start of the processed change file, its changesets are closed after it
+        :type start: datetime
+        :return: Changesets read
+        :rtype: int
+        """
+        state = self.get_state()
+        last = parse_changeset_state(state)
+        last_run = parse_changeset_time(state)
+        if start is not None and last_run is not None:
+            sequences = max(int(math.ceil((last_run - start).total_seconds() / 60.0)), 0) + 1
+        first = max(last - sequences + 1, 0)
+        if self.last_sequence is not None:
+            first = max(first, self.last_sequence + 1)
+        count = 0
+        for sequence in range(first, last + 1):
+            count += index.load(self.get_changesets(sequence), "osm.gz")
+            self.last_sequence = sequence
+        return count
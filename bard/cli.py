@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
+import json
+import sys
+
 import click
 from raven import Client
 from bard import Bard
+from bard import ChangeHandler
+from bard.osc import OSC
+from bard.profiling import RunProfiler
 
 
 @click.group()
@@ -16,15 +22,29 @@ def bardgroup():
 @click.option('--user', default=None)
 @click.option('--password', default=None)
 @click.option("--file",default=None)
-def process(host, db, user, password, file):
+@click.option("--subscriptions/--no-subscriptions", default=False)
+@click.option("--prometheus", default=None)
+@click.option("--profile", default=None)
+@click.option("--profile-top", default=20)
+@click.option("--workers", type=int, default=None,
+              help="Processes used when the previous versions are requested to the OSM API, "
+                   "every process parses the whole file so with the cache or the history store "
+                   "the file is processed on a single process")
+def process(process, host, db, user, password, file, subscriptions, prometheus, profile, profile_top, workers):
     """
-    Process file
+    Process file, the metrics of the run are printed as JSON at the end
 
+    :param process: Name of the run, not used
     :param host:
     :param db:
     :param user:
     :param password:
     :param file:
+    :param subscriptions: Evaluate all the user tags of the database and save its results
+    :param prometheus: File where the metrics are written for the textfile collector of Prometheus
+    :param profile: File where the cProfile statistics of the processing are saved, the file is processed on a single process
+    :param profile_top: Functions of each group of the profile summary
+    :param workers: Worker processes, by default the ones of the configuration
     :return: None
     """
 
@@ -32,14 +52,114 @@ def process(host, db, user, password, file):
     try:
         c = Bard(host, db, user, password)
         c.load_config()
-        if file is not None:
+        if workers is not None:
+            c.workers = workers
+        if subscriptions:
+            c.load_subscriptions()
+        if profile is not None:
+            c.workers = 1
+            with RunProfiler(profile, profile_top) as profiler:
+                c.process_file(None if file is None else str(file))
+            click.echo(profiler.format_summary(ChangeHandler), err=True)
+        elif file is not None:
             c.process_file(str(file))
         else:
             c.process_file()
         c.report()
+        if subscriptions:
+            c.save_results()
+        c.wait_mail()
+        click.echo(json.dumps(c.get_metrics(), sort_keys=True))
+        if prometheus is None:
+            prometheus = c.metrics_textfile
+        if prometheus:
+            c.write_metrics(prometheus)
     except Exception as e:
-            print(e.message)
-            client.captureException()
+        click.echo(str(e), err=True)
+        client.captureException()
+        sys.exit(1)
+
+
+@bardgroup.command("follow")
+@click.argument("state")
+@click.option('--host', default=None)
+@click.option('--db', default=None)
+@click.option('--user', default=None)
+@click.option('--password', default=None)
+@click.option("--periodicity", type=click.Choice(["minute", "hour", "day"]), default="minute")
+@click.option("--interval", default=60)
+@click.option("--subscriptions/--no-subscriptions", default=False)
+@click.option("--report/--no-report", default=False)
+def follow(state, host, db, user, password, periodicity, interval, subscriptions, report):
+    """
+    Follows the replication diffs
+
+    :param state: File with the last processed sequence
+    :param host:
+    :param db:
+    :param user:
+    :param password:
+    :param periodicity: Replication periodicity to follow
+    :param interval: Seconds between polls of the replication state
+    :param subscriptions: Evaluate all the user tags of the database and save its results
+    :param report: Send the report of each processed diff
+    :return: None
+    """
+
+    client = Client()
+    try:
+        c = Bard(host, db, user, password)
+        c.load_config()
+        if subscriptions:
+            c.load_subscriptions()
+        osc = OSC()
+        osc.periodicty = dict((name, key) for key, name in OSC.replication_name.items())[periodicity]
+        c.follow(state, osc, interval, subscriptions, report)
+    except Exception:
+        client.captureException()
+        raise
+
+
+@bardgroup.group("cache")
+def cache():
+    """
+    Maintenance of the database cache
+    """
+    pass
+
+
+@cache.command("compact")
+@click.option('--host', default=None)
+@click.option('--db', default=None)
+@click.option('--user', default=None)
+@click.option('--password', default=None)
+@click.option("--versions", type=int, default=None)
+@click.option("--outside/--no-outside", default=None)
+@click.option("--range-size", type=int, default=None)
+@click.option("--subscriptions/--no-subscriptions", default=False)
+@click.option("--vacuum/--no-vacuum", default=True)
+def compact(host, db, user, password, versions, outside, range_size, subscriptions, vacuum):
+    """
+    Compacts the cache and prints the size and the rows pruned of each table
+
+    :param host:
+    :param db:
+    :param user:
+    :param password:
+    :param versions: Versions of each element to keep
+    :param outside: Remove the elements outside all the bounding boxes
+    :param range_size: Ids compacted on each transaction
+    :param subscriptions: Load the user tags of the database, their bounding boxes are kept even when they aren't loaded
+    :param vacuum: Vacuum and analyze the tables after removing the rows
+    :return: None
+    """
+
+    c = Bard(host, db, user, password)
+    c.load_config()
+    if subscriptions:
+        c.load_subscriptions()
+    metrics = c.compact_cache(versions, outside, range_size, vacuum)
+    click.echo(json.dumps(metrics, indent=2, sort_keys=True))
 
 
 @bardgroup.command("adduser")
@@ -74,11 +194,12 @@ def adduser(login, userpassword, host, db, user, password):
 @click.option("--node/--no-node", default=False)
 @click.option("--way/--no-way", default=False)
 @click.option("--relation/--no-relation", default=False)
+@click.option("--geojson", default=None, type=click.Path(exists=True))
 @click.option('--host', default=None)
 @click.option('--db', default=None)
 @click.option('--user','dbuser', default=None)
 @click.option('--password', default=None)
-def adduser(user,bbox,description,tags,node,way,relation, host, db, dbuser, password):
+def adduser(user,bbox,description,tags,node,way,relation, geojson, host, db, dbuser, password):
     """
     Adds user to bard
 
@@ -86,6 +207,7 @@ def adduser(user,bbox,description,tags,node,way,relation, host, db, dbuser, pass
     :param bbox: Bounding box to apply the tags
     :param description: Tags description
     :param tags: Tags to evauate
+    :param geojson: GeoJSON file with the polygon of the tags
     :param host: Postgres host
     :param db: Database name
     :param dbuser: Database user
@@ -93,8 +215,11 @@ def adduser(user,bbox,description,tags,node,way,relation, host, db, dbuser, pass
     :return: None
     """
 
+    if geojson is not None:
+        with open(geojson) as f:
+            geojson = f.read()
     bard = Bard(host, db, dbuser, password)
-    bard.create_tags(user, bbox, description, tags, node, way, relation)
+    bard.create_tags(user, bbox, description, tags, node, way, relation, geojson)
 
 
 @bardgroup.command("initialize")
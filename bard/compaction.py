@@ -0,0 +1,195 @@
+import time
+
+# Tables of the cache
+CACHE_TABLES = ("cache_node", "cache_way")
+
+# Deletes the versions older than the last ones of each element of a range of ids
+PRUNE_VERSIONS_SQL = (
+    "DELETE FROM {table} WHERE id IN ("
+    "SELECT id FROM ("
+    "SELECT id, row_number() OVER (PARTITION BY osm_id ORDER BY version DESC NULLS LAST, id DESC) AS position "
+    "FROM {table} WHERE osm_id >= %(low)s AND osm_id < %(high)s"
+    ") AS versions WHERE position > %(versions)s)"
+)
+
+# Deletes the elements of a range of ids without any version intersecting the bounding boxes
+PRUNE_OUTSIDE_SQL = (
+    "DELETE FROM {table} WHERE osm_id >= %(low)s AND osm_id < %(high)s AND osm_id NOT IN ("
+    "SELECT osm_id FROM {table} WHERE osm_id >= %(low)s AND osm_id < %(high)s AND ({inside}))"
+)
+
+ENVELOPE_SQL = "ST_Intersects(geom, ST_MakeEnvelope(%({name})s_south, %({name})s_west, %({name})s_north, %({name})s_east, 4326))"
+
+
+def id_ranges(first, last, range_size):
+    """
+    Splits the ids between the first and the last one in ranges aligned to
+    the size of the range
+
+    :param first: First id
+    :type first: int
+    :param last: Last id
+    :type last: int
+    :param range_size: Ids of each range
+    :type range_size: int
+    :return: Generator of low, high tuples, the high id is not included
+    """
+    low = first - first % range_size
+    while low <= last:
+        yield low, low + range_size
+        low += range_size
+
+
+class CacheCompactor(object):
+    """
+    Removes the old versions of the elements of the cache and the elements
+    outside the bounding boxes. The tables are compacted by ranges of ids,
+    each range is a transaction so the deleted rows are released and the
+    indexes are updated in small steps
+    """
+
+    def __init__(self, connect, versions=2, bboxes=None, range_size=1000000):
+        """
+        Class constructor
+
+        :param connect: Function that returns a new psycopg2 connection
+        :param versions: Versions of each element to keep, the last ones
+        :type versions: int
+        :param bboxes: Bounding boxes as north, east, south, west, the elements outside all of them are removed. If not set no element is removed by its location
+        :type bboxes: list
+        :param range_size: Ids of each range
+        :type range_size: int
+        """
+        if versions < 1:
+            raise ValueError("At least one version must be kept")
+        self.connect = connect
+        self.versions = versions
+        self.bboxes = list(bboxes or [])
+        self.range_size = range_size
+
+    def table_stats(self, cursor, table):
+        """
+        Returns the size and the estimated rows of a table
+
+        :param cursor: Database cursor
+        :param table: Table name
+        :type table: str
+        :return: Size in bytes with its indexes and estimated rows
+        :rtype: dict
+        """
+        cursor.execute(
+            "SELECT pg_total_relation_size(oid), reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            (table,))
+        size, rows = cursor.fetchone()
+        return {"size": size, "rows": max(rows, 0)}
+
+    def table_ranges(self, cursor, table):
+        """
+        Returns the ranges of ids of a table
+
+        :param cursor: Database cursor
+        :param table: Table name
+        :type table: str
+        :return: Low, high tuples
+        :rtype: list
+        """
+        cursor.execute("SELECT min(osm_id), max(osm_id) FROM {}".format(table))
+        first, last = cursor.fetchone()
+        if first is None:
+            return []
+        return list(id_ranges(first, last, self.range_size))
+
+    def prune_versions(self, cursor, table, low, high):
+        """
+        Deletes the old versions of the elements of a range of ids
+
+        :param cursor: Database cursor
+        :param table: Table name
+        :type table: str
+        :param low: First id of the range
+        :type low: int
+        :param high: Id after the last one of the range
+        :type high: int
+        :return: Deleted rows
+        :rtype: int
+        """
+        cursor.execute(
+            PRUNE_VERSIONS_SQL.format(table=table),
+            {"low": low, "high": high, "versions": self.versions})
+        return cursor.rowcount
+
+    def prune_outside(self, cursor, table, low, high):
+        """
+        Deletes the elements of a range of ids that don't have any version
+        intersecting the bounding boxes
+
+        :param cursor: Database cursor
+        :param table: Table name
+        :type table: str
+        :param low: First id of the range
+        :type low: int
+        :param high: Id after the last one of the range
+        :type high: int
+        :return: Deleted rows
+        :rtype: int
+        """
+        if not self.bboxes:
+            return 0
+        params = {"low": low, "high": high}
+        conditions = []
+        for position, (north, east, south, west) in enumerate(self.bboxes):
+            name = "bbox{}".format(position)
+            conditions.append(ENVELOPE_SQL.format(name=name))
+            params[name + "_north"] = north
+            params[name + "_east"] = east
+            params[name + "_south"] = south
+            params[name + "_west"] = west
+        cursor.execute(PRUNE_OUTSIDE_SQL.format(table=table, inside=" OR ".join(conditions)), params)
+        return cursor.rowcount
+
+    def compact(self, vacuum=True):
+        """
+        Compacts the cache tables
+
+        :param vacuum: Vacuum and analyze the tables after removing the rows
+        :type vacuum: bool
+        :return: Size and rows before and after, rows pruned, ranges and seconds by table
+        :rtype: dict
+        """
+        metrics = {}
+        connection = self.connect()
+        try:
+            for table in CACHE_TABLES:
+                start = time.time()
+                with connection.cursor() as cursor:
+                    before = self.table_stats(cursor, table)
+                    ranges = self.table_ranges(cursor, table)
+                connection.commit()
+                pruned_versions = 0
+                pruned_outside = 0
+                for low, high in ranges:
+                    with connection.cursor() as cursor:
+                        pruned_outside += self.prune_outside(cursor, table, low, high)
+                        pruned_versions += self.prune_versions(cursor, table, low, high)
+                    connection.commit()
+                if vacuum:
+                    connection.autocommit = True
+                    with connection.cursor() as cursor:
+                        cursor.execute("VACUUM ANALYZE {}".format(table))
+                    connection.autocommit = False
+                with connection.cursor() as cursor:
+                    after = self.table_stats(cursor, table)
+                connection.commit()
+                metrics[table] = {
+                    "size_before": before["size"],
+                    "size_after": after["size"],
+                    "rows_before": before["rows"],
+                    "rows_after": after["rows"],
+                    "pruned_versions": pruned_versions,
+                    "pruned_outside": pruned_outside,
+                    "ranges": len(ranges),
+                    "seconds": time.time() - start
+                }
+        finally:
+            connection.close()
+        return metrics
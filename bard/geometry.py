@@ -0,0 +1,147 @@
+import itertools
+
+import numpy
+from shapely.geometry import LineString, Point, box
+
+# Points of a chunk of the containment test against several bounding boxes
+CHUNK_SIZE = 4096
+
+
+def point(node):
+    """
+    Returns the coordinates of a node
+
+    :param node: Node as a dict with lat and lon, a dict of the OSM API with data or a lat, lon sequence
+    :return: Latitude and longitude
+    :rtype: tuple
+    """
+    if isinstance(node, dict):
+        if "data" in node:
+            node = node["data"]
+        return node.get("lat"), node.get("lon")
+    return node[0], node[1]
+
+
+def coordinates(locations):
+    """
+    Returns the locations as an array of coordinates
+
+    :param locations: Lat, lon sequences, node dicts (see point) or lines of lat, lon sequences like the coordinates returned by LineConverter.sql2py
+    :return: Array of lat, lon rows
+    :rtype: numpy.ndarray
+    """
+    if isinstance(locations, numpy.ndarray):
+        return locations.reshape(-1, 2)
+    if len(locations) == 0:
+        return numpy.empty((0, 2))
+    first = locations[0]
+    if isinstance(first, dict):
+        return numpy.array([point(node) for node in locations], dtype=float)
+    if len(first) and isinstance(first[0], (list, tuple, numpy.ndarray)):
+        return numpy.concatenate([coordinates(line) for line in locations])
+    values = itertools.chain.from_iterable(locations)
+    return numpy.fromiter(values, dtype=float, count=2 * len(locations)).reshape(-1, 2)
+
+
+def bboxes_array(bboxes):
+    """
+    Returns the bounding boxes as an array
+
+    :param bboxes: Bounding boxes as north, east, south, west
+    :type bboxes: list
+    :return: Array of north, east, south, west rows
+    :rtype: numpy.ndarray
+    """
+    return numpy.asarray(bboxes, dtype=float).reshape(-1, 4)
+
+
+def in_bbox(points, bbox):
+    """
+    Checks which points are inside a bounding box, the points on the border
+    are outside
+
+    :param points: Array of lat, lon rows, see coordinates
+    :type points: numpy.ndarray
+    :param bbox: Bounding box as north, east, south, west
+    :type bbox: tuple
+    :return: Array of booleans
+    :rtype: numpy.ndarray
+    """
+    north, east, south, west = bbox
+    lat = points[:, 0]
+    lon = points[:, 1]
+    return (lat < north) & (lat > south) & (lon < east) & (lon > west)
+
+
+def any_in_bbox(points, bbox):
+    """
+    Checks if any point is inside a bounding box
+
+    :param points: Array of lat, lon rows, see coordinates
+    :type points: numpy.ndarray
+    :param bbox: Bounding box as north, east, south, west
+    :type bbox: tuple
+    :return: True if a point is inside
+    :rtype: bool
+    """
+    return bool(in_bbox(points, bbox).any())
+
+
+def bboxes_hit(points, bboxes, chunk_size=CHUNK_SIZE):
+    """
+    Checks which bounding boxes contain any of the points. The points
+    outside the envelope of the bounding boxes are discarded first, the
+    other ones are tested against all the bounding boxes at once in chunks
+
+    :param points: Array of lat, lon rows, see coordinates
+    :type points: numpy.ndarray
+    :param bboxes: Array of north, east, south, west rows, see bboxes_array
+    :type bboxes: numpy.ndarray
+    :param chunk_size: Points of each chunk
+    :type chunk_size: int
+    :return: Array of booleans, one for each bounding box
+    :rtype: numpy.ndarray
+    """
+    hit = numpy.zeros(len(bboxes), dtype=bool)
+    if not len(bboxes):
+        return hit
+    north, east, south, west = bboxes.T
+    envelope = (north.max(), east.max(), south.min(), west.min())
+    points = points[in_bbox(points, envelope)]
+    for start in range(0, len(points), chunk_size):
+        lat = points[start:start + chunk_size, 0, None]
+        lon = points[start:start + chunk_size, 1, None]
+        hit |= ((lat < north) & (lat > south) & (lon < east) & (lon > west)).any(axis=0)
+        if hit.all():
+            break
+    return hit
+
+
+def line(locations):
+    """
+    Returns the geometry of a point or a line
+
+    :param locations: Lat, lon sequences, a single one is a point
+    :type locations: list
+    :return: Point or line with lat, lon coordinates
+    :rtype: shapely.geometry.base.BaseGeometry
+    """
+    if len(locations) == 1:
+        return Point(locations[0])
+    return LineString(locations)
+
+
+def line_intersects_bbox(locations, bbox):
+    """
+    Checks if a point or a line intersects a bounding box, the border is
+    inside like on ST_Intersects of the database cache
+
+    :param locations: Lat, lon sequences, a single one is a point
+    :type locations: list
+    :param bbox: Bounding box as north, east, south, west
+    :type bbox: tuple
+    :return: True if the geometry intersects the bounding box
+    :rtype: bool
+    """
+    north, east, south, west = bbox
+    return line(locations).intersects(box(south, west, north, east))
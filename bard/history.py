@@ -0,0 +1,333 @@
+import json
+import sqlite3
+
+import osmapi
+
+
+def merge_stats(stats):
+    """
+    Merges the stats of several history chains
+
+    :param stats: Stats returned by HistoryChain.get_stats
+    :type stats: list
+    :return: Stats of all the requests
+    :rtype: dict
+    """
+    hits = {}
+    misses = 0
+    for chain_stats in stats:
+        for name, provider_hits in chain_stats["hits"].items():
+            hits[name] = hits.get(name, 0) + provider_hits
+        misses += chain_stats["misses"]
+    requests = sum(hits.values()) + misses
+    local = sum(provider_hits for name, provider_hits in hits.items() if name != ApiHistory.name)
+    if requests:
+        hit_rate = float(local) / requests
+    else:
+        hit_rate = 0.0
+    return {
+        "requests": requests,
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hit_rate
+    }
+
+
+class HistoryProvider(object):
+    """
+    Provider of the tags of previous versions of the elements
+    """
+
+    name = "provider"
+    # The requests wait for a remote service, like the OSM API
+    remote = False
+
+    def get_tags(self, elem, gid, version):
+        """
+        Returns the tags of a version of an element
+
+        :param elem: Type of element
+        :param gid: Element id
+        :param version: Version of the element
+        :return: Tags or None if the version is not available
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def store(self, elem, gid, version, tags):
+        """
+        Stores the tags of a version of an element, providers that can't store
+        elements ignore it
+
+        :param elem: Type of element
+        :param gid: Element id
+        :param version: Version of the element
+        :param tags: Tags of the element
+        :return: None
+        """
+        pass
+
+    def commit(self):
+        """
+        Commits the stored elements
+
+        :return: None
+        """
+        pass
+
+    def reconnect(self):
+        """
+        Opens new connections, used by the worker processes that inherit the
+        provider
+
+        :return: None
+        """
+        pass
+
+    def set_read_only(self, read_only):
+        """
+        Keeps the stored elements in memory instead of writing them, used by
+        the worker processes so only the parent process writes on the store
+
+        :param read_only: True to keep the stored elements in memory
+        :type read_only: bool
+        :return: None
+        """
+        pass
+
+    def take_stored(self):
+        """
+        Returns and forgets the elements kept in memory while read only
+
+        :return: Type, id, version and tags of the elements
+        :rtype: list
+        """
+        return []
+
+
+class CacheHistory(HistoryProvider):
+    """
+    Previous versions from the PostGIS cache
+    """
+
+    name = "cache"
+
+    def __init__(self, cache):
+        """
+        Class constructor
+
+        :param cache: Database cache
+        :type cache: DbCache
+        """
+        self.cache = cache
+
+    def get_tags(self, elem, gid, version):
+        if elem == "node":
+            element = self.cache.get_node(gid, version)
+        elif elem == "way":
+            element = self.cache.get_way(gid, version)
+        else:
+            element = None
+        if element is None:
+            return None
+        return element["data"]["tag"] or {}
+
+
+class SqliteHistory(HistoryProvider):
+    """
+    Local SQLite store of the tags of the elements of the processed diffs
+    """
+
+    name = "sqlite"
+
+    def __init__(self, filename, batch_size=10000):
+        """
+        Class constructor
+
+        :param filename: Path of the SQLite database
+        :type filename: str
+        :param batch_size: Elements stored between commits
+        :type batch_size: int
+        """
+        self.filename = filename
+        self.batch_size = batch_size
+        self.pending = 0
+        self.read_only = False
+        self.stored = {}
+        self.connect()
+
+    def connect(self):
+        """
+        Opens the database and creates the table if it doesn't exist
+
+        :return: None
+        """
+        self.connection = sqlite3.connect(self.filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "type TEXT NOT NULL, osm_id INTEGER NOT NULL, version INTEGER NOT NULL, tags TEXT, "
+            "PRIMARY KEY (type, osm_id, version))"
+        )
+
+    def get_tags(self, elem, gid, version):
+        tags = self.stored.get((elem, gid, version))
+        if tags is not None:
+            return tags
+        row = self.connection.execute(
+            "SELECT tags FROM history WHERE type = ? AND osm_id = ? AND version = ?",
+            (elem, gid, version)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def store(self, elem, gid, version, tags):
+        if self.read_only:
+            self.stored[(elem, gid, version)] = tags
+            return
+        self.connection.execute(
+            "INSERT OR REPLACE INTO history (type, osm_id, version, tags) VALUES (?, ?, ?, ?)",
+            (elem, gid, version, json.dumps(tags))
+        )
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        if self.read_only:
+            return
+        self.connection.commit()
+        self.pending = 0
+
+    def reconnect(self):
+        # An in memory database is copied by the fork and can't be reopened
+        if self.filename != ":memory:":
+            self.connect()
+            self.pending = 0
+
+    def set_read_only(self, read_only):
+        self.read_only = read_only
+
+    def take_stored(self):
+        stored = [key + (tags,) for key, tags in self.stored.items()]
+        self.stored = {}
+        return stored
+
+
+class ApiHistory(HistoryProvider):
+    """
+    Previous versions from the OSM API, only the requested version is
+    downloaded and the client is reused between calls
+    """
+
+    name = "api"
+    remote = True
+
+    def __init__(self, api=None):
+        """
+        Class constructor
+
+        :param api: OSM API client
+        :type api: osmapi.OsmApi
+        """
+        if api is None:
+            api = osmapi.OsmApi()
+        self.api = api
+
+    def get_tags(self, elem, gid, version):
+        if version < 1:
+            return None
+        if elem == "node":
+            element = self.api.NodeGet(gid, version)
+        elif elem == "way":
+            element = self.api.WayGet(gid, version)
+        elif elem == "relation":
+            element = self.api.RelationGet(gid, version)
+        else:
+            element = None
+        if not element:
+            return None
+        return element.get("tag") or {}
+
+
+class HistoryChain(HistoryProvider):
+    """
+    Asks the providers in order until one has the version, counting the
+    hits of each provider
+    """
+
+    name = "chain"
+
+    def __init__(self, providers):
+        """
+        Class constructor
+
+        :param providers: Providers sorted by preference
+        :type providers: list
+        """
+        self.providers = providers
+        self.hits = dict((provider.name, 0) for provider in providers)
+        self.misses = 0
+
+    @property
+    def remote(self):
+        """
+        Checks if any provider waits for a remote service
+
+        :return: True if a provider is remote
+        :rtype: bool
+        """
+        return any(provider.remote for provider in self.providers)
+
+    def get_tags(self, elem, gid, version):
+        for provider in self.providers:
+            tags = provider.get_tags(elem, gid, version)
+            if tags is not None:
+                self.hits[provider.name] += 1
+                return tags
+        self.misses += 1
+        return None
+
+    def store(self, elem, gid, version, tags):
+        for provider in self.providers:
+            provider.store(elem, gid, version, tags)
+
+    def commit(self):
+        for provider in self.providers:
+            provider.commit()
+
+    def reconnect(self):
+        for provider in self.providers:
+            provider.reconnect()
+
+    def clear_stats(self):
+        """
+        Resets the counters of the requests, used by the worker processes
+        that inherit the counters of the parent process
+
+        :return: None
+        """
+        self.hits = dict((provider.name, 0) for provider in self.providers)
+        self.misses = 0
+
+    def add_stats(self, stats):
+        """
+        Adds the requests counted by another chain, like the one of a worker process
+
+        :param stats: Stats returned by get_stats
+        :type stats: dict
+        :return: None
+        """
+        for name, hits in stats["hits"].items():
+            self.hits[name] = self.hits.get(name, 0) + hits
+        self.misses += stats["misses"]
+
+    def get_stats(self):
+        """
+        Returns the requests served by each provider and the rate of requests
+        served without using the API
+
+        :return: Stats of the history requests
+        :rtype: dict
+        """
+        return merge_stats([{"hits": self.hits, "misses": self.misses}])
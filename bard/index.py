@@ -0,0 +1,134 @@
+import math
+
+
+class BboxIndex(object):
+    """
+    Grid bucket index of bounding boxes, each bounding box is stored on all
+    the cells of the grid that it touches
+    """
+
+    def __init__(self, cell_size=0.25, max_cells=4096):
+        """
+        Class constructor
+
+        :param cell_size: Size in degrees of the cells of the grid
+        :type cell_size: float
+        :param max_cells: Bounding boxes covering more cells are checked on every query
+        :type max_cells: int
+        """
+        self.cell_size = float(cell_size)
+        self.max_cells = max_cells
+        self.cells = {}
+        self.large = []
+        self.entries = []
+        self.size = 0
+        # Bounding box of all the bounding boxes as north, east, south, west
+        self.bounds = None
+
+    def __len__(self):
+        return self.size
+
+    def cell(self, lat, lon):
+        """
+        Returns the cell of a coordinate
+
+        :param lat: Latitude
+        :param lon: Longitude
+        :return: Row and column of the cell
+        :rtype: tuple
+        """
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lon / self.cell_size))
+
+    def add(self, name, bbox):
+        """
+        Adds a bounding box to the index
+
+        :param name: Name to return on the queries
+        :param bbox: Bounding box as north, east, south, west
+        :type bbox: tuple
+        :return: None
+        """
+        north, east, south, west = bbox
+        entry = (name, north, east, south, west)
+        top, right = self.cell(north, east)
+        bottom, left = self.cell(south, west)
+        if top < bottom or right < left:
+            return
+        self.entries.append(entry)
+        if self.bounds is None:
+            self.bounds = bbox
+        else:
+            self.bounds = (
+                max(self.bounds[0], north), max(self.bounds[1], east),
+                min(self.bounds[2], south), min(self.bounds[3], west)
+            )
+        if (top - bottom + 1) * (right - left + 1) > self.max_cells:
+            self.large.append(entry)
+        else:
+            for row in range(bottom, top + 1):
+                for col in range(left, right + 1):
+                    self.cells.setdefault((row, col), []).append(entry)
+        self.size += 1
+
+    def query(self, lat, lon):
+        """
+        Returns the names of the bounding boxes that contain the coordinate
+
+        :param lat: Latitude
+        :param lon: Longitude
+        :return: Names of the bounding boxes
+        :rtype: set
+        """
+        names = set()
+        for entries in (self.cells.get(self.cell(lat, lon), ()), self.large):
+            for name, north, east, south, west in entries:
+                if north > lat > south and east > lon > west:
+                    names.add(name)
+        return names
+
+    def intersects(self, north, east, south, west):
+        """
+        Checks if a bounding box intersects the bounds of all the bounding
+        boxes, it's a quick test before querying the index
+
+        :param north: North of the bbox
+        :param east: East of the bbox
+        :param south: South of the bbox
+        :param west: West of the bbox
+        :return: False if it's far from every bounding box
+        :rtype: bool
+        """
+        if self.bounds is None:
+            return False
+        bounds_north, bounds_east, bounds_south, bounds_west = self.bounds
+        return bounds_north >= south and bounds_south <= north and bounds_east >= west and bounds_west <= east
+
+    def query_bbox(self, north, east, south, west):
+        """
+        Returns the names of the bounding boxes that intersect a bounding box,
+        the ones that only touch its border are included
+
+        :param north: North of the bbox
+        :param east: East of the bbox
+        :param south: South of the bbox
+        :param west: West of the bbox
+        :return: Names of the bounding boxes
+        :rtype: set
+        """
+        top, right = self.cell(north, east)
+        bottom, left = self.cell(south, west)
+        if top < bottom or right < left:
+            return set()
+        if (top - bottom + 1) * (right - left + 1) > self.max_cells:
+            buckets = [self.entries]
+        else:
+            buckets = [self.large] + [
+                self.cells.get((row, col), ())
+                for row in range(bottom, top + 1) for col in range(left, right + 1)
+            ]
+        names = set()
+        for entries in buckets:
+            for name, entry_north, entry_east, entry_south, entry_west in entries:
+                if entry_north >= south and entry_south <= north and entry_east >= west and entry_west <= east:
+                    names.add(name)
+        return names
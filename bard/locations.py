@@ -0,0 +1,139 @@
+from array import array
+
+import osmium
+
+# Sorted index types only find the locations inserted in id order
+SORTED_TYPES = ("flex_mem", "sparse_file_array", "sparse_mem_array", "sparse_mmap_array")
+
+
+class LocationCollector(osmium.SimpleHandler):
+    """
+    First pass over a change file, stores the node locations and the node
+    references of the ways
+    """
+
+    def __init__(self, index):
+        """
+        Class constructor
+
+        :param index: Index to fill
+        :type index: LocationIndex
+        """
+        osmium.SimpleHandler.__init__(self)
+        self.index = index
+
+    def node(self, node):
+        if node.location.valid():
+            self.index.set(node.id, node.location.lat, node.location.lon)
+
+    def way(self, way):
+        self.index.add_way(way.id, [node.ref for node in way.nodes])
+
+
+class LocationIndex(object):
+    """
+    Index of node locations built from the change file and the cache before
+    processing the ways and relations
+    """
+
+    def __init__(self, idx="sparse_mem_map"):
+        """
+        Class constructor
+
+        :param idx: Osmium index type, memory mapped types like "dense_mmap_array" or "dense_file_array,/path/to/file" can be used for big files
+        :type idx: str
+        """
+        if idx.split(",")[0] in SORTED_TYPES:
+            raise ValueError("Index type {} needs the nodes sorted by id".format(idx))
+        self.idx = idx
+        self.index = osmium.index.create_map(idx)
+        self.way_nodes = {}
+
+    def set(self, node_id, lat, lon):
+        """
+        Sets the location of a node
+
+        :param node_id: Node id
+        :param lat: Latitude
+        :param lon: Longitude
+        :return: None
+        """
+        self.index.set(node_id, osmium.osm.Location(lon, lat))
+
+    def get(self, node_id):
+        """
+        Returns the location of a node
+
+        :param node_id: Node id
+        :return: Latitude and longitude or None if the node is not indexed
+        :rtype: tuple
+        """
+        try:
+            location = self.index.get(node_id)
+        except KeyError:
+            return None
+        return location.lat, location.lon
+
+    def add_way(self, way_id, refs):
+        """
+        Stores the node references of a way
+
+        :param way_id: Way id
+        :param refs: Node ids of the way
+        :type refs: list
+        :return: None
+        """
+        self.way_nodes[way_id] = array("q", refs)
+
+    def way_locations(self, way_id):
+        """
+        Returns the locations of the nodes of a way of the change file
+
+        :param way_id: Way id
+        :return: Locations or None if the way or any of its nodes is not indexed
+        :rtype: list
+        """
+        refs = self.way_nodes.get(way_id)
+        if refs is None:
+            return None
+        locations = []
+        for ref in refs:
+            location = self.get(ref)
+            if location is None:
+                return None
+            locations.append(location)
+        return locations
+
+    def missing_nodes(self):
+        """
+        Returns the nodes of the ways without location
+
+        :return: Node ids
+        :rtype: list
+        """
+        missing = set()
+        for refs in self.way_nodes.values():
+            for ref in refs:
+                if ref not in missing and self.get(ref) is None:
+                    missing.add(ref)
+        return sorted(missing)
+
+    def load(self, filename, cache=None, file_format=None):
+        """
+        Fills the index with the nodes of the change file and the nodes of
+        its ways stored on the cache
+
+        :param filename: Change file or its content if the format is set
+        :param cache: Database cache
+        :type cache: DbCache
+        :param file_format: Format of the content, like "osc.gz"
+        :type file_format: str
+        :return: None
+        """
+        if file_format is None:
+            LocationCollector(self).apply_file(filename)
+        else:
+            LocationCollector(self).apply_buffer(filename, file_format)
+        if cache is not None:
+            for node_id, (lat, lon) in cache.get_node_locations(self.missing_nodes()).items():
+                self.set(node_id, lat, lon)
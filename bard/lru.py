@@ -0,0 +1,255 @@
+from collections import OrderedDict
+import sys
+
+# Cached value of the elements that are not on the database
+MISSING = object()
+
+# Estimated memory in bytes of a cached element by type, including its key.
+# Measuring every element costs more than the rest of the write.
+ELEMENT_SIZES = {"node": 600, "way": 1600}
+
+
+def estimate_size(value):
+    """
+    Returns an estimation of the memory used by a value and its contents
+
+    :param value: Value made of dicts, lists, tuples and scalars
+    :return: Size in bytes
+    :rtype: int
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += estimate_size(key) + estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
+
+def merge_stats(stats):
+    """
+    Merges the stats of several caches
+
+    :param stats: Stats returned by ElementCache.get_stats
+    :type stats: list
+    :return: Stats of all the caches
+    :rtype: dict
+    """
+    merged = {"hits": 0, "negative_hits": 0, "misses": 0, "evictions": 0, "items": 0, "size": 0}
+    for cache_stats in stats:
+        for key in merged:
+            merged[key] += cache_stats[key]
+    requests = merged["hits"] + merged["negative_hits"] + merged["misses"]
+    if requests:
+        merged["hit_rate"] = float(merged["hits"] + merged["negative_hits"]) / requests
+    else:
+        merged["hit_rate"] = 0.0
+    return merged
+
+
+class ElementCache(object):
+    """
+    Least recently used cache of the elements read from or written to the
+    database cache, keyed by type, id and version. The version None is the
+    last version of the element, the entry keeps its version so it's found
+    by version too. The elements that are not on the database are cached
+    too, the entries are evicted when the estimated memory used is bigger
+    than the limit.
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024, sizes=None):
+        """
+        Class constructor
+
+        :param max_size: Maximum estimated memory of the cached elements in bytes
+        :type max_size: int
+        :param sizes: Fixed estimated memory of an entry by type, the entries of other types are measured
+        :type sizes: dict
+        """
+        self.max_size = max_size
+        self.sizes = sizes or {}
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def find(self, elem, identifier, version=None):
+        """
+        Returns the key and the entry of a cached element, a version is
+        looked up on the last version when it isn't cached by itself
+
+        :param elem: Type of element
+        :param identifier: Element id
+        :param version: Version of the element, None for the last version
+        :return: Key and entry (value, size and version) or None if it's not cached
+        :rtype: tuple
+        """
+        key = (elem, identifier, version)
+        entry = self.entries.get(key)
+        if entry is None and version is not None:
+            key = (elem, identifier, None)
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] != version:
+                entry = None
+        return key, entry
+
+    def get(self, elem, identifier, version=None):
+        """
+        Returns a cached element
+
+        :param elem: Type of element
+        :param identifier: Element id
+        :param version: Version of the element, None for the last version
+        :return: Element, MISSING if it's known not to be on the database or None if it's not cached
+        """
+        key, entry = self.find(elem, identifier, version)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        if entry[0] is MISSING:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return entry[0]
+
+    def peek(self, elem, identifier, version=None):
+        """
+        Returns a cached element without updating the counters and the order
+
+        :param elem: Type of element
+        :param identifier: Element id
+        :param version: Version of the element, None for the last version
+        :return: Element, MISSING or None if it's not cached
+        """
+        entry = self.find(elem, identifier, version)[1]
+        if entry is None:
+            return None
+        return entry[0]
+
+    def put_version(self, elem, identifier, version, value):
+        """
+        Caches a version of an element that has been written or read, it's
+        cached once as the last version unless a later version is cached
+
+        :param elem: Type of element
+        :param identifier: Element id
+        :param version: Version of the element
+        :param value: Element
+        :return: None
+        """
+        latest = self.entries.get((elem, identifier, None))
+        latest_version = None
+        if latest is not None and latest[0] is not MISSING:
+            latest_version = latest[0]["data"]["version"] if latest[2] is None else latest[2]
+        if latest_version is None or version is None or latest_version <= version:
+            self.remove((elem, identifier, version))
+            self.store((elem, identifier, None), value, version)
+        else:
+            self.put(elem, identifier, version, value)
+
+    def put(self, elem, identifier, version, value):
+        """
+        Caches an element
+
+        :param elem: Type of element
+        :param identifier: Element id
+        :param version: Version of the element, None for the last version
+        :param value: Element or MISSING if it isn't on the database
+        :return: None
+        """
+        self.store((elem, identifier, version), value, version)
+
+    def store(self, key, value, version):
+        """
+        Caches an entry and evicts the least recently used ones when the
+        cache is full
+
+        :param key: Type, id and version of the element
+        :type key: tuple
+        :param value: Element or MISSING
+        :param version: Version of the element
+        :return: None
+        """
+        if value is MISSING:
+            size = sys.getsizeof(key)
+        elif key[0] in self.sizes:
+            size = self.sizes[key[0]]
+        else:
+            size = estimate_size(key) + estimate_size(value)
+        self.remove(key)
+        self.entries[key] = (value, size, version)
+        self.size += size
+        while self.size > self.max_size and self.entries:
+            evicted = self.entries.popitem(last=False)[1]
+            self.size -= evicted[1]
+            self.evictions += 1
+
+    def remove(self, key):
+        """
+        Removes an entry if it's cached
+
+        :param key: Type, id and version of the element
+        :type key: tuple
+        :return: None
+        """
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous[1]
+
+    def clear(self):
+        """
+        Removes all the elements
+
+        :return: None
+        """
+        self.entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear_stats(self):
+        """
+        Resets the counters, used by the worker processes that inherit the
+        counters of the parent process
+
+        :return: None
+        """
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add_stats(self, stats):
+        """
+        Adds the counters of another cache, like the one of a worker process.
+        The items and the size are the ones of this cache
+
+        :param stats: Stats returned by get_stats
+        :type stats: dict
+        :return: None
+        """
+        self.hits += stats["hits"]
+        self.negative_hits += stats["negative_hits"]
+        self.misses += stats["misses"]
+        self.evictions += stats["evictions"]
+
+    def get_stats(self):
+        """
+        Returns the counters of the cache
+
+        :return: Hits, negative hits, misses, evictions, items and estimated size
+        :rtype: dict
+        """
+        return merge_stats([{
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "items": len(self.entries),
+            "size": self.size
+        }])
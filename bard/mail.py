@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+from time import sleep
+from timeit import default_timer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Maximum recipients of a batch message of Mailgun
+MAX_BATCH = 1000
+
+
+class MailError(IOError):
+    """
+    A message couldn't be delivered to Mailgun
+    """
+    pass
+
+
+class MailgunClient(object):
+    """
+    Sends messages with the Mailgun API on a pool of threads that share a
+    pooled HTTP session. The recipients are sent in batches with recipient
+    variables, so each recipient gets its own message and a message for
+    hundreds of recipients is a few requests. The failed requests are retried
+    with exponential backoff.
+    """
+
+    def __init__(self, domain, api_key, api_url=None, workers=4, retries=3, backoff=1.0, timeout=30,
+                 batch_size=MAX_BATCH):
+        """
+        Class constructor
+
+        :param domain: Mailgun domain
+        :type domain: str
+        :param api_key: Mailgun API key
+        :type api_key: str
+        :param api_url: URL of the messages endpoint, by default the one of the domain
+        :type api_url: str
+        :param workers: Concurrent requests
+        :type workers: int
+        :param retries: Retries of a failed request
+        :type retries: int
+        :param backoff: Seconds before the first retry, doubled on each retry
+        :type backoff: float
+        :param timeout: Seconds to wait for a response
+        :type timeout: float
+        :param batch_size: Recipients of each request
+        :type batch_size: int
+        """
+        if api_url is None:
+            api_url = 'https://api.mailgun.net/v3/{0}/messages'.format(domain)
+        self.domain = domain
+        self.api_key = api_key
+        self.api_url = api_url
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.batch_size = min(batch_size, MAX_BATCH)
+        self.session = None
+        self.executor = None
+        self.pending = []
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failed_requests = 0
+        self.sent = 0
+        self.seconds = 0.0
+
+    def get_session(self):
+        """
+        Returns the HTTP session, its pool has a connection for each worker
+
+        :return: Session
+        :rtype: requests.Session
+        """
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.auth = ("api", self.api_key)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+        return self.session
+
+    def get_executor(self):
+        """
+        Returns the pool of threads that send the requests
+
+        :return: Executor
+        :rtype: ThreadPoolExecutor
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def batches(self, recipients):
+        """
+        Splits the recipients in batches
+
+        :param recipients: Addresses or recipient variables by address
+        :return: Generator of dicts of recipient variables by address
+        """
+        if not isinstance(recipients, dict):
+            recipients = dict((address, {}) for address in recipients)
+        addresses = list(recipients)
+        for pos in range(0, len(addresses), self.batch_size):
+            yield dict((address, recipients[address]) for address in addresses[pos:pos + self.batch_size])
+
+    def post(self, data):
+        """
+        Posts a message, the connection errors, the rate limit and the
+        server errors are retried
+
+        :param data: Form fields of the message
+        :type data: dict
+        :return: Response
+        :rtype: requests.Response
+        """
+        attempt = 0
+        while True:
+            start = default_timer()
+            error = None
+            try:
+                response = self.get_session().post(self.api_url, data=data, timeout=self.timeout)
+                if response.status_code == 429 or response.status_code >= 500:
+                    error = "Mailgun returned {}".format(response.status_code)
+                elif response.status_code >= 400:
+                    raise MailError("Mailgun rejected the message with {}: {}".format(
+                        response.status_code, response.text))
+            except requests.RequestException as e:
+                error = str(e)
+            finally:
+                with self.lock:
+                    self.requests += 1
+                    self.seconds += default_timer() - start
+            if error is None:
+                return response
+            with self.lock:
+                self.failed_requests += 1
+            if attempt >= self.retries:
+                raise MailError(error)
+            sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def send_batch(self, data, recipients):
+        """
+        Sends a message to a batch of recipients with a single request. The
+        recipient variables make Mailgun send a separate message to each
+        address, so the recipients don't see each other. A batch has at most
+        batch_size recipients, the limit of Mailgun is MAX_BATCH
+
+        :param data: Form fields of the message without the recipients
+        :type data: dict
+        :param recipients: Recipient variables by address, see batches
+        :type recipients: dict
+        :return: Response
+        :rtype: requests.Response
+        """
+        response = self.post(dict(data, **{
+            "to": list(recipients),
+            "recipient-variables": json.dumps(recipients)
+        }))
+        with self.lock:
+            self.sent += len(recipients)
+        return response
+
+    def send(self, subject, text, html, recipients, sender=None):
+        """
+        Queues a message, it's sent in the background
+
+        :param subject: Subject, it can use the recipient variables like %recipient.name%
+        :type subject: str
+        :param text: Text version
+        :type text: str
+        :param html: HTML version
+        :type html: str
+        :param recipients: Addresses or recipient variables by address
+        :param sender: Sender, by default OSM Changes at the domain
+        :type sender: str
+        :return: Futures of the requests
+        :rtype: list
+        """
+        if sender is None:
+            sender = "OSM Changes <mailgun@{}>".format(self.domain)
+        data = {"from": sender, "subject": subject, "text": text, "html": html}
+        futures = [
+            self.get_executor().submit(self.send_batch, data, batch)
+            for batch in self.batches(recipients)
+        ]
+        self.pending.extend(futures)
+        return futures
+
+    def wait(self):
+        """
+        Waits until the queued messages are sent
+
+        :return: Responses of the requests
+        :rtype: list
+        """
+        pending, self.pending = self.pending, []
+        return [future.result() for future in pending]
+
+    def get_stats(self):
+        """
+        Returns the counters of the client
+
+        :return: Requests, failed requests, recipients sent and seconds of the requests
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "failed_requests": self.failed_requests,
+                "sent": self.sent,
+                "seconds": self.seconds
+            }
+
+    def close(self):
+        """
+        Waits for the queued messages and releases the threads and the connections
+
+        :return: None
+        """
+        try:
+            self.wait()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+            if self.session is not None:
+                self.session.close()
+                self.session = None
@@ -0,0 +1,205 @@
+import re
+
+REGEX_CHARS = set(".^$*+?{}[]\\|()")
+
+
+class Pattern(object):
+    """
+    Key or value expression of the watched tags. Expressions without regular
+    expression characters are matched as literal prefixes, like re.match does
+    """
+
+    def __init__(self, expression):
+        """
+        Class constructor
+
+        :param expression: Regular expression
+        :type expression: str
+        """
+        self.expression = expression
+        self.literal = not REGEX_CHARS.intersection(expression)
+        if self.literal:
+            self.regex = None
+        else:
+            self.regex = re.compile(expression)
+
+    def match(self, text) -> bool:
+        """
+        Checks if the text matches the pattern
+
+        :param text: Text to check
+        :return: True if it matches
+        """
+        if self.literal:
+            return text.startswith(self.expression)
+        return self.regex.match(text) is not None
+
+
+class KeyMatcher(object):
+    """
+    Finds the key patterns that match a key, literal patterns are looked up
+    by prefix and the regular expressions are checked with a single combined
+    expression before checking them one by one
+    """
+
+    def __init__(self, patterns):
+        """
+        Class constructor
+
+        :param patterns: Key patterns
+        :type patterns: list of Pattern
+        """
+        self.literals = {}
+        self.regexes = []
+        for pattern in patterns:
+            if pattern.literal:
+                self.literals[pattern.expression] = pattern
+            else:
+                self.regexes.append(pattern)
+        self.lengths = sorted(set(len(literal) for literal in self.literals))
+        self.combined = None
+        self.combinable = []
+        self.always_check = self.regexes
+        combinable = [pattern for pattern in self.regexes if pattern.regex.groups == 0]
+        if len(combinable) > 1:
+            try:
+                self.combined = re.compile(
+                    "|".join("(?:{})".format(pattern.expression) for pattern in combinable))
+                self.combinable = combinable
+                self.always_check = [pattern for pattern in self.regexes if pattern.regex.groups > 0]
+            except re.error:
+                self.combined = None
+
+    def match(self, key) -> list:
+        """
+        Returns the patterns that match the key
+
+        :param key: Key of the tag
+        :return: Matching patterns
+        """
+        patterns = []
+        for length in self.lengths:
+            if length > len(key):
+                break
+            pattern = self.literals.get(key[:length])
+            if pattern is not None:
+                patterns.append(pattern)
+        if self.combined is not None and self.combined.match(key):
+            for pattern in self.combinable:
+                if pattern.regex.match(key):
+                    patterns.append(pattern)
+        for pattern in self.always_check:
+            if pattern.regex.match(key):
+                patterns.append(pattern)
+        return patterns
+
+
+class CompiledTags(object):
+    """
+    Watched tags of an element type compiled into rules, each rule is a
+    distinct key and value expression shared by one or more watched tags
+    """
+
+    def __init__(self, watches):
+        """
+        Class constructor
+
+        :param watches: Key and value expressions by watched tag name
+        :type watches: dict
+        """
+        keys = {}
+        values = {}
+        self.rules = {}
+        self.rule_names = {}
+        self.name_rule = {}
+        for name, (key, value) in watches.items():
+            if key not in keys:
+                keys[key] = Pattern(key)
+            if value not in values:
+                values[value] = Pattern(value)
+            rule = (key, value)
+            if rule not in self.rule_names:
+                self.rule_names[rule] = set()
+                self.rules.setdefault(keys[key], []).append((values[value], rule))
+            self.rule_names[rule].add(name)
+            self.name_rule[name] = rule
+        self.keys = KeyMatcher(list(keys.values()))
+
+    def match_rules(self, tags) -> set:
+        """
+        Returns the rules matched by the tags in a single pass
+
+        :param tags: Tags of the element
+        :return: Matched rules
+        """
+        matched = set()
+        total = len(self.rule_names)
+        for tag in tags:
+            for key_pattern in self.keys.match(tag.k):
+                for value_pattern, rule in self.rules[key_pattern]:
+                    if rule not in matched and value_pattern.match(tag.v):
+                        matched.add(rule)
+            if len(matched) == total:
+                break
+        return matched
+
+
+class TagMatcher(object):
+    """
+    Matches the tags of the elements against all the watched tags at once
+    """
+
+    def __init__(self):
+        """
+        Class constructor
+        """
+        self.watches = {}
+        self.compiled = {}
+
+    def add(self, name, key, value, element_types):
+        """
+        Adds or replaces a watched tag
+
+        :param name: Name of the tags
+        :param key: Key expression
+        :param value: Value expression
+        :param element_types: List of element types
+        :return: None
+        """
+        self.watches[name] = (key, value, list(element_types))
+        self.compiled = {}
+
+    def compile(self, elem) -> CompiledTags:
+        """
+        Returns the compiled watched tags of an element type
+
+        :param elem: Type of element
+        :return: Compiled tags
+        """
+        if elem not in self.compiled:
+            self.compiled[elem] = CompiledTags(dict(
+                (name, (key, value))
+                for name, (key, value, types) in self.watches.items()
+                if elem in types
+            ))
+        return self.compiled[elem]
+
+    def match(self, tags, elem, candidates=None) -> set:
+        """
+        Returns the names of the watched tags that match the tags of the element
+
+        :param tags: Tags of the element, iterable of objects with k and v
+        :param elem: Type of element
+        :param candidates: Names of the watched tags to consider, if not set all are considered
+        :return: Names of the matching watched tags
+        """
+        compiled = self.compile(elem)
+        if not compiled.rule_names:
+            return set()
+        rules = compiled.match_rules(tags)
+        if candidates is None:
+            names = set()
+            for rule in rules:
+                names.update(compiled.rule_names[rule])
+            return names
+        return set(name for name in candidates if compiled.name_rule.get(name) in rules)
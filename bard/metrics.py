@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+import functools
+import os
+from timeit import default_timer
+
+
+def timed(stage):
+    """
+    Decorator that adds the time of each call of a method to a stage of the
+    metrics of its object
+
+    :param stage: Name of the stage
+    :type stage: str
+    :return: Decorator
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = default_timer()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.add_time(stage, default_timer() - start)
+        return wrapper
+    return decorator
+
+
+class Metrics(object):
+    """
+    Wall time and calls of the stages of a run and its counters
+    """
+
+    def __init__(self):
+        """
+        Class constructor
+        """
+        self.stages = {}
+        self.counters = {}
+
+    def add_time(self, stage, seconds, calls=1):
+        """
+        Adds time to a stage
+
+        :param stage: Name of the stage
+        :type stage: str
+        :param seconds: Wall time
+        :type seconds: float
+        :param calls: Calls of the stage
+        :type calls: int
+        :return: None
+        """
+        times = self.stages.get(stage)
+        if times is None:
+            self.stages[stage] = [seconds, calls]
+        else:
+            times[0] += seconds
+            times[1] += calls
+
+    @contextmanager
+    def stage(self, stage):
+        """
+        Context manager that adds its wall time to a stage
+
+        :param stage: Name of the stage
+        :type stage: str
+        """
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add_time(stage, default_timer() - start)
+
+    def count(self, name, value=1):
+        """
+        Increments a counter
+
+        :param name: Name of the counter
+        :type name: str
+        :param value: Increment
+        :type value: int
+        :return: None
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, metrics):
+        """
+        Adds the stages and counters of other metrics
+
+        :param metrics: Metrics returned by to_dict
+        :type metrics: dict
+        :return: None
+        """
+        for stage, times in metrics["stages"].items():
+            self.add_time(stage, times["seconds"], times["calls"])
+        for name, value in metrics["counters"].items():
+            self.count(name, value)
+
+    def clear(self):
+        """
+        Resets the stages and the counters
+
+        :return: None
+        """
+        self.stages = {}
+        self.counters = {}
+
+    def to_dict(self):
+        """
+        Returns the metrics as a dict, used to store them as JSON
+
+        :return: Seconds and calls by stage and counters
+        :rtype: dict
+        """
+        return {
+            "stages": dict(
+                (stage, {"seconds": seconds, "calls": calls})
+                for stage, (seconds, calls) in self.stages.items()),
+            "counters": dict(self.counters)
+        }
+
+
+def prometheus_text(metrics, prefix="bard"):
+    """
+    Formats the metrics of a run in the text format of Prometheus
+
+    :param metrics: Metrics returned by Bard.get_metrics
+    :type metrics: dict
+    :param prefix: Prefix of the metric names
+    :type prefix: str
+    :return: Metrics in the text exposition format
+    :rtype: str
+    """
+    lines = [
+        "# HELP {}_stage_seconds_total Wall time of each stage of the processing".format(prefix),
+        "# TYPE {}_stage_seconds_total counter".format(prefix),
+    ]
+    for stage, times in sorted(metrics["stages"].items()):
+        lines.append('{}_stage_seconds_total{{stage="{}"}} {}'.format(prefix, stage, times["seconds"]))
+    lines.append("# TYPE {}_stage_calls_total counter".format(prefix))
+    for stage, times in sorted(metrics["stages"].items()):
+        lines.append('{}_stage_calls_total{{stage="{}"}} {}'.format(prefix, stage, times["calls"]))
+    for name, value in sorted(metrics["counters"].items()):
+        lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+        lines.append("{}_{}_total {}".format(prefix, name, value))
+    gauges = [("elements_per_second", metrics.get("elements_per_second"))]
+    for name in ("history", "cache"):
+        if metrics.get(name) is not None:
+            gauges.append(("{}_hit_rate".format(name), metrics[name]["hit_rate"]))
+    for name, value in gauges:
+        if value is not None:
+            lines.append("# TYPE {}_{} gauge".format(prefix, name))
+            lines.append("{}_{} {}".format(prefix, name, value))
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(filename, metrics, prefix="bard"):
+    """
+    Writes the metrics of a run on a file for the textfile collector of the
+    Prometheus node exporter, the file is replaced atomically
+
+    :param filename: Path of the file, it must end with .prom
+    :type filename: str
+    :param metrics: Metrics returned by Bard.get_metrics
+    :type metrics: dict
+    :param prefix: Prefix of the metric names
+    :type prefix: str
+    :return: None
+    """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(prometheus_text(metrics, prefix))
+    os.replace(tmp_filename, filename)
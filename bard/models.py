@@ -7,8 +7,8 @@ db = Database()
 
 class Cache_Node(db.Entity):
     id = PrimaryKey(int, auto=True)
-    osm_id = Required(int, sql_type="BIGINT", index=True)
-    version = Optional(int, index=True)
+    osm_id = Required(int, sql_type="BIGINT")
+    version = Optional(int)
     tag = Optional(Json)
     geom = Optional(Point, srid=4326)
 
@@ -20,6 +20,29 @@ class Cache_Way(db.Entity):
     geom = Optional(Line, srid=4326)
 
 
+# Indexes of the cache tables, the versions of an element are read from the
+# latest, the rows without version last, and the geometries are filtered by
+# bounding box
+CACHE_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_cache_node_osm_id_latest ON cache_node (osm_id, version DESC NULLS LAST)",
+    "CREATE INDEX IF NOT EXISTS idx_cache_way_osm_id_latest ON cache_way (osm_id, version DESC NULLS LAST)",
+    "CREATE INDEX IF NOT EXISTS idx_cache_node_geom ON cache_node USING GIST (geom)",
+    "CREATE INDEX IF NOT EXISTS idx_cache_way_geom ON cache_way USING GIST (geom)",
+    # Replaced by the composite indexes
+    "DROP INDEX IF EXISTS idx_cache_node__osm_id",
+    "DROP INDEX IF EXISTS idx_cache_node__version",
+    "DROP INDEX IF EXISTS idx_cache_node_osm_id_version",
+    "DROP INDEX IF EXISTS idx_cache_way_osm_id_version",
+]
+
+# Columns added to the tables of the existing databases, as table, column and
+# type. They are checked on information_schema, ADD COLUMN IF NOT EXISTS
+# needs PostgreSQL 9.6
+SCHEMA_UPDATES = [
+    ("usertags", "geojson", "TEXT"),
+]
+
+
 class BardUser(db.Entity):
     id = PrimaryKey(int,auto=True)
     login = Required(str, unique=True)
@@ -35,6 +58,7 @@ class UserTags(db.Entity):
     way = Required(bool)
     relation = Required(bool)
     bbox = Required(str)
+    geojson = Optional(str, nullable=True)
     user = Required(BardUser)
     states = Set('ResultTags')
 
@@ -1,8 +1,91 @@
-from tempfile import mkstemp
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from tempfile import mkdtemp
+import multiprocessing
+import os
+import shutil
 import sys
+import zlib
 
 import requests
 
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_state(text)-> dict:
+    """
+    Parses a state file of the replication system
+
+    :param text: Content of the state file
+    :type text: str
+    :return: Values of the state
+    """
+    ret_val = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            key, value = line.split("=", 1)
+            ret_val[key] = value.replace("\\:", ":")
+    return ret_val
+
+
+def parse_timestamp(value)-> datetime:
+    """
+    Parses a timestamp of the state files of the replication system
+
+    :param value: Timestamp, like 2017-05-31T16:25:02Z
+    :type value: str
+    :return: Time in UTC
+    """
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+
+
+class SequenceState(object):
+    """
+    Last processed sequence of the replication system, persisted on a file
+    with the format of the state files of the replication system
+    """
+
+    def __init__(self, filename):
+        """
+        Class constructor
+
+        :param filename: Path of the state file
+        :type filename: str
+        """
+        self.filename = filename
+
+    def load(self):
+        """
+        Reads the last processed sequence
+
+        :return: Sequence number or None if no sequence has been processed
+        :rtype: int
+        """
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename) as f:
+            state = parse_state(f.read())
+        if "sequenceNumber" not in state:
+            return None
+        return int(state["sequenceNumber"])
+
+    def save(self, sequence, timestamp=None):
+        """
+        Stores the last processed sequence, the file is replaced atomically
+
+        :param sequence: Sequence number
+        :type sequence: int
+        :param timestamp: Timestamp of the sequence
+        :type timestamp: str
+        :return: None
+        """
+        tmp_filename = "{}.tmp".format(self.filename)
+        with open(tmp_filename, "w") as f:
+            if timestamp:
+                f.write("timestamp={}\n".format(timestamp.replace(":", "\\:")))
+            f.write("sequenceNumber={}\n".format(sequence))
+        os.replace(tmp_filename, self.filename)
+
 
 class OSC(object):
     """
@@ -19,8 +102,15 @@ class OSC(object):
         3: "day"
     }
 
-    def __init__(self):
+    def __init__(self, base_url="http://planet.openstreetmap.org/replication"):
+        """
+        Class constructor
+
+        :param base_url: URL of the replication system
+        :type base_url: str
+        """
         self._periodicty = self.HOURLY
+        self.base_url = base_url
 
     @property
     def periodicty(self):
@@ -40,50 +130,184 @@ class OSC(object):
         """
         self._periodicty = value
 
-    def get_state(self)-> dict:
+    def get_url(self, path):
+        """
+        Returns the URL of a file of the replication system
+
+        :param path: Path of the file inside the periodicity directory
+        :type path: str
+        :return: URL
+        :rtype: str
+        """
+        return '{}/{}/{}'.format(self.base_url, self.replication_name[self._periodicty], path)
+
+    @staticmethod
+    def sequence_path(sequence)-> str:
+        """
+        Returns the path of a sequence, like 002/345/678
+
+        :param sequence: Sequence number
+        :type sequence: int
+        :return: Path without extension
+        """
+        state = '{:09d}'.format(int(sequence))
+        return '{0}/{1}/{2}'.format(state[-9:-6], state[-6:-3], state[-3:])
+
+    def get_state(self, sequence=None)-> dict:
         """
         Downloads the state from OSM replication system
 
+        :param sequence: Sequence number, if not set the actual state is downloaded
+        :type sequence: int
         :return: Actual state
         :rtype: dict
         """
-        url = 'http://planet.openstreetmap.org/replication/{}/state.txt'.format(
-                self.replication_name[self._periodicty])
+        if sequence is None:
+            url = self.get_url('state.txt')
+        else:
+            url = self.get_url('{}.state.txt'.format(self.sequence_path(sequence)))
         r = requests.get(url)
-        ret_val = {}
-        for line in r.text.splitlines():
-            if line and not line.startswith("#"):
-                ret_val[line.split("=")[0]] = line.split("=")[1]
-        return ret_val
+        r.raise_for_status()
+        return parse_state(r.text)
 
-    def get_last(self):
+    def get_sequence(self)-> int:
         """
-        Method that dowload the last osc file
+        Returns the number of the last published sequence
 
-        :return: None
+        :return: Sequence number
+        """
+        return int(self.get_state()["sequenceNumber"])
+
+    def get_timestamp(self, sequence)-> datetime:
+        """
+        Returns the time of a sequence, the changes of a change file are
+        made between the time of the previous sequence and its time
+
+        :param sequence: Sequence number
+        :type sequence: int
+        :return: Time in UTC
+        """
+        return parse_timestamp(self.get_state(sequence)["timestamp"])
+
+    def get_diff_url(self, sequence=None)-> str:
+        """
+        Returns the URL of the compressed change file of a sequence
+
+        :param sequence: Sequence number, if not set the last sequence is used
+        :type sequence: int
+        :return: URL of the .osc.gz file
+        """
+        if sequence is None:
+            sequence = self.get_sequence()
+        return self.get_url('{}.osc.gz'.format(self.sequence_path(sequence)))
+
+    def stream(self, sequence=None):
+        """
+        Streams the compressed change file of a sequence
+
+        :param sequence: Sequence number, if not set the last sequence is used
+        :type sequence: int
+        :return: Stream that decompresses the file while it is downloaded
+        :rtype: DiffStream
+        """
+        return DiffStream(self.get_diff_url(sequence))
+
+
+class DiffStream(object):
+    """
+    Change file downloaded in chunks. The HTTP status and the end of the
+    compressed data are checked, so a failed or truncated download raises
+    IOError instead of processing part of the file.
+    """
+
+    def __init__(self, url, chunk_size=CHUNK_SIZE):
+        """
+        Class constructor
+
+        :param url: URL of the compressed change file
+        :type url: str
+        :param chunk_size: Size of the downloaded chunks
+        :type chunk_size: int
+        """
+        self.url = url
+        self.chunk_size = chunk_size
+
+    def iter_content(self):
+        """
+        Downloads the change file and decompresses it while it is downloaded
+
+        :return: Generator of the compressed chunks and their decompressed content
         """
+        sys.stderr.write('downloading {0}...\n'.format(self.url))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        with requests.get(self.url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(self.chunk_size):
+                yield chunk, decompressor.decompress(chunk)
+        yield b"", decompressor.flush()
+        if not decompressor.eof:
+            raise IOError("Download of {} is truncated".format(self.url))
 
-        state = self.get_state()
+    def read(self)-> bytes:
+        """
+        Downloads the compressed change file, for the files parsed more than
+        once. Only the compressed content is kept in memory.
 
-        # zero-pad state so it can be safely split.
-        state = '000000000' + state["sequenceNumber"]
-        path = '{0}/{1}/{2}'.format(state[-9:-6], state[-6:-3], state[-3:])
-        stateurl = 'http://planet.openstreetmap.org/replication/{}/{}.osc.gz'.format(
-            self.replication_name[self._periodicty],
-            path
-        )
+        :return: Content of the .osc.gz file, to parse with the "osc.gz" format
+        """
+        return b"".join(chunk for chunk, data in self.iter_content())
 
-        sys.stderr.write('downloading {0}...\n'.format(stateurl))
-        # prepare a local file to store changes
-        handle, filename = mkstemp(prefix='change-', suffix='.osc.gz')
-        os.close(handle)
+    def write(self, filename, connection):
+        """
+        Writes the decompressed content on a pipe while it is downloaded, the
+        download stops if the reader closes the pipe
 
-        with open(filename, "w") as f:
-            resp = requests.get(stateurl)
-            f.write(resp.content)
-        sys.stderr.write('Done\n')
-        # sys.stderr.write('extracting {0}...\n'.format(filename))
-        # os.system('gunzip -f {0}'.format(filename))
+        :param filename: Path of the pipe
+        :type filename: str
+        :param connection: Connection where the error of the download, or None, is sent
+        :type connection: multiprocessing.connection.Connection
+        :return: None
+        """
+        error = None
+        try:
+            with open(filename, "wb") as f:
+                for chunk, data in self.iter_content():
+                    f.write(data)
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            error = str(e) or repr(e)
+        connection.send(error)
+        connection.close()
+
+    @contextmanager
+    def open(self):
+        """
+        Streams the change file through a named pipe, osmium parses it while
+        a forked process downloads and decompresses it, so the memory doesn't
+        grow with the size of the file. A thread can't write the pipe because
+        osmium keeps the GIL while it parses. The pipe can be read only once.
 
-        # knock off the ".gz" suffix and return
-        return filename
\ No newline at end of file
+        :return: Context manager that gives the path of the .osc pipe
+        """
+        directory = mkdtemp(prefix="diff-")
+        filename = os.path.join(directory, "diff.osc")
+        os.mkfifo(filename)
+        receiver, sender = multiprocessing.Pipe(False)
+        process = multiprocessing.get_context("fork").Process(target=self.write, args=(filename, sender))
+        process.daemon = True
+        process.start()
+        sender.close()
+        try:
+            yield filename
+        finally:
+            # Unblocks the writer when the reader stopped before the end or never opened the pipe
+            while process.is_alive():
+                fd = os.open(filename, os.O_RDONLY | os.O_NONBLOCK)
+                process.join(0.1)
+                os.close(fd)
+            error = receiver.recv() if receiver.poll() else "Download of {} failed".format(self.url)
+            receiver.close()
+            shutil.rmtree(directory)
+            if error is not None:
+                raise IOError(error)
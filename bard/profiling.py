@@ -0,0 +1,121 @@
+import cProfile
+import inspect
+import os
+import pstats
+
+# Modules of the database calls
+DB_MODULES = ("psycopg2", "sqlite3", os.sep + "pony" + os.sep, os.path.join("bard", "writer.py"))
+
+
+def function_keys(cls):
+    """
+    Returns the pstats keys of the methods of a class, the decorated methods
+    are unwrapped
+
+    :param cls: Class
+    :return: File, line and function name of each method
+    :rtype: set
+    """
+    keys = set()
+    for member in vars(cls).values():
+        if inspect.isfunction(member):
+            code = inspect.unwrap(member).__code__
+            keys.add((code.co_filename, code.co_firstlineno, code.co_name))
+    return keys
+
+
+def function_name(key):
+    """
+    Returns a readable name of a pstats key
+
+    :param key: File, line and function name
+    :type key: tuple
+    :return: Name as module file:line(function)
+    :rtype: str
+    """
+    filename, line, name = key
+    if filename == "~":
+        return name
+    return "{}:{}({})".format(os.path.basename(filename), line, name)
+
+
+class RunProfiler(object):
+    """
+    Profiles a run with cProfile, the statistics are saved in the pstats
+    format, that can be read by pstats, snakeviz or converted to a flame
+    graph by flameprof
+    """
+
+    def __init__(self, filename, top=20):
+        """
+        Class constructor
+
+        :param filename: File where the statistics are saved
+        :type filename: str
+        :param top: Functions of each group of the summary
+        :type top: int
+        """
+        self.filename = filename
+        self.top = top
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.disable()
+        self.profile.dump_stats(self.filename)
+
+    def summary(self, handler_class):
+        """
+        Returns the hottest methods of the handler and the OSM API and
+        database calls, sorted by cumulative time
+
+        :param handler_class: Class of the handler
+        :return: Calls, own time and cumulative time of the functions of the handler, osmapi and database groups
+        :rtype: dict
+        """
+        stats = pstats.Stats(self.filename).stats
+        handler_keys = function_keys(handler_class)
+        groups = {"handler": [], "osmapi": [], "database": []}
+        for key, (primitive_calls, calls, total, cumulative, callers) in stats.items():
+            filename, line, name = key
+            if key in handler_keys:
+                group = "handler"
+            elif os.sep + "osmapi" + os.sep in filename:
+                group = "osmapi"
+            elif any(module in filename or module in name for module in DB_MODULES):
+                group = "database"
+            else:
+                continue
+            groups[group].append({
+                "function": function_name(key),
+                "calls": calls,
+                "total": total,
+                "cumulative": cumulative
+            })
+        for group in groups:
+            groups[group].sort(key=lambda function: function["cumulative"], reverse=True)
+            del groups[group][self.top:]
+        return groups
+
+    def format_summary(self, handler_class):
+        """
+        Returns the summary as text
+
+        :param handler_class: Class of the handler
+        :return: Table of each group
+        :rtype: str
+        """
+        lines = []
+        summary = self.summary(handler_class)
+        for group in ("handler", "osmapi", "database"):
+            functions = summary[group]
+            lines.append("{} (top {})".format(group, self.top))
+            lines.append("{:>10} {:>10} {:>10}  {}".format("calls", "tottime", "cumtime", "function"))
+            for function in functions:
+                lines.append("{:>10} {:>10.3f} {:>10.3f}  {}".format(
+                    function["calls"], function["total"], function["cumulative"], function["function"]))
+            lines.append("")
+        return "\n".join(lines)
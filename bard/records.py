@@ -0,0 +1,152 @@
+from array import array
+
+# Keys of the ids of each type of element
+IDS_KEYS = ("nids", "wids", "rids")
+# Attributes of the records
+FIELDS = ("changeset", "user", "uid", "tag_id")
+
+
+class ChangesetRecord(object):
+    """
+    Changes of a changeset, the ids of the changed elements are stored on
+    an int64 array with a parallel array of the column of each id, a column
+    is a type of element and a watched tag. The record can be read like the
+    dict that it replaces.
+    """
+
+    __slots__ = ("changeset", "user", "uid", "tag_id", "columns", "column_ids", "ids")
+
+    def __init__(self, changeset, user, uid, tag_id=None):
+        """
+        Class constructor
+
+        :param changeset: Changeset id
+        :type changeset: int
+        :param user: User name
+        :type user: str
+        :param uid: User id
+        :type uid: int
+        :param tag_id: Id of the user tags
+        :type tag_id: int
+        """
+        self.changeset = changeset
+        self.user = user
+        self.uid = uid
+        self.tag_id = tag_id
+        self.columns = []
+        self.column_ids = array("H")
+        self.ids = array("q")
+
+    def add(self, ids_key, tag_name, identifier):
+        """
+        Adds a changed element
+
+        :param ids_key: Type of the ids (nids, wids or rids)
+        :type ids_key: str
+        :param tag_name: Name of the watched tag
+        :type tag_name: str
+        :param identifier: Element id
+        :type identifier: int
+        :return: None
+        """
+        column = (ids_key, tag_name)
+        try:
+            column_id = self.columns.index(column)
+        except ValueError:
+            column_id = len(self.columns)
+            self.columns.append(column)
+        self.column_ids.append(column_id)
+        self.ids.append(identifier)
+
+    def get_ids(self, ids_key):
+        """
+        Returns the ids of a type of element as lists by watched tag
+
+        :param ids_key: Type of the ids (nids, wids or rids)
+        :type ids_key: str
+        :return: Ids by watched tag
+        :rtype: dict
+        """
+        ids = {}
+        for column_id, (column_key, tag_name) in enumerate(self.columns):
+            if column_key == ids_key:
+                ids[tag_name] = []
+        if ids:
+            columns = self.columns
+            for column_id, identifier in zip(self.column_ids, self.ids):
+                column_key, tag_name = columns[column_id]
+                if column_key == ids_key:
+                    ids[tag_name].append(identifier)
+        return ids
+
+    def tag_names(self):
+        """
+        Returns the watched tags with changes on the changeset
+
+        :return: Names of the watched tags
+        :rtype: set
+        """
+        return set(tag_name for ids_key, tag_name in self.columns)
+
+    def activity(self):
+        """
+        Returns the number of changes of the changeset
+
+        :return: Changed elements by watched tag
+        :rtype: int
+        """
+        return len(self.ids)
+
+    def fingerprint(self):
+        """
+        Returns a hash of the user and the changes of the record, it changes
+        when a change is added
+
+        :return: Hash of the content
+        :rtype: int
+        """
+        return hash((self.user, tuple(self.columns), self.column_ids.tobytes(), self.ids.tobytes()))
+
+    def to_dict(self):
+        """
+        Returns the record as a dict, used to store it as JSON
+
+        :return: Changeset, user, uid, ids and user tags id
+        :rtype: dict
+        """
+        return {
+            "changeset": self.changeset,
+            "user": self.user,
+            "uid": self.uid,
+            "nids": self.get_ids("nids"),
+            "wids": self.get_ids("wids"),
+            "rids": self.get_ids("rids"),
+            "tag_id": self.tag_id
+        }
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, key):
+        if key in IDS_KEYS:
+            return self.get_ids(key)
+        if key in FIELDS:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in FIELDS or key in IDS_KEYS
+
+    def __eq__(self, other):
+        if isinstance(other, ChangesetRecord):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.to_dict())
@@ -0,0 +1,112 @@
+import gettext
+import hashlib
+import os
+import threading
+
+from jinja2 import Environment
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "templates")
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "locales")
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(locales_dir=LOCALES_DIR, templates_dir=TEMPLATES_DIR):
+    """
+    Returns the registry of the templates of a locales directory, the
+    registries are shared by all the Bard instances of the process
+
+    :param locales_dir: Directory of the compiled translations
+    :type locales_dir: str
+    :param templates_dir: Directory of the templates
+    :type templates_dir: str
+    :return: Registry
+    :rtype: TemplateRegistry
+    """
+    key = (os.path.realpath(locales_dir), os.path.realpath(templates_dir))
+    with _registries_lock:
+        registry = _registries.get(key)
+        if registry is None:
+            registry = _registries[key] = TemplateRegistry(locales_dir, templates_dir)
+        return registry
+
+
+class TemplateRegistry(object):
+    """
+    Templates compiled once for each language. Each language has its own
+    Jinja environment with its translations, nothing is installed globally,
+    so reports of several languages can be rendered at the same time
+    """
+
+    def __init__(self, locales_dir=LOCALES_DIR, templates_dir=TEMPLATES_DIR):
+        """
+        Class constructor
+
+        :param locales_dir: Directory of the compiled translations
+        :type locales_dir: str
+        :param templates_dir: Directory of the templates
+        :type templates_dir: str
+        """
+        self.locales_dir = locales_dir
+        self.templates_dir = templates_dir
+        self.environments = {}
+        self.templates = {}
+        self.sources = {}
+        self.lock = threading.RLock()
+
+    def get_environment(self, language):
+        """
+        Returns the Jinja environment of a language, the messages without
+        translation are taken from English
+
+        :param language: Language code
+        :type language: str
+        :return: Environment
+        :rtype: jinja2.Environment
+        """
+        with self.lock:
+            environment = self.environments.get(language)
+            if environment is None:
+                translations = gettext.translation(
+                    'messages', localedir=self.locales_dir, languages=[language, 'en'], fallback=True)
+                environment = Environment(extensions=['jinja2.ext.i18n'])
+                environment.install_gettext_translations(translations)
+                self.environments[language] = environment
+            return environment
+
+    def get_source(self, template_name):
+        """
+        Returns the source of a template and its hash, it's read once
+
+        :param template_name: File name of the template on the templates directory
+        :type template_name: str
+        :return: Source and SHA1 of the source
+        :rtype: tuple
+        """
+        with self.lock:
+            source = self.sources.get(template_name)
+            if source is None:
+                with open(os.path.join(self.templates_dir, template_name)) as f:
+                    text = f.read()
+                source = self.sources[template_name] = (text, hashlib.sha1(text.encode("utf-8")).hexdigest())
+            return source
+
+    def get_template(self, template_name, language="en"):
+        """
+        Returns a template compiled for a language
+
+        :param template_name: File name of the template on the templates directory
+        :type template_name: str
+        :param language: Language code
+        :type language: str
+        :return: Template and SHA1 of its source
+        :rtype: tuple
+        """
+        key = (template_name, language)
+        with self.lock:
+            template = self.templates.get(key)
+            if template is None:
+                text, digest = self.get_source(template_name)
+                template = self.templates[key] = (self.get_environment(language).from_string(text), digest)
+            return template
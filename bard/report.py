@@ -0,0 +1,126 @@
+import heapq
+import threading
+
+from .lru import ElementCache
+from .registry import get_registry
+
+# Layout and changeset fragment template of each kind of report
+TEMPLATES = {
+    "html": ("html_template.html", "html_changeset.html"),
+    "text": ("text_template.txt", "text_changeset.txt"),
+}
+
+
+def select_changesets(changesets, limit):
+    """
+    Selects the changesets with more changes, the selected ones keep the
+    order of the file
+
+    :param changesets: Changeset records by id
+    :type changesets: dict
+    :param limit: Maximum number of changesets
+    :type limit: int
+    :return: Selected records
+    :rtype: list
+    """
+    records = list(changesets.values())
+    if len(records) <= limit:
+        return records
+    positions = heapq.nlargest(
+        limit, range(len(records)), key=lambda position: (records[position].activity(), -position))
+    return [records[position] for position in sorted(positions)]
+
+
+class ReportRenderer(object):
+    """
+    Renders the reports streaming a fragment for each changeset. The rendered
+    fragments are cached by changeset, language and template, so the
+    changesets of repeated reports are rendered once
+    """
+
+    def __init__(self, registry=None, language="en", cache=None):
+        """
+        Class constructor
+
+        :param registry: Registry of the compiled templates, by default the shared one
+        :type registry: bard.registry.TemplateRegistry
+        :param language: Language of the report
+        :type language: str
+        :param cache: Cache of the rendered fragments
+        :type cache: bard.lru.ElementCache
+        """
+        if registry is None:
+            registry = get_registry()
+        self.language = language
+        if cache is None:
+            cache = ElementCache(16 * 1024 * 1024)
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.layouts = {}
+        self.fragment_templates = {}
+        self.hashes = {}
+        for kind, (layout, fragment) in TEMPLATES.items():
+            self.layouts[kind] = registry.get_template(layout, language)[0]
+            self.fragment_templates[kind], self.hashes[kind] = registry.get_template(fragment, language)
+
+    def fragment(self, kind, record, tags):
+        """
+        Returns the rendered fragment of a changeset
+
+        :param kind: Kind of report (html or text)
+        :type kind: str
+        :param record: Changes of the changeset
+        :type record: bard.records.ChangesetRecord
+        :param tags: Names of the watched tags
+        :type tags: list
+        :return: Rendered fragment
+        :rtype: str
+        """
+        key = (kind, self.language, self.hashes[kind], tuple(tags))
+        version = record.fingerprint()
+        with self.lock:
+            fragment = self.cache.get(key, record.changeset, version)
+        if fragment is None:
+            fragment = self.fragment_templates[kind].render(changeset=record, tags=tags)
+            with self.lock:
+                self.cache.put(key, record.changeset, version, fragment)
+        return fragment
+
+    def fragments(self, kind, records, tags):
+        """
+        Yields the rendered fragments of the changesets
+
+        :param kind: Kind of report (html or text)
+        :param records: Changes of the changesets
+        :param tags: Names of the watched tags
+        :return: Generator of rendered fragments
+        """
+        for record in records:
+            yield self.fragment(kind, record, tags)
+
+    def generate(self, kind, data):
+        """
+        Yields the report in chunks, the fragments are rendered while the
+        report is consumed
+
+        :param kind: Kind of report (html or text)
+        :type kind: str
+        :param data: Report data returned by Bard.generate_report_data
+        :type data: dict
+        :return: Generator of chunks of the report
+        """
+        fragments = self.fragments(kind, data["changesets"], data["tags"])
+        return self.layouts[kind].generate(fragments=fragments, **data)
+
+    def render(self, kind, data):
+        """
+        Renders a report
+
+        :param kind: Kind of report (html or text)
+        :type kind: str
+        :param data: Report data returned by Bard.generate_report_data
+        :type data: dict
+        :return: Report
+        :rtype: str
+        """
+        return "".join(self.generate(kind, data))
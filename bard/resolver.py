@@ -0,0 +1,204 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import threading
+
+import osmapi
+
+
+class MemberResolver(object):
+    """
+    Resolves the locations of the members of the relations. Members on the
+    cache are read first, the missing ones are downloaded in batches with the
+    multi id calls of the OSM API on a pool of concurrent clients
+    """
+
+    def __init__(self, cache=None, workers=4, batch_size=100, api_factory=osmapi.OsmApi):
+        """
+        Class constructor
+
+        :param cache: Database cache
+        :type cache: DbCache
+        :param workers: Concurrent API clients
+        :type workers: int
+        :param batch_size: Ids requested on each API call
+        :type batch_size: int
+        :param api_factory: Function that returns a new API client
+        """
+        self.cache = cache
+        self.workers = workers
+        self.batch_size = batch_size
+        self.api_factory = api_factory
+        self.local = threading.local()
+        self.executor = None
+        self.api_calls = 0
+        self.lock = threading.Lock()
+
+    def get_api(self):
+        """
+        Returns the API client of the current thread
+
+        :return: API client
+        :rtype: osmapi.OsmApi
+        """
+        if not hasattr(self.local, "api"):
+            self.local.api = self.api_factory()
+        return self.local.api
+
+    def get_executor(self):
+        """
+        Returns the pool of threads used to call the API
+
+        :return: Executor
+        :rtype: ThreadPoolExecutor
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self.executor
+
+    def call(self, method, ids):
+        """
+        Calls a multi id method of the API, if the call fails the ids are
+        split and requested again to skip the missing elements
+
+        :param method: Name of the method (NodesGet or WaysGet)
+        :param ids: Ids to request
+        :type ids: list
+        :return: Elements by id
+        :rtype: dict
+        """
+        with self.lock:
+            self.api_calls += 1
+        try:
+            return getattr(self.get_api(), method)(ids)
+        except osmapi.ApiError:
+            if len(ids) == 1:
+                return {}
+            half = len(ids) // 2
+            elements = self.call(method, ids[:half])
+            elements.update(self.call(method, ids[half:]))
+            return elements
+
+    def batches(self, ids):
+        """
+        Splits the ids in batches
+
+        :param ids: Ids
+        :type ids: list
+        :return: Generator of lists of ids
+        """
+        for pos in range(0, len(ids), self.batch_size):
+            yield ids[pos:pos + self.batch_size]
+
+    def cached_locations(self, members, missing_nodes, missing_ways):
+        """
+        Yields the locations of the members stored on the cache and collects
+        the ids of the missing ones
+
+        :param members: Type and id of the members
+        :type members: list
+        :param missing_nodes: Ids of the nodes not found on the cache
+        :type missing_nodes: list
+        :param missing_ways: Ids of the ways not found on the cache
+        :type missing_ways: list
+        :return: Generator of lat, lon tuples
+        """
+        for member_type, ref in members:
+            if member_type == "n":
+                node = None
+                if self.cache is not None:
+                    node = self.cache.get_node(ref)
+                if node is None:
+                    missing_nodes.append(ref)
+                else:
+                    yield node["data"]["lat"], node["data"]["lon"]
+            elif member_type == "w":
+                way = None
+                if self.cache is not None:
+                    way = self.cache.get_way(ref)
+                if way is None:
+                    missing_ways.append(ref)
+                else:
+                    for line in way["data"]["coordinates"] or []:
+                        for node in line:
+                            yield node[0], node[1]
+
+    def locations(self, members, cached=True):
+        """
+        Yields the locations of the members of a relation. The API calls are
+        cancelled when the caller stops consuming the locations
+
+        :param members: Type and id of the members
+        :type members: list
+        :param cached: False if the members are known to be missing on the cache
+        :type cached: bool
+        :return: Generator of lat, lon tuples
+        """
+        missing_nodes = []
+        missing_ways = []
+        if cached:
+            for location in self.cached_locations(members, missing_nodes, missing_ways):
+                yield location
+        else:
+            missing_nodes = [ref for member_type, ref in members if member_type == "n"]
+            missing_ways = [ref for member_type, ref in members if member_type == "w"]
+        if not missing_nodes and not missing_ways:
+            return
+
+        executor = self.get_executor()
+        pending = {}
+        for ids in self.batches(missing_nodes):
+            pending[executor.submit(self.call, "NodesGet", ids)] = "nodes"
+        for ids in self.batches(missing_ways):
+            pending[executor.submit(self.call, "WaysGet", ids)] = "ways"
+        ways = {}
+        way_nodes = {}
+        try:
+            while pending:
+                done = wait(list(pending), return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    kind = pending.pop(future)
+                    elements = future.result()
+                    if kind == "ways":
+                        node_ids = set()
+                        for way_id, way in elements.items():
+                            ways[way_id] = way
+                            node_ids.update(way.get("nd", []))
+                        for ids in self.batches(sorted(node_ids)):
+                            pending[executor.submit(self.call, "NodesGet", ids)] = "way_nodes"
+                        continue
+                    for node_id, node in elements.items():
+                        if node.get("lat") is None or node.get("lon") is None:
+                            continue
+                        if kind == "way_nodes":
+                            way_nodes[node_id] = (node["lat"], node["lon"])
+                        yield node["lat"], node["lon"]
+            self.cache_ways(ways, way_nodes)
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def cache_ways(self, ways, way_nodes):
+        """
+        Stores on the cache the downloaded ways with all its nodes
+
+        :param ways: Ways by id
+        :type ways: dict
+        :param way_nodes: Locations by node id
+        :type way_nodes: dict
+        :return: None
+        """
+        if self.cache is None:
+            return
+        for way_id, way in ways.items():
+            nodes = [way_nodes.get(node_id) for node_id in way.get("nd", [])]
+            if nodes and None not in nodes:
+                self.cache.add_way(way_id, way.get("version"), nodes, way.get("tag"))
+
+    def close(self):
+        """
+        Stops the pool of threads
+
+        :return: None
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -0,0 +1,251 @@
+from array import array
+import io
+import json
+import struct
+
+WKB_POINT = 1
+WKB_LINESTRING = 2
+WKB_SRID_FLAG = 0x20000000
+
+
+def ewkb_point(x, y, srid):
+    """
+    Returns the hex EWKB of a point
+
+    :param x: X coordinate
+    :param y: Y coordinate
+    :param srid: Spatial reference id
+    :return: Hex EWKB
+    :rtype: str
+    """
+    return struct.pack("<BIIdd", 1, WKB_POINT | WKB_SRID_FLAG, srid, x, y).hex()
+
+
+def ewkb_line(coordinates, srid):
+    """
+    Returns the hex EWKB of a linestring
+
+    :param coordinates: Flat sequence of x, y coordinates
+    :param srid: Spatial reference id
+    :return: Hex EWKB
+    :rtype: str
+    """
+    header = struct.pack("<BIII", 1, WKB_LINESTRING | WKB_SRID_FLAG, srid, len(coordinates) // 2)
+    return (header + struct.pack("<{}d".format(len(coordinates)), *coordinates)).hex()
+
+
+def copy_value(value):
+    """
+    Formats a value for the text format of COPY
+
+    :param value: Value to format
+    :return: Formatted value
+    :rtype: str
+    """
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\")
+
+
+class CacheWriter(object):
+    """
+    Buffers the nodes and ways of the cache in arrays and writes them with
+    COPY, the buffered elements can be read before they are written
+    """
+
+    def __init__(self, connect, srid=4326):
+        """
+        Class constructor
+
+        :param connect: Function that returns a new psycopg2 connection
+        :param srid: Spatial reference id of the geometries
+        :type srid: int
+        """
+        self.connect = connect
+        self.srid = srid
+        self.connection = None
+        self.clear()
+
+    def clear(self):
+        """
+        Empties the buffers
+
+        :return: None
+        """
+        self.node_ids = array("q")
+        self.node_versions = array("q")
+        self.node_coordinates = array("d")
+        self.node_tags = []
+        self.node_positions = {}
+        self.way_ids = array("q")
+        self.way_versions = array("q")
+        self.way_offsets = array("q", [0])
+        self.way_coordinates = array("d")
+        self.way_tags = []
+        self.way_positions = {}
+
+    @property
+    def pending_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def pending_ways(self):
+        return len(self.way_ids)
+
+    def add_node(self, identifier, version, x, y, tags):
+        """
+        Buffers a node
+
+        :param identifier: Node id
+        :param version: Node version
+        :param x: X coordinate
+        :param y: Y coordinate
+        :param tags: Tags of the node or None
+        :return: None
+        """
+        self.node_positions.setdefault(identifier, {})[version] = len(self.node_ids)
+        self.node_ids.append(identifier)
+        self.node_versions.append(version)
+        self.node_coordinates.append(x)
+        self.node_coordinates.append(y)
+        self.node_tags.append(tags)
+
+    def add_way(self, identifier, version, coordinates, tags):
+        """
+        Buffers a way
+
+        :param identifier: Way id
+        :param version: Way version
+        :param coordinates: Flat sequence of x, y coordinates of the nodes
+        :param tags: Tags of the way or None
+        :return: None
+        """
+        self.way_positions.setdefault(identifier, {})[version] = len(self.way_ids)
+        self.way_ids.append(identifier)
+        self.way_versions.append(version)
+        self.way_coordinates.extend(coordinates)
+        self.way_offsets.append(len(self.way_coordinates))
+        self.way_tags.append(tags)
+
+    @staticmethod
+    def find(positions, identifier, version=None):
+        """
+        Returns the position of a buffered element
+
+        :param positions: Positions by version by id
+        :type positions: dict
+        :param identifier: Element id
+        :param version: Version of the element, None for the last buffered version
+        :return: Position or None if the element isn't buffered
+        :rtype: int
+        """
+        versions = positions.get(identifier)
+        if not versions:
+            return None
+        if version is None:
+            version = max(versions)
+        return versions.get(version)
+
+    def get_node(self, identifier, version=None):
+        """
+        Returns a buffered node
+
+        :param identifier: Node id
+        :param version: Version of the node, None for the last buffered version
+        :return: Version, x, y and tags or None if the node isn't buffered
+        :rtype: tuple
+        """
+        pos = self.find(self.node_positions, identifier, version)
+        if pos is None:
+            return None
+        coordinates = self.node_coordinates
+        return self.node_versions[pos], coordinates[2 * pos], coordinates[2 * pos + 1], self.node_tags[pos]
+
+    def get_way(self, identifier, version=None):
+        """
+        Returns a buffered way
+
+        :param identifier: Way id
+        :param version: Version of the way, None for the last buffered version
+        :return: Version, flat list of x, y coordinates and tags or None if the way isn't buffered
+        :rtype: tuple
+        """
+        pos = self.find(self.way_positions, identifier, version)
+        if pos is None:
+            return None
+        coordinates = self.way_coordinates[self.way_offsets[pos]:self.way_offsets[pos + 1]]
+        return self.way_versions[pos], coordinates.tolist(), self.way_tags[pos]
+
+    def node_rows(self):
+        """
+        Returns the buffered nodes in the text format of COPY
+
+        :return: Rows
+        :rtype: io.StringIO
+        """
+        rows = io.StringIO()
+        coordinates = self.node_coordinates
+        for pos in range(len(self.node_ids)):
+            tags = self.node_tags[pos]
+            rows.write("{}\t{}\t{}\t{}\n".format(
+                self.node_ids[pos],
+                self.node_versions[pos],
+                copy_value(json.dumps(tags) if tags else None),
+                ewkb_point(coordinates[2 * pos], coordinates[2 * pos + 1], self.srid)
+            ))
+        rows.seek(0)
+        return rows
+
+    def way_rows(self):
+        """
+        Returns the buffered ways in the text format of COPY
+
+        :return: Rows
+        :rtype: io.StringIO
+        """
+        rows = io.StringIO()
+        for pos in range(len(self.way_ids)):
+            tags = self.way_tags[pos]
+            coordinates = self.way_coordinates[self.way_offsets[pos]:self.way_offsets[pos + 1]]
+            rows.write("{}\t{}\t{}\t{}\n".format(
+                self.way_ids[pos],
+                self.way_versions[pos],
+                copy_value(json.dumps(tags) if tags else None),
+                ewkb_line(coordinates, self.srid)
+            ))
+        rows.seek(0)
+        return rows
+
+    def flush(self):
+        """
+        Writes the buffered nodes and ways on a single transaction
+
+        :return: None
+        """
+        if not self.node_ids and not self.way_ids:
+            return
+        if self.connection is None or self.connection.closed:
+            self.connection = self.connect()
+        try:
+            with self.connection.cursor() as cursor:
+                if self.node_ids:
+                    cursor.copy_expert(
+                        "COPY cache_node (osm_id, version, tag, geom) FROM STDIN", self.node_rows())
+                if self.way_ids:
+                    cursor.copy_expert(
+                        "COPY cache_way (osm_id, version, tag, geom) FROM STDIN", self.way_rows())
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        self.clear()
+
+    def close(self):
+        """
+        Closes the connection
+
+        :return: None
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,130 @@
+"""
+Throughput of the location filter with a polygon area compared with the
+bounding box of the area
+
+Usage: python benchmarks/bench_areas.py [change_file.osc.gz]
+
+The area is an irregular polygon of a municipality size with many
+vertices. Without a change file random locations are used, most of them
+outside the bounding box of the area like on the diffs of the planet.
+"""
+from __future__ import print_function
+import math
+import os
+import random
+import sys
+import time
+
+import shapely
+from shapely.geometry import Polygon
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bard import ChangeHandler
+from bard import geometry
+from bard.areas import Area
+
+VERTICES = [100, 1000, 10000]
+LOCATIONS = 200000
+# Share of the random locations inside the bounding box of the area
+INSIDE_SHARE = 0.1
+CENTER = (41.98, 2.82)
+
+
+def build_polygon(vertices, rnd):
+    """
+    Returns a star shaped polygon around the center, about 10 km wide
+    """
+    points = []
+    for pos in range(vertices):
+        angle = 2 * math.pi * pos / vertices
+        radius = 0.05 * rnd.uniform(0.5, 1)
+        points.append((CENTER[1] + radius * math.cos(angle), CENTER[0] + radius * math.sin(angle)))
+    return Polygon(points)
+
+
+def build_locations(area, rnd):
+    north, east, south, west = area.bbox
+    locations = []
+    for _ in range(LOCATIONS):
+        if rnd.random() < INSIDE_SHARE:
+            locations.append((rnd.uniform(south, north), rnd.uniform(west, east)))
+        else:
+            locations.append((rnd.uniform(-60, 70), rnd.uniform(-180, 180)))
+    return locations
+
+
+def load_locations(filename):
+    import osmium
+
+    class LocationCollector(osmium.SimpleHandler):
+        def __init__(self):
+            osmium.SimpleHandler.__init__(self)
+            self.locations = []
+
+        def node(self, node):
+            if node.location.valid():
+                self.locations.append((node.location.lat, node.location.lon))
+
+    collector = LocationCollector()
+    collector.apply_file(filename)
+    return collector.locations
+
+
+def rate(function, locations):
+    start = time.time()
+    found = function(locations)
+    return len(locations) / (time.time() - start), found
+
+
+def main():
+    rnd = random.Random(1)
+    print("{:>9} {:>12} {:>14} {:>14} {:>14}".format(
+        "vertices", "bbox loc/s", "polygon loc/s", "no reject/s", "vector loc/s"))
+    for vertices in VERTICES:
+        area = Area(build_polygon(vertices, rnd))
+        if len(sys.argv) > 1:
+            locations = load_locations(sys.argv[1])
+        else:
+            locations = build_locations(area, rnd)
+
+        bbox_handler = ChangeHandler()
+        bbox_handler.set_bbox(*area.bbox)
+        bbox_handler.set_tags("all", ".*", ".*", ["node"])
+        area_handler = ChangeHandler()
+        area_handler.set_area(area)
+        area_handler.set_tags("all", ".*", ".*", ["node"])
+
+        def bbox_filter(locations):
+            index = bbox_handler.get_bbox_index()
+            return sum(1 for lat, lon in locations if index.query(lat, lon))
+
+        def area_filter(locations):
+            index = area_handler.get_bbox_index()
+            found = 0
+            for lat, lon in locations:
+                candidates = index.query(lat, lon)
+                if candidates and area_handler.in_areas(candidates, lat, lon):
+                    found += 1
+            return found
+
+        def no_reject(locations):
+            return sum(1 for lat, lon in locations if shapely.contains_xy(area.polygon, lon, lat))
+
+        def vector(locations):
+            points = geometry.coordinates(locations)
+            return sum(1 for start in range(0, len(points), 1000) if area.contains_any(points[start:start + 1000]))
+
+        bbox_rate, _ = rate(bbox_filter, locations)
+        area_rate, found = rate(area_filter, locations)
+        sample = locations[:LOCATIONS // 10]
+        no_reject_rate, _ = rate(no_reject, sample)
+        vector_rate, _ = rate(vector, locations)
+        assert area_filter(sample) == no_reject(sample)
+        print("{:>9} {:>12.0f} {:>14.0f} {:>14.0f} {:>14.0f}".format(
+            vertices, bbox_rate, area_rate, no_reject_rate, vector_rate))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Latency of the node lookups of the cache with and without its indexes
+
+Usage: python benchmarks/bench_cache_lookup.py host database user password [nodes]
+
+The cache_node table of the database is filled up to the number of nodes
+(10M by default, 3 versions of each id) before measuring, use a database
+only for the benchmark. The in memory cache of DbCache is disabled so
+every lookup is a query.
+"""
+from __future__ import print_function
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bard.bard import DbCache
+from bard.models import CACHE_INDEXES
+from bard.writer import CacheWriter
+
+NODES = 10000000
+VERSIONS = 3
+BATCH = 100000
+LOOKUPS = 1000
+UNINDEXED_LOOKUPS = 10
+
+
+def fill(cache, nodes):
+    connection = cache.connect()
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT count(*) FROM cache_node")
+        existing = cursor.fetchone()[0]
+    connection.close()
+    if existing >= nodes:
+        return
+    rnd = random.Random(1)
+    writer = CacheWriter(cache.connect)
+    start = time.time()
+    for row in range(existing, nodes):
+        identifier = row // VERSIONS + 1
+        writer.add_node(identifier, row % VERSIONS + 1, rnd.uniform(41, 42), rnd.uniform(2, 3), None)
+        if writer.pending_nodes >= BATCH:
+            writer.flush()
+    writer.flush()
+    writer.close()
+    print("loaded {} nodes in {:.0f} s".format(nodes - existing, time.time() - start))
+
+
+def drop_indexes(cache):
+    connection = cache.connect()
+    with connection.cursor() as cursor:
+        for sql in CACHE_INDEXES:
+            if sql.startswith("CREATE INDEX"):
+                cursor.execute("DROP INDEX IF EXISTS {}".format(sql.split()[5]))
+    connection.commit()
+    connection.close()
+
+
+def analyze(cache):
+    connection = cache.connect()
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE cache_node")
+    connection.commit()
+    connection.close()
+
+
+def lookups(cache, nodes, count):
+    rnd = random.Random(2)
+    ids = [rnd.randint(1, nodes // VERSIONS) for _ in range(count)]
+    latest = []
+    for identifier in ids:
+        start = time.time()
+        node = cache.get_node(identifier)
+        latest.append(time.time() - start)
+        assert node["data"]["version"] == VERSIONS
+    versioned = []
+    for identifier in ids:
+        start = time.time()
+        cache.get_node(identifier, 1)
+        versioned.append(time.time() - start)
+    return latest, versioned
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    print("{:>22} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+        name,
+        1000 * latencies[len(latencies) // 2],
+        1000 * latencies[int(len(latencies) * 0.95)],
+        1000 * latencies[-1]))
+
+
+def main():
+    host, database, user, password = sys.argv[1:5]
+    nodes = int(sys.argv[5]) if len(sys.argv) > 5 else NODES
+    cache = DbCache(host, database, user, password)
+    cache.initialize()
+    cache.elements.max_size = 0
+    fill(cache, nodes)
+
+    print("{:>22} {:>10} {:>10} {:>10}".format("lookup", "p50 ms", "p95 ms", "max ms"))
+    drop_indexes(cache)
+    analyze(cache)
+    latest, versioned = lookups(cache, nodes, UNINDEXED_LOOKUPS)
+    report("latest, no index", latest)
+    report("version, no index", versioned)
+
+    start = time.time()
+    cache.create_indexes()
+    analyze(cache)
+    print("indexes created in {:.0f} s".format(time.time() - start))
+    latest, versioned = lookups(cache, nodes, LOOKUPS)
+    report("latest, indexed", latest)
+    report("version, indexed", versioned)
+
+
+if __name__ == '__main__':
+    main()
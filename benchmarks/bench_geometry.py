@@ -0,0 +1,70 @@
+"""
+Time of the bounding box test of the locations of a way by number of nodes
+
+Usage: python benchmarks/bench_geometry.py
+
+The locations are outside all the bounding boxes, the worst case, and are
+checked with the point by point lookup on the index of bounding boxes and
+with the vectorized test of bard.geometry, from lat, lon tuples and from
+the coordinates of a way of the cache.
+"""
+from __future__ import print_function
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bard import ChangeHandler
+from bard import geometry
+
+NODES = [10, 100, 1000, 10000]
+SUBSCRIPTIONS = [1, 10, 100]
+REPEAT_POINTS = 200000
+
+
+def build_handler(subscriptions):
+    rnd = random.Random(subscriptions)
+    handler = ChangeHandler()
+    for tag_id in range(subscriptions):
+        lat = rnd.uniform(40, 42)
+        lon = rnd.uniform(0, 3)
+        handler.set_tags(str(tag_id), ".*", ".*", ["way"], tag_id + 1, (lat + 0.1, lon + 0.1, lat, lon))
+    return handler
+
+
+def way_locations(nodes):
+    rnd = random.Random(nodes)
+    return [(rnd.uniform(-60, 30), rnd.uniform(-180, -10)) for _ in range(nodes)]
+
+
+def measure(function, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        function()
+    return (time.time() - start) / repeat * 1e6
+
+
+def main():
+    print("{:>6} {:>13} {:>14} {:>14} {:>14}".format("nodes", "subscriptions", "index us", "vector us", "cached us"))
+    for nodes in NODES:
+        locations = way_locations(nodes)
+        cached = [locations]
+        repeat = max(10, REPEAT_POINTS // nodes)
+        for subscriptions in SUBSCRIPTIONS:
+            handler = build_handler(subscriptions)
+            names = sorted(handler.tags)
+            handler.get_bbox_index()
+            bboxes = geometry.bboxes_array([handler.tag_bbox(name) for name in names])
+            assert handler.tags_in_bbox(iter(locations), names) == handler.tags_in_bbox(locations, names)
+            index_us = measure(lambda: handler.tags_in_bbox(iter(locations), names), repeat)
+            vector_us = measure(lambda: handler.tags_in_bbox(locations, names), repeat)
+            cached_us = measure(lambda: geometry.bboxes_hit(geometry.coordinates(cached), bboxes), repeat)
+            print("{:>6} {:>13} {:>14.1f} {:>14.1f} {:>14.1f}".format(
+                nodes, subscriptions, index_us, vector_us, cached_us))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
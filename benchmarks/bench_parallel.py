@@ -0,0 +1,120 @@
+"""
+Speedup of the processing of a change file split in shards on several processes
+
+Usage: python benchmarks/bench_parallel.py [change_file.osc.gz] [latency_ms]
+
+Without a change file a synthetic one is generated. The previous versions
+are served by a provider that waits latency_ms milliseconds on each request
+to simulate the requests to the OSM API (1 ms by default, 0 to measure
+only the CPU).
+
+Every worker parses the whole file, so the parsing time printed first is
+paid by each worker and bounds the speedup. The workers are only used when
+the provider is remote, with a latency of 0 the CPU bound run is processed
+on a single process like the runs with the cache or the history store.
+"""
+from __future__ import print_function
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bard import Bard
+from bard.history import HistoryChain, HistoryProvider
+
+WORKERS = [1, 2, 4, 8]
+NODES = 20000
+WAYS = 5000
+BBOX = (42.0, 3.0, 41.0, 2.0)
+
+
+class LatencyHistory(HistoryProvider):
+    """
+    Previous versions without tags served after a delay
+    """
+
+    name = "latency"
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.remote = latency > 0
+
+    def get_tags(self, elem, gid, version):
+        if self.latency:
+            time.sleep(self.latency)
+        return {}
+
+
+def generate(filename, nodes=NODES, ways=WAYS):
+    rnd = random.Random(1)
+    north, east, south, west = BBOX
+    with open(filename, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6" generator="bench">\n<modify>\n')
+        for node_id in range(1, nodes + 1):
+            f.write(
+                '<node id="{}" version="2" changeset="{}" user="u{}" uid="{}" lat="{:.7f}" lon="{:.7f}">'
+                '<tag k="amenity" v="bench"/></node>\n'.format(
+                    node_id, node_id // 100, node_id % 50, node_id % 50,
+                    rnd.uniform(south, north), rnd.uniform(west, east)))
+        for way_id in range(1, ways + 1):
+            refs = "".join('<nd ref="{}"/>'.format(rnd.randint(1, nodes)) for _ in range(4))
+            f.write(
+                '<way id="{}" version="3" changeset="{}" user="u{}" uid="{}">{}'
+                '<tag k="highway" v="residential"/></way>\n'.format(
+                    way_id, way_id // 100, way_id % 50, way_id % 50, refs))
+        f.write('</modify>\n</osmChange>\n')
+
+
+def run(filename, workers, latency):
+    bard = Bard()
+    bard.handler.set_bbox(*BBOX)
+    bard.handler.set_history(HistoryChain([LatencyHistory(latency)]))
+    bard.handler.set_tags("amenity", "amenity", ".*", ["node"])
+    bard.handler.set_tags("highway", "highway", ".*", ["way"])
+    start = time.time()
+    bard.process_file(filename, workers=workers)
+    return time.time() - start, bard.changesets
+
+
+def parse(filename):
+    """
+    Time of the parsing of the file, without watched tags every element is
+    dropped before the callbacks
+    """
+    bard = Bard()
+    bard.handler.set_history(HistoryChain([]))
+    start = time.time()
+    bard.process_file(filename)
+    return time.time() - start
+
+
+def main():
+    tmp_dir = None
+    if len(sys.argv) > 1 and sys.argv[1] != "-":
+        filename = sys.argv[1]
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, "bench.osc")
+        generate(filename)
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.001
+    try:
+        print("{} cores, {:.1f} ms per history request".format(os.cpu_count(), latency * 1000))
+        print("parsing: {:.2f} seconds on every worker".format(parse(filename)))
+        print("{:>8} {:>10} {:>8}".format("workers", "seconds", "speedup"))
+        base_time, base_changesets = run(filename, 1, latency)
+        print("{:>8} {:>10.2f} {:>8.2f}".format(1, base_time, 1.0))
+        for workers in WORKERS[1:]:
+            elapsed, changesets = run(filename, workers, latency)
+            assert changesets == base_changesets
+            print("{:>8} {:>10.2f} {:>8.2f}".format(workers, elapsed, base_time / elapsed))
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
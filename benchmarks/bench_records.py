@@ -0,0 +1,127 @@
+"""
+Memory used by the changeset records compared with the nested dicts they replace
+
+Usage: python benchmarks/bench_records.py [change_file.osc.gz]
+
+With a change file every element is recorded as a change of a single
+watched tag, like a daily diff processed with the tag .*=.*. Without a
+change file a synthetic day of changes is used.
+"""
+from __future__ import print_function
+from array import array
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import osmium
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bard.records import ChangesetRecord
+
+TAGS = ["all", "highway", "building"]
+CHANGESETS = 50000
+ELEMENTS = 3000000
+
+
+class ChangeCollector(osmium.SimpleHandler):
+    """
+    Collects the changes of a change file
+    """
+
+    def __init__(self):
+        osmium.SimpleHandler.__init__(self)
+        self.changes = []
+        self.ids = array("q")
+
+    def add(self, element, ids_key):
+        self.changes.append((element.changeset, element.user, element.uid, ids_key, "all"))
+        self.ids.append(element.id)
+
+    def node(self, node):
+        self.add(node, "nids")
+
+    def way(self, way):
+        self.add(way, "wids")
+
+    def relation(self, relation):
+        self.add(relation, "rids")
+
+
+def load_changes(filename=None):
+    """
+    Returns the changes and its element ids, the ids are kept on an array so
+    each structure creates its own int objects like the handler does
+    """
+    if filename is not None:
+        collector = ChangeCollector()
+        collector.apply_file(filename)
+        return collector.changes, collector.ids
+    rnd = random.Random(1)
+    changes = []
+    ids = array("q")
+    for element_id in range(ELEMENTS):
+        changeset = rnd.randint(1, CHANGESETS)
+        ids_key = rnd.choice(("nids", "nids", "nids", "wids", "rids"))
+        changes.append((changeset, "user{}".format(changeset % 1000), changeset % 1000,
+                        ids_key, rnd.choice(TAGS)))
+        ids.append(4000000000 + element_id)
+    return changes, ids
+
+
+def nested_dicts(changes, ids):
+    changesets = {}
+    for (changeset, user, uid, ids_key, tag_name), element_id in zip(changes, ids):
+        if changeset not in changesets:
+            changesets[changeset] = {
+                "changeset": changeset,
+                "user": user,
+                "uid": uid,
+                "nids": {},
+                "wids": {},
+                "rids": {},
+                "tag_id": None
+            }
+        ids = changesets[changeset][ids_key]
+        if tag_name not in ids:
+            ids[tag_name] = []
+        ids[tag_name].append(element_id)
+    return changesets
+
+
+def records(changes, ids):
+    changesets = {}
+    for (changeset, user, uid, ids_key, tag_name), element_id in zip(changes, ids):
+        record = changesets.get(changeset)
+        if record is None:
+            record = changesets[changeset] = ChangesetRecord(changeset, user, uid)
+        record.add(ids_key, tag_name, element_id)
+    return changesets
+
+
+def measure(build, changes, ids):
+    tracemalloc.start()
+    start = time.time()
+    result = build(changes, ids)
+    elapsed = time.time() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def main():
+    changes, ids = load_changes(sys.argv[1] if len(sys.argv) > 1 else None)
+    print("{} changes".format(len(changes)))
+    print("{:>14} {:>10} {:>10}".format("structure", "MB", "seconds"))
+    old, old_size, old_time = measure(nested_dicts, changes, ids)
+    print("{:>14} {:>10.1f} {:>10.2f}".format("nested dicts", old_size / 1024.0 / 1024, old_time))
+    del old
+    new, new_size, new_time = measure(records, changes, ids)
+    print("{:>14} {:>10.1f} {:>10.2f}".format("records", new_size / 1024.0 / 1024, new_time))
+    print("{:.1f}x less memory".format(float(old_size) / new_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Throughput of the bounding box lookup of the handler by number of user tags
+
+Usage: python benchmarks/bench_subscriptions.py [change_file.osc.gz]
+
+Without a change file random locations are used.
+"""
+from __future__ import print_function
+import os
+import random
+import sys
+import time
+
+import osmium
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bard import ChangeHandler
+
+SUBSCRIPTIONS = [10, 100, 1000, 10000]
+LOCATIONS = 200000
+
+
+class LocationCollector(osmium.SimpleHandler):
+    """
+    Collects the node locations of a change file
+    """
+
+    def __init__(self):
+        osmium.SimpleHandler.__init__(self)
+        self.locations = []
+
+    def node(self, node):
+        if node.location.valid():
+            self.locations.append((node.location.lat, node.location.lon))
+
+
+def random_bbox(rnd):
+    lat = rnd.uniform(-60, 70)
+    lon = rnd.uniform(-180, 179)
+    size = rnd.uniform(0.01, 1)
+    return lat + size, lon + size, lat, lon
+
+
+def load_locations(filename=None):
+    if filename is None:
+        rnd = random.Random(1)
+        return [(rnd.uniform(-60, 70), rnd.uniform(-180, 180)) for _ in range(LOCATIONS)]
+    collector = LocationCollector()
+    collector.apply_file(filename)
+    return collector.locations
+
+
+def build_handler(subscriptions):
+    rnd = random.Random(subscriptions)
+    handler = ChangeHandler()
+    for tag_id in range(subscriptions):
+        handler.set_tags(str(tag_id), ".*", ".*", ["node"], tag_id + 1, random_bbox(rnd))
+    return handler
+
+
+def linear(handler, locations):
+    found = 0
+    for lat, lon in locations:
+        for tag_name in handler.tags:
+            if handler.node_in_bbox((lat, lon), handler.tag_bbox(tag_name)):
+                found += 1
+    return found
+
+
+def indexed(handler, locations):
+    found = 0
+    index = handler.get_bbox_index()
+    for lat, lon in locations:
+        found += len(index.query(lat, lon))
+    return found
+
+
+def main():
+    locations = load_locations(sys.argv[1] if len(sys.argv) > 1 else None)
+    print("{} locations".format(len(locations)))
+    print("{:>13} {:>16} {:>16} {:>10}".format("subscriptions", "linear loc/s", "index loc/s", "build s"))
+    for subscriptions in SUBSCRIPTIONS:
+        handler = build_handler(subscriptions)
+        start = time.time()
+        handler.get_bbox_index()
+        build = time.time() - start
+
+        start = time.time()
+        indexed(handler, locations)
+        index_rate = len(locations) / (time.time() - start)
+
+        sample = locations[:max(200, len(locations) * 10 // subscriptions)]
+        start = time.time()
+        linear(handler, sample)
+        linear_rate = len(sample) / (time.time() - start)
+        assert indexed(handler, sample) == linear(handler, sample)
+        print("{:>13} {:>16.0f} {:>16.0f} {:>10.3f}".format(subscriptions, linear_rate, index_rate, build))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+Throughput and peak memory of the processing of synthetic change files
+
+Usage: python benchmarks/bench_suite.py [--size small|medium|large] [--latency MS]
+                                        [--postgres host,db,user,password]
+                                        [--thresholds FILE] [--save-thresholds]
+
+Each scenario processes the same generated file with Bard.process_file on
+its own process, so the peak RSS is the one of the scenario:
+
+    parse     the file is only parsed by osmium, the baseline of the speed
+    no_cache  the cache is off and the previous versions come from the API
+    sqlite    the previous versions are in the local SQLite history
+    postgres  the previous versions are in the PostGIS cache (only with --postgres)
+
+The OSM API is replaced by a mock that waits the latency on every call. The
+speed of each scenario is compared as a ratio of the speed of the baseline
+measured in the same run, so the thresholds don't depend on the machine.
+The ratios must not be lower and the peak RSS must not be higher than the
+thresholds, the exit status is 1 when any scenario regresses. The peak RSS
+depends less on the machine but it changes with the versions of Python and
+osmium, after upgrading them run --save-thresholds, which writes thresholds
+with a margin from the results of the run.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from synthetic import BBOX, generate
+
+SIZES = {
+    "small": (20000, 4000, 400),
+    "medium": (100000, 20000, 2000),
+    "large": (500000, 100000, 10000),
+}
+BASELINE = "parse"
+SCENARIOS = [BASELINE, "no_cache", "sqlite", "postgres"]
+THRESHOLDS = os.path.join(BENCHMARKS_DIR, "thresholds.json")
+# Margins of the saved thresholds
+SPEED_MARGIN = 0.5
+MEMORY_MARGIN = 1.5
+
+
+class MockApi(object):
+    """
+    OSM API that answers after a delay, half of the previous versions have
+    the watched tags and the members are inside the bounding box
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def element(self, identifier, version):
+        self.wait()
+        tags = {"building": "yes"} if identifier % 2 else {}
+        return {"id": identifier, "version": version, "tag": tags}
+
+    def NodeGet(self, identifier, version=-1):
+        return self.element(identifier, version)
+
+    def WayGet(self, identifier, version=-1):
+        return self.element(identifier, version)
+
+    def RelationGet(self, identifier, version=-1):
+        return self.element(identifier, version)
+
+    def NodesGet(self, ids):
+        self.wait()
+        north, east, south, west = BBOX
+        return dict((i, {"id": i, "lat": (north + south) / 2, "lon": (east + west) / 2}) for i in ids)
+
+    def WaysGet(self, ids):
+        self.wait()
+        return dict((i, {"id": i, "version": 1, "tag": {}, "nd": [i * 10, i * 10 + 1]}) for i in ids)
+
+
+def build_bard(scenario, latency, work_dir, postgres=None):
+    """
+    Returns a Bard configured for the scenario
+
+    :param scenario: Name of the scenario
+    :param latency: Seconds of each API call
+    :param work_dir: Directory of the SQLite history
+    :param postgres: Host, database, user and password of the cache
+    :return: Bard
+    """
+    from bard import Bard
+    from bard.history import ApiHistory, CacheHistory, HistoryChain, SqliteHistory
+    from bard.resolver import MemberResolver
+
+    if scenario == "postgres":
+        bard = Bard(*postgres)
+        bard.handler.cache.initialize()
+    else:
+        bard = Bard()
+    api = ApiHistory(MockApi(latency))
+    if scenario == "sqlite":
+        store = SqliteHistory(os.path.join(work_dir, "history.sqlite"))
+        bard.handler.set_history_store(store)
+        bard.handler.set_history(HistoryChain([store, api]))
+    elif scenario == "postgres":
+        bard.handler.set_history(HistoryChain([CacheHistory(bard.handler.cache), api]))
+    else:
+        bard.handler.set_history(HistoryChain([api]))
+    bard.handler.resolver = MemberResolver(
+        bard.handler.cache if scenario == "postgres" else None,
+        api_factory=lambda: MockApi(latency))
+    bard.handler.set_bbox(*BBOX)
+    bard.handler.set_tags("highway", "highway", ".*", ["way"])
+    bard.handler.set_tags("building", "building", ".*", ["node", "way", "relation"])
+    bard.handler.set_tags("amenity", "amenity|shop", ".*", ["node"])
+    return bard
+
+
+def parse_file(filename):
+    """
+    Parses the file with a handler that only counts the elements
+
+    :return: Elements
+    :rtype: int
+    """
+    import osmium
+
+    class CountHandler(osmium.SimpleHandler):
+        def __init__(self):
+            super(CountHandler, self).__init__()
+            self.elements = 0
+
+        def node(self, node):
+            self.elements += 1
+
+        def way(self, way):
+            self.elements += 1
+
+        def relation(self, relation):
+            self.elements += 1
+
+    handler = CountHandler()
+    handler.apply_file(filename)
+    return handler.elements
+
+
+def run_scenario(scenario, filename, latency, postgres=None, elements=None):
+    """
+    Processes the file twice, the first run fills the local history of the
+    scenario and the second one is measured. The elements per second are
+    the ones of the file, the elements dropped by the osmium filters don't
+    reach the handler counters
+
+    :return: Elements, seconds, elements per second, changesets and peak RSS in MB
+    :rtype: dict
+    """
+    if scenario == BASELINE:
+        parse_file(filename)
+        start = time.time()
+        count = parse_file(filename)
+        seconds = time.time() - start
+        return {
+            "elements": count,
+            "seconds": seconds,
+            "elements_per_second": count / seconds,
+            "changesets": 0,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+    work_dir = tempfile.mkdtemp()
+    try:
+        build_bard(scenario, latency, work_dir, postgres).process_file(filename)
+        bard = build_bard(scenario, latency, work_dir, postgres)
+        start = time.time()
+        bard.process_file(filename)
+        seconds = time.time() - start
+        metrics = bard.get_metrics()
+        counters = metrics["counters"]
+        if elements is None:
+            elements = counters.get("nodes", 0) + counters.get("ways", 0) + counters.get("relations", 0)
+        return {
+            "elements": elements,
+            "seconds": seconds,
+            "elements_per_second": elements / seconds,
+            "changesets": counters.get("changesets", 0),
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def run_isolated(scenario, filename, latency, postgres=None, elements=None):
+    """
+    Runs a scenario on a new process and returns its results
+    """
+    command = [sys.executable, os.path.abspath(__file__), "--run", scenario, "--file", filename,
+               "--latency", str(latency * 1000)]
+    if elements is not None:
+        command += ["--elements", str(elements)]
+    if postgres:
+        command += ["--postgres", ",".join(postgres)]
+    output = subprocess.check_output(command)
+    return json.loads(output.decode("utf-8").splitlines()[-1])
+
+
+def speed_ratio(results, scenario):
+    """
+    Returns the speed of a scenario as a ratio of the speed of the baseline
+
+    :param results: Results by scenario
+    :param scenario: Name of the scenario
+    :return: Elements per second of the scenario divided by the ones of the baseline
+    :rtype: float
+    """
+    return results[scenario]["elements_per_second"] / results[BASELINE]["elements_per_second"]
+
+
+def check(results, thresholds):
+    """
+    Compares the results with the thresholds
+
+    :param results: Results by scenario, with the baseline
+    :param thresholds: Minimum speed ratio and maximum peak RSS by scenario
+    :return: Regressions as text
+    :rtype: list
+    """
+    regressions = []
+    for scenario, result in sorted(results.items()):
+        limits = thresholds.get(scenario)
+        if limits is None:
+            continue
+        ratio = speed_ratio(results, scenario)
+        if ratio < limits["min_speed_ratio"]:
+            regressions.append("{}: {:.3f} of the {} speed is lower than {:.3f}".format(
+                scenario, ratio, BASELINE, limits["min_speed_ratio"]))
+        if result["peak_rss_mb"] > limits["max_peak_rss_mb"]:
+            regressions.append("{}: {:.1f} MB of peak RSS is higher than {:.1f}".format(
+                scenario, result["peak_rss_mb"], limits["max_peak_rss_mb"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the processing of synthetic change files")
+    parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds of each API call")
+    parser.add_argument("--postgres", default=None, help="host,database,user,password of the cache")
+    parser.add_argument("--thresholds", default=THRESHOLDS)
+    parser.add_argument("--save-thresholds", action="store_true")
+    parser.add_argument("--run", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--file", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--elements", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    latency = args.latency / 1000
+    postgres = args.postgres.split(",") if args.postgres else None
+
+    if args.run:
+        print(json.dumps(run_scenario(args.run, args.file, latency, postgres, args.elements)))
+        return 0
+
+    scenarios = [scenario for scenario in SCENARIOS if scenario != "postgres" or postgres]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmp_dir, "synthetic.osc.gz")
+        count = generate(filename, *SIZES[args.size])
+        print("{} elements, {} size, {:.1f} ms per API call".format(count, args.size, args.latency))
+        print("{:>10} {:>12} {:>8} {:>10} {:>10}".format("scenario", "elements/s", "ratio", "seconds", "RSS MB"))
+        results = {}
+        for scenario in scenarios:
+            result = results[scenario] = run_isolated(scenario, filename, latency, postgres, count)
+            print("{:>10} {:>12.0f} {:>8.3f} {:>10.2f} {:>10.1f}".format(
+                scenario, result["elements_per_second"], speed_ratio(results, scenario),
+                result["seconds"], result["peak_rss_mb"]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    key = "{}-{}ms".format(args.size, args.latency)
+    thresholds = {}
+    if os.path.exists(args.thresholds):
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+    if args.save_thresholds:
+        thresholds[key] = dict(
+            (scenario, {
+                "min_speed_ratio": round(speed_ratio(results, scenario) * SPEED_MARGIN, 3),
+                "max_peak_rss_mb": round(result["peak_rss_mb"] * MEMORY_MARGIN, 1)
+            }) for scenario, result in results.items() if scenario != BASELINE)
+        with open(args.thresholds, "w") as f:
+            json.dump(thresholds, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("thresholds saved to {}".format(args.thresholds))
+        return 0
+    regressions = check(results, thresholds.get(key, {}))
+    for regression in regressions:
+        print("REGRESSION {}".format(regression))
+    if not regressions:
+        print("no regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Generator of synthetic change files
+
+Usage: python benchmarks/synthetic.py output.osc[.gz] [nodes] [ways] [relations]
+
+The elements are created, modified and deleted in the proportions of the
+mix, a part of them are inside the bounding box and have the watched tags.
+The relations have members of the file and members that are not in it, like
+the relations of a real diff.
+"""
+from __future__ import print_function
+import gzip
+import random
+import sys
+
+BBOX = (42.0, 3.0, 41.0, 2.0)
+# Proportions of created, modified and deleted elements
+MIX = {"create": 0.2, "modify": 0.7, "delete": 0.1}
+TAGS = [
+    ("highway", "residential"), ("building", "yes"), ("amenity", "cafe"),
+    ("shop", "bakery"), ("natural", "tree"), ("landuse", "forest"),
+]
+
+
+class ChangeGenerator(object):
+    """
+    Generates the elements of a change file
+    """
+
+    def __init__(self, nodes=50000, ways=10000, relations=1000, mix=None, bbox=BBOX, inside=0.5,
+                 tagged=0.3, seed=1):
+        """
+        Class constructor
+
+        :param nodes: Number of nodes
+        :param ways: Number of ways
+        :param relations: Number of relations
+        :param mix: Proportions of created, modified and deleted elements
+        :type mix: dict
+        :param bbox: Bounding box as north, east, south, west
+        :param inside: Proportion of the nodes inside the bounding box
+        :param tagged: Proportion of the elements with tags
+        :param seed: Seed of the random generator, the same seed generates the same file
+        """
+        self.nodes = nodes
+        self.ways = ways
+        self.relations = relations
+        self.mix = mix or MIX
+        self.bbox = bbox
+        self.inside = inside
+        self.tagged = tagged
+        self.rnd = random.Random(seed)
+        self.changeset = 1000
+
+    def action(self):
+        value = self.rnd.random()
+        for action in ("create", "modify"):
+            if value < self.mix[action]:
+                return action
+            value -= self.mix[action]
+        return "delete"
+
+    def attributes(self, identifier, action):
+        if action == "create":
+            version = 1
+        else:
+            version = self.rnd.randint(2, 9)
+        if self.rnd.random() < 0.2:
+            self.changeset += 1
+        uid = self.changeset % 500
+        return 'id="{}" version="{}" changeset="{}" user="user{}" uid="{}" timestamp="2019-01-01T00:00:00Z"'.format(
+            identifier, version, self.changeset, uid, uid)
+
+    def tags(self, action):
+        if action == "delete" or self.rnd.random() >= self.tagged:
+            return ""
+        key, value = self.rnd.choice(TAGS)
+        return '<tag k="{}" v="{}"/>'.format(key, value)
+
+    def location(self):
+        north, east, south, west = self.bbox
+        if self.rnd.random() < self.inside:
+            return self.rnd.uniform(south, north), self.rnd.uniform(west, east)
+        return self.rnd.uniform(south - 10, south - 1), self.rnd.uniform(west - 10, west - 1)
+
+    def node(self, identifier):
+        action = self.action()
+        attributes = self.attributes(identifier, action)
+        if action == "delete":
+            return action, '<node {}/>'.format(attributes)
+        lat, lon = self.location()
+        return action, '<node {} lat="{:.7f}" lon="{:.7f}">{}</node>'.format(
+            attributes, lat, lon, self.tags(action))
+
+    def way(self, identifier):
+        action = self.action()
+        attributes = self.attributes(identifier, action)
+        if action == "delete":
+            return action, '<way {}/>'.format(attributes)
+        first = self.rnd.randint(1, max(self.nodes - 10, 1))
+        refs = "".join('<nd ref="{}"/>'.format(first + position) for position in range(self.rnd.randint(2, 10)))
+        return action, '<way {}>{}{}</way>'.format(attributes, refs, self.tags(action))
+
+    def relation(self, identifier):
+        action = self.action()
+        attributes = self.attributes(identifier, action)
+        if action == "delete":
+            return action, '<relation {}/>'.format(attributes)
+        members = []
+        for _ in range(self.rnd.randint(1, 10)):
+            if self.rnd.random() < 0.5:
+                member_type, ref = "node", self.rnd.randint(1, self.nodes * 2)
+            else:
+                member_type, ref = "way", self.rnd.randint(1, self.ways * 2)
+            members.append('<member type="{}" ref="{}" role=""/>'.format(member_type, ref))
+        return action, '<relation {}>{}{}</relation>'.format(attributes, "".join(members), self.tags(action))
+
+    def elements(self):
+        """
+        Yields the action and the XML of every element in the order of a change file
+
+        :return: Generator of action, XML tuples
+        """
+        for identifier in range(1, self.nodes + 1):
+            yield self.node(identifier)
+        for identifier in range(1, self.ways + 1):
+            yield self.way(identifier)
+        for identifier in range(1, self.relations + 1):
+            yield self.relation(identifier)
+
+    def write(self, filename):
+        """
+        Writes the change file, it's compressed if the name ends with .gz
+
+        :param filename: Path of the file
+        :return: Number of elements
+        :rtype: int
+        """
+        opener = gzip.open if filename.endswith(".gz") else open
+        count = 0
+        with opener(filename, "wt") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6" generator="bard-benchmarks">\n')
+            for action, xml in self.elements():
+                f.write("<{0}>{1}</{0}>\n".format(action, xml))
+                count += 1
+            f.write("</osmChange>\n")
+        return count
+
+
+def generate(filename, nodes=50000, ways=10000, relations=1000, **kwargs):
+    """
+    Writes a synthetic change file
+
+    :param filename: Path of the file, it's compressed if the name ends with .gz
+    :param nodes: Number of nodes
+    :param ways: Number of ways
+    :param relations: Number of relations
+    :return: Number of elements
+    :rtype: int
+    """
+    return ChangeGenerator(nodes, ways, relations, **kwargs).write(filename)
+
+
+def main():
+    sizes = [int(value) for value in sys.argv[2:5]]
+    count = generate(sys.argv[1], *sizes)
+    print("{} elements written to {}".format(count, sys.argv[1]))
+
+
+if __name__ == '__main__':
+    main()
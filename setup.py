@@ -21,7 +21,9 @@ setup(
     package_data={
         'bard': [
             "bard/templates/text_template.txt",
-            "bard/templates/html_template.html"
+            "bard/templates/html_template.html",
+            "bard/templates/text_changeset.txt",
+            "bard/templates/html_changeset.html"
         ]
     }
 )
@@ -1,8 +1,37 @@
+from datetime import datetime, timezone
+import gzip
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+from time import sleep
 import unittest
 from bard import Bard
 from bard import ChangeHandler
 from osmium.osm import Location, WayNodeList, Node
 from bard.bard import DbCache
+from bard.index import BboxIndex
+from bard import geometry
+from bard.areas import Area, load_area, load_geojson
+from bard.changesets import ChangesetIndex, ChangesetReplication, parse_changeset_state, parse_changeset_time
+from bard.matcher import TagMatcher
+from bard.history import ApiHistory, HistoryChain, HistoryProvider, SqliteHistory
+from bard.writer import CacheWriter, ewkb_line, ewkb_point
+from bard.compaction import CacheCompactor, id_ranges
+from bard.metrics import Metrics, prometheus_text
+from bard.profiling import RunProfiler
+from bard.report import ReportRenderer, select_changesets
+from bard.registry import TemplateRegistry, get_registry
+from bard.mail import MailError, MailgunClient
+from bard.resolver import MemberResolver
+from bard.locations import LocationIndex
+from bard.lru import ElementCache, MISSING
+from bard.records import ChangesetRecord
+from bard.osc import OSC, SequenceState, parse_timestamp
+from shapely import wkb
 from bard.models import *
 import osmapi
 import psycopg2
@@ -16,6 +45,23 @@ else:
     from unittest.mock import MagicMock
 
 
+class CommandErrorTest(unittest.TestCase):
+    """
+    Test suite for the errors of the Cli commands
+    """
+
+    def test_process(self):
+        """
+        Tests that the errors of process are printed and end with a non zero status
+        :return: None
+        """
+        runner = CliRunner()
+        result = runner.invoke(bardcli, ["process", "test", "--file", "test/test1.osc"],
+                               env={"BARD_CONFIG": None})
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("BARD_CONFIG", result.output)
+
+
 class CommandTest(unittest.TestCase):
     """
     Test suite for Cli commands
@@ -237,6 +283,27 @@ class CacheTest(unittest.TestCase):
         self.cache.add_way(4, 2, nl, {"test": "ok"})
         self.cache.get_way(4)
 
+    def test_batch_size(self):
+        """
+        Tests that the nodes and ways are written when the batch is full
+
+        :return: None
+        """
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_node;")
+        self.connection.commit()
+        self.cache.batch_size = 3
+        self.cache.add_node(1, 1, 1.23, 2.42, {})
+        self.cache.add_node(2, 1, 1.23, 2.42, {"name": "tab\tand \\ backslash"})
+        self.assertEqual(self.cache.get_pending_nodes(), 2)
+        self.cache.add_way(1, 1, [(1.0, 1.0), (2.0, 2.0)], {})
+        self.assertEqual(self.cache.get_pending_nodes(), 0)
+        self.assertEqual(self.cache.get_pending_ways(), 0)
+        self.cur.execute("SELECT count(*) from cache_node;")
+        self.assertEqual(self.cur.fetchall()[0][0], 2)
+        self.assertEqual(self.cache.get_node(2)["data"]["tag"], {"name": "tab\tand \\ backslash"})
+        self.cache.batch_size = 10000
+
     def test_get_node(self):
         """
         Test the get_node method
@@ -290,10 +357,421 @@ class CacheTest(unittest.TestCase):
             }
         }
 
+        self.cache.elements.clear()
         self.assertEqual(self.cache.get_node(42, 2), nod_42)
+        self.assertEqual(self.cache.get_node(42), nod_42)
         self.assertEqual(self.cache.get_node(43), nod_43)
         self.assertEqual(self.cache.get_node(44), nod_44)
-        self.assertIsNone(self.cache.get_node(1))
+        self.assertIsNone(self.cache.get_node(1, 99))
+        self.assertEqual(self.cache.get_pending_nodes(), 4)
+        self.cache.commit()
+
+
+    def test_latest_version(self):
+        """
+        Tests that the last version is returned when the version is not set,
+        the rows without version are older, and that the indexes are created
+
+        :return: None
+        """
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_node WHERE osm_id = 77;")
+        self.connection.commit()
+        self.cache.add_node(77, 2, 2.22, 0.23, {})
+        self.cache.add_node(77, 3, 3.33, 0.33, {})
+        self.cache.add_node(77, 1, 1.11, 0.13, {})
+        self.assertEqual(self.cache.get_node(77)["data"]["version"], 3)
+        self.cache.commit()
+        self.cur.execute(
+            "INSERT INTO cache_node (osm_id, version, geom) VALUES (77, NULL, ST_SetSRID(ST_MakePoint(9, 9), 4326));")
+        self.connection.commit()
+        self.cache.elements.clear()
+        self.assertEqual(self.cache.get_node(77)["data"]["version"], 3)
+        self.assertEqual(self.cache.get_node(77, 1)["data"]["lat"], 1.11)
+        self.assertEqual(self.cache.get_node_locations([77]), {77: (3.33, 0.33)})
+
+        self.cache.create_indexes()
+        self.cur.execute("SELECT indexname FROM pg_indexes WHERE tablename IN ('cache_node', 'cache_way');")
+        indexes = set(row[0] for row in self.cur.fetchall())
+        self.assertTrue({
+            "idx_cache_node_osm_id_latest", "idx_cache_way_osm_id_latest",
+            "idx_cache_node_geom", "idx_cache_way_geom"
+        }.issubset(indexes))
+
+    def test_update_schema(self):
+        """
+        Tests that the missing columns are added to the existing tables
+
+        :return: None
+        """
+        self.cur = self.connection.cursor()
+        self.cur.execute("ALTER TABLE usertags DROP COLUMN IF EXISTS geojson;")
+        self.connection.commit()
+        self.cache.update_schema()
+        self.cache.update_schema()
+        self.cur.execute(
+            "SELECT count(*) FROM information_schema.columns "
+            "WHERE table_name = 'usertags' AND column_name = 'geojson';"
+        )
+        self.assertEqual(self.cur.fetchone()[0], 1)
+
+    def test_members_in_bbox(self):
+        """
+        Tests that the last version of the members is checked on the database
+
+        :return: None
+        """
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_node WHERE osm_id IN (78, 79);")
+        self.cur.execute("DELETE FROM cache_way WHERE osm_id = 78;")
+        self.connection.commit()
+        self.cache.add_node(78, 1, 41.5, 2.5, {})
+        self.cache.add_node(78, 2, 10.0, 10.0, {})
+        self.cache.add_way(78, 1, [(41.5, 2.5), (41.6, 2.6)], {})
+
+        bboxes = {"girona": (42.0, 3.0, 41.0, 2.0), "paris": (49.0, 2.5, 48.0, 2.0)}
+        inside, nodes, ways = self.cache.members_in_bbox([78, 79], [], bboxes)
+        self.assertEqual(inside, set())
+        self.assertEqual(nodes, {78})
+        self.assertEqual(ways, set())
+        inside, nodes, ways = self.cache.members_in_bbox([78], [78], bboxes)
+        self.assertEqual(inside, {"girona"})
+        self.assertEqual(ways, {78})
+        area = Area(load_geojson({
+            "type": "Polygon", "coordinates": [[[2.55, 41.0], [3.0, 41.0], [3.0, 42.0], [2.55, 42.0], [2.55, 41.0]]]
+        }))
+        inside, nodes, ways = self.cache.members_in_bbox([78], [78], bboxes, {"girona": area})
+        self.assertEqual(inside, {"girona"})
+        area = Area(load_geojson({
+            "type": "Polygon", "coordinates": [[[2.7, 41.0], [3.0, 41.0], [3.0, 42.0], [2.7, 42.0], [2.7, 41.0]]]
+        }))
+        inside, nodes, ways = self.cache.members_in_bbox([78], [78], bboxes, {"girona": area})
+        self.assertEqual(inside, set())
+
+    def test_compact(self):
+        """
+        Tests that the old versions and the elements outside the bounding
+        boxes are removed from a range of ids
+
+        :return: None
+        """
+        self.cur = self.connection.cursor()
+        self.cur.execute("DELETE FROM cache_node WHERE osm_id >= 900000000 AND osm_id < 900000010;")
+        self.connection.commit()
+        for version in range(1, 5):
+            self.cache.add_node(900000001, version, 41.5, 2.5, {})
+            self.cache.add_node(900000002, version, 10.0, 10.0, {})
+        self.cache.add_node(900000003, 1, 10.0, 10.0, {})
+        self.cache.add_node(900000003, 2, 41.5, 2.5, {})
+        self.cache.commit()
+
+        compactor = CacheCompactor(self.cache.connect, 2, [(42.0, 3.0, 41.0, 2.0)])
+        self.assertEqual(compactor.prune_outside(self.cur, "cache_node", 900000000, 900000010), 4)
+        self.assertEqual(compactor.prune_versions(self.cur, "cache_node", 900000000, 900000010), 2)
+        self.connection.commit()
+        self.cur.execute(
+            "SELECT osm_id, version FROM cache_node WHERE osm_id >= 900000000 AND osm_id < 900000010 "
+            "ORDER BY osm_id, version;")
+        self.assertEqual(self.cur.fetchall(), [(900000001, 3), (900000001, 4), (900000003, 1), (900000003, 2)])
+        stats = compactor.table_stats(self.cur, "cache_node")
+        self.assertTrue(stats["size"] > 0)
+
+class WriterTest(unittest.TestCase):
+    """
+    Test suite for the bulk writer of the cache
+    """
+
+    def test_ewkb(self):
+        """
+        Tests the EWKB geometries built by the writer
+        :return: None
+        """
+        point = wkb.loads(ewkb_point(41.98, 2.81, 4326), hex=True)
+        self.assertEqual((point.x, point.y), (41.98, 2.81))
+        line = wkb.loads(ewkb_line([1.0, 1.0, 2.0, 2.5], 4326), hex=True)
+        self.assertEqual(list(line.coords), [(1.0, 1.0), (2.0, 2.5)])
+
+    def test_rows(self):
+        """
+        Tests the rows written with COPY
+        :return: None
+        """
+        writer = CacheWriter(None)
+        writer.add_node(1, 2, 41.98, 2.81, None)
+        writer.add_node(2, 1, 41.98, 2.81, {"name": "a\\b"})
+        writer.add_way(3, 1, [1.0, 1.0, 2.0, 2.5], {"highway": "residential"})
+        self.assertEqual(writer.pending_nodes, 2)
+        self.assertEqual(writer.pending_ways, 1)
+        rows = writer.node_rows().read().splitlines()
+        self.assertEqual(rows[0], "1\t2\t\\N\t" + ewkb_point(41.98, 2.81, 4326))
+        self.assertEqual(rows[1].split("\t")[2], '{"name": "a\\\\\\\\b"}')
+        self.assertEqual(
+            writer.way_rows().read(),
+            '3\t1\t{"highway": "residential"}\t' + ewkb_line([1.0, 1.0, 2.0, 2.5], 4326) + "\n"
+        )
+        writer.add_node(1, 1, 40.0, 2.0, {"name": "a"})
+        self.assertEqual(writer.get_node(1), (2, 41.98, 2.81, None))
+        self.assertEqual(writer.get_node(1, 1), (1, 40.0, 2.0, {"name": "a"}))
+        self.assertIsNone(writer.get_node(1, 3))
+        self.assertIsNone(writer.get_node(3))
+        self.assertEqual(writer.get_way(3), (1, [1.0, 1.0, 2.0, 2.5], {"highway": "residential"}))
+        writer.clear()
+        self.assertEqual(writer.pending_nodes, 0)
+        self.assertIsNone(writer.get_node(1))
+        writer.flush()
+
+
+class ElementCacheTest(unittest.TestCase):
+    """
+    Test suite for the in memory cache of elements
+    """
+
+    def test_get(self):
+        """
+        Tests the hits, the negative hits and the misses
+        :return: None
+        """
+        cache = ElementCache()
+        node = {"data": {"id": 1, "version": 2, "lat": 1.0, "lon": 2.0, "tag": None}}
+        cache.put("node", 1, 2, node)
+        cache.put("node", 1, None, node)
+        cache.put("way", 5, None, MISSING)
+        self.assertEqual(cache.get("node", 1, 2), node)
+        self.assertEqual(cache.get("node", 1), node)
+        self.assertIs(cache.get("way", 5), MISSING)
+        self.assertIsNone(cache.get("node", 1, 1))
+        stats = cache.get_stats()
+        self.assertEqual(
+            (stats["hits"], stats["negative_hits"], stats["misses"], stats["items"]), (2, 1, 1, 3))
+        self.assertEqual(stats["hit_rate"], 0.75)
+        cache.put_version("node", 1, 1, {"data": {"version": 1}})
+        self.assertEqual(cache.peek("node", 1), node)
+        cache.put_version("node", 1, 3, {"data": {"version": 3}})
+        self.assertEqual(cache.peek("node", 1), {"data": {"version": 3}})
+
+    def test_put_version(self):
+        """
+        Tests that a written version is cached once as the last version and
+        found by its version
+        :return: None
+        """
+        cache = ElementCache(sizes={"node": 100})
+        cache.put_version("node", 1, 2, {"data": {"version": 2}})
+        self.assertEqual((len(cache), cache.size), (1, 100))
+        self.assertEqual(cache.get("node", 1, 2), {"data": {"version": 2}})
+        self.assertEqual(cache.get("node", 1), {"data": {"version": 2}})
+        self.assertIsNone(cache.get("node", 1, 1))
+        cache.put_version("node", 1, 3, {"data": {"version": 3}})
+        self.assertEqual((len(cache), cache.size), (1, 100))
+        self.assertIsNone(cache.peek("node", 1, 2))
+        self.assertEqual(cache.peek("node", 1, 3), {"data": {"version": 3}})
+        cache.put_version("node", 1, 1, {"data": {"version": 1}})
+        self.assertEqual(cache.peek("node", 1, 1), {"data": {"version": 1}})
+        self.assertEqual(cache.peek("node", 1), {"data": {"version": 3}})
+        cache.put("way", 1, None, {"data": {"version": 1}})
+        self.assertTrue(cache.size > 200)
+
+    def test_eviction(self):
+        """
+        Tests that the least recently used elements are evicted when the cache is full
+        :return: None
+        """
+        cache = ElementCache(0)
+        cache.put("node", 1, None, MISSING)
+        self.assertEqual(len(cache), 0)
+        cache = ElementCache()
+        cache.put("node", 1, None, MISSING)
+        size = cache.size
+        cache = ElementCache(size * 2)
+        cache.put("node", 1, None, MISSING)
+        cache.put("node", 2, None, MISSING)
+        cache.get("node", 1)
+        cache.put("node", 3, None, MISSING)
+        self.assertIs(cache.get("node", 1), MISSING)
+        self.assertIsNone(cache.get("node", 2))
+        self.assertIs(cache.get("node", 3), MISSING)
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+        self.assertTrue(cache.size <= size * 2)
+
+
+class RecordTest(unittest.TestCase):
+    """
+    Test suite for the changeset records
+    """
+
+    def test_record(self):
+        """
+        Tests that the record is read like a dict
+        :return: None
+        """
+        record = ChangesetRecord(10, "user", 5, 1)
+        record.add("nids", "girona", 1)
+        record.add("wids", "girona", 7)
+        record.add("nids", "highway", 3)
+        record.add("nids", "girona", 2)
+        self.assertEqual(record["nids"], {"girona": [1, 2], "highway": [3]})
+        self.assertEqual(record["wids"], {"girona": [7]})
+        self.assertEqual(record["rids"], {})
+        self.assertEqual(record.user, "user")
+        self.assertEqual(record.get("changeset"), 10)
+        self.assertIsNone(record.get("comment"))
+        self.assertEqual(record.tag_names(), {"girona", "highway"})
+        self.assertEqual(record, {
+            "changeset": 10,
+            "user": "user",
+            "uid": 5,
+            "nids": {"girona": [1, 2], "highway": [3]},
+            "wids": {"girona": [7]},
+            "rids": {},
+            "tag_id": 1
+        })
+
+
+class FakeApi(object):
+    """
+    OSM API that returns nodes on a diagonal and ways of two nodes
+    """
+    calls = []
+
+    def NodesGet(self, ids):
+        FakeApi.calls.append(("NodesGet", list(ids)))
+        if 404 in ids:
+            raise osmapi.ApiError(404, "Not found", "")
+        return dict((i, {"id": i, "lat": i / 1000.0, "lon": i / 1000.0}) for i in ids)
+
+    def WaysGet(self, ids):
+        FakeApi.calls.append(("WaysGet", list(ids)))
+        return dict((i, {"id": i, "version": 1, "tag": {}, "nd": [i * 10, i * 10 + 1]}) for i in ids)
+
+
+class FakeHistory(HistoryProvider):
+    """
+    History provider that returns the same tags for every version, the
+    elements with an even id are missing when even_missing is set and it
+    acts as the OSM API when remote is set
+    """
+
+    def __init__(self, tags=None, name="provider", even_missing=False, remote=False):
+        self.tags = tags or {}
+        self.name = name
+        self.even_missing = even_missing
+        self.remote = remote
+
+    def get_tags(self, elem, gid, version):
+        if self.even_missing and not gid % 2:
+            return None
+        return dict(self.tags)
+
+
+def girona_bard(types=("node", "way"), history=None, store=None):
+    """
+    Returns a Bard watching all the tags of the element types in the bounding
+    box of Girona, where the changes of test1.osc are
+
+    :param types: Element types of the watched tags
+    :param history: History provider, by default the store or a FakeHistory
+    :param store: History store of the processed elements
+    :return: Bard
+    """
+    bard = Bard()
+    bard.handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+    if store is not None:
+        bard.handler.set_history_store(store)
+    if history is None:
+        history = FakeHistory() if store is None else store
+    bard.handler.set_history(HistoryChain([history]))
+    bard.handler.set_tags("all", ".*", ".*", list(types))
+    return bard
+
+
+class ResolverTest(unittest.TestCase):
+    """
+    Test suite for the resolver of relation members
+    """
+
+    def setUp(self):
+        FakeApi.calls = []
+        self.resolver = MemberResolver(workers=2, batch_size=3, api_factory=FakeApi)
+
+    def tearDown(self):
+        self.resolver.close()
+
+    def test_locations(self):
+        """
+        Tests that the missing members are requested in batches
+        :return: None
+        """
+        members = [("n", 1), ("n", 2), ("n", 3), ("n", 4), ("w", 5), ("r", 6)]
+        locations = sorted(self.resolver.locations(members))
+        self.assertEqual(
+            locations,
+            [(0.001, 0.001), (0.002, 0.002), (0.003, 0.003), (0.004, 0.004), (0.05, 0.05), (0.051, 0.051)]
+        )
+        self.assertEqual(
+            sorted(FakeApi.calls),
+            [("NodesGet", [1, 2, 3]), ("NodesGet", [4]), ("NodesGet", [50, 51]), ("WaysGet", [5])]
+        )
+
+    def test_missing(self):
+        """
+        Tests that the missing elements don't discard the rest of the batch
+        :return: None
+        """
+        locations = list(self.resolver.locations([("n", 1), ("n", 404), ("n", 3)]))
+        self.assertEqual(sorted(locations), [(0.001, 0.001), (0.003, 0.003)])
+
+    def test_early_stop(self):
+        """
+        Tests that the handler stops when all the tags are found
+        :return: None
+        """
+        handler = ChangeHandler()
+        handler.resolver = self.resolver
+        handler.set_tags("a", ".*", ".*", ["relation"], 1, (0.0025, 0.0025, 0, 0))
+        if sys.version_info[0] == 2:
+            members = [mock.MagicMock(type="n", ref=i) for i in range(1, 4)]
+            relation = mock.MagicMock(members=members)
+        else:
+            members = [MagicMock(type="n", ref=i) for i in range(1, 4)]
+            relation = MagicMock(members=members)
+        self.assertEqual(handler.tags_in_bbox(handler.relation_locations(relation), ["a"]), ["a"])
+        handler.set_tags("b", ".*", ".*", ["relation"], 2, (1, 1, 0.5, 0.5))
+        self.assertEqual(handler.relation_tags(relation, ["a", "b"]), ["a"])
+
+    def test_cached_members(self):
+        """
+        Tests that the members on the cache are checked with a single query
+        and only the rest are downloaded
+        :return: None
+        """
+
+        class Cache(object):
+            queries = []
+
+            def members_in_bbox(self, nodes, ways, bboxes, areas=None):
+                self.queries.append((nodes, ways, bboxes, areas))
+                return set(name for name, bbox in bboxes.items() if bbox == (1, 1, 0, 0)), {1, 2}, set()
+
+        handler = ChangeHandler()
+        handler.cache = Cache()
+        handler.cache_enabled = True
+        handler.resolver = self.resolver
+        handler.set_tags("a", ".*", ".*", ["relation"], 1, (1, 1, 0, 0))
+        handler.set_tags("b", ".*", ".*", ["relation"], 2, (0.0035, 0.0035, 0.0025, 0.0025))
+        handler.set_tags("c", ".*", ".*", ["relation"], 3, (2, 2, 1.5, 1.5))
+        if sys.version_info[0] == 2:
+            members = [mock.MagicMock(type=t, ref=i) for t, i in (("n", 1), ("n", 2), ("n", 3), ("w", 4))]
+            relation = mock.MagicMock(members=members)
+        else:
+            members = [MagicMock(type=t, ref=i) for t, i in (("n", 1), ("n", 2), ("n", 3), ("w", 4))]
+            relation = MagicMock(members=members)
+        self.assertEqual(handler.relation_tags(relation, ["a"]), ["a"])
+        self.assertEqual(FakeApi.calls, [])
+        self.assertEqual(Cache.queries, [([1, 2, 3], [4], {"a": (1, 1, 0, 0)}, {})])
+        self.assertEqual(handler.relation_tags(relation, ["a", "b", "c"]), ["a", "b"])
+        self.assertEqual(len(Cache.queries), 2)
+        self.assertEqual(sorted(Cache.queries[1][2]), ["a", "b", "c"])
+        self.assertEqual(sorted(FakeApi.calls), [("NodesGet", [3]), ("NodesGet", [40, 41]), ("WaysGet", [4])])
 
 
 class HandlerTest(unittest.TestCase):
@@ -414,6 +892,34 @@ class HandlerTest(unittest.TestCase):
         self.assertEqual(self.handler.south, 41.9623)
         self.assertEqual(self.handler.west, 2.7847)
 
+    def test_multiple_subscriptions(self):
+        """
+        Tests that each element is evaluated against the bbox and element
+        types of every watched tag on the same pass
+        :return: None
+        """
+
+        if sys.version_info[0] == 2:
+            tag = mock.MagicMock(k="highway", v="residential")
+            node = mock.MagicMock(
+                id=1, version=1, deleted=False, changeset=10, user="test",
+                uid=1, location=Location(2.81372, 41.98268), tags=[tag])
+        else:
+            tag = MagicMock(k="highway", v="residential")
+            node = MagicMock(
+                id=1, version=1, deleted=False, changeset=10, user="test",
+                uid=1, location=Location(2.81372, 41.98268), tags=[tag])
+        self.handler.set_tags("girona", "highway", ".*", ["node"], 1, (41.9933, 2.8576, 41.9623, 2.7847))
+        self.handler.set_tags("barcelona", "highway", ".*", ["node"], 2, (41.4695, 2.2280, 41.3170, 2.0524))
+        self.handler.set_tags("girona_ways", "highway", ".*", ["way"], 3, (41.9933, 2.8576, 41.9623, 2.7847))
+        self.handler.node(node)
+
+        self.assertEqual(list(self.handler.tag_changesets.keys()), [1])
+        self.assertEqual(self.handler.tag_changesets[1][10]["nids"], {"girona": [1]})
+        self.assertEqual(self.handler.changeset, {})
+        self.assertEqual(self.handler.stats, {})
+        self.assertEqual(self.handler.num_nodes, 1)
+
     def test_has_changed(self):
         osm_api = osmapi.OsmApi()
         old_tags = osm_api.WayGet(360662139, 1)["tag"]
@@ -424,6 +930,1187 @@ class HandlerTest(unittest.TestCase):
         self.assertFalse(ret)
 
 
+class IndexTest(unittest.TestCase):
+    """
+    Test suite for the bounding box index
+    """
+
+    def test_query(self):
+        """
+        Tests the query of locations on the index
+        :return: None
+        """
+        index = BboxIndex(cell_size=0.5)
+        index.add("girona", (41.9933, 2.8576, 41.9623, 2.7847))
+        index.add("barcelona", (41.4695, 2.2280, 41.3170, 2.0524))
+        index.add("catalonia", (42.8615, 3.3322, 40.5230, 0.1592))
+        index.add("world", (90, 180, -90, -180))
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.query(41.98268, 2.81372), {"girona", "catalonia", "world"})
+        self.assertEqual(index.query(41.3851, 2.1734), {"barcelona", "catalonia", "world"})
+        self.assertEqual(index.query(48.8566, 2.3522), {"world"})
+        self.assertEqual(index.query(41.9933, 2.81372), {"catalonia", "world"})
+
+    def test_query_bbox(self):
+        """
+        Tests the query of bounding boxes on the index
+        :return: None
+        """
+        index = BboxIndex(cell_size=0.5, max_cells=16)
+        index.add("girona", (41.9933, 2.8576, 41.9623, 2.7847))
+        index.add("barcelona", (41.4695, 2.2280, 41.3170, 2.0524))
+        index.add("world", (90, 180, -90, -180))
+        self.assertEqual(index.query_bbox(42.0, 2.9, 41.9, 2.7), {"girona", "world"})
+        self.assertEqual(index.query_bbox(41.9623, 2.8, 41.5, 2.5), {"girona", "world"})
+        self.assertEqual(index.query_bbox(48.9, 2.4, 48.8, 2.3), {"world"})
+        self.assertEqual(index.query_bbox(43.0, 3.5, 40.0, 0.0), {"girona", "barcelona", "world"})
+        self.assertEqual(index.query_bbox(41.0, 2.0, 42.0, 3.0), set())
+
+    def test_intersects(self):
+        """
+        Tests the check of bounding boxes against the bounds of the index
+        :return: None
+        """
+        index = BboxIndex()
+        self.assertFalse(index.intersects(42.0, 2.9, 41.9, 2.7))
+        index.add("girona", (41.9933, 2.8576, 41.9623, 2.7847))
+        index.add("barcelona", (41.4695, 2.2280, 41.3170, 2.0524))
+        self.assertEqual(index.bounds, (41.9933, 2.8576, 41.3170, 2.0524))
+        self.assertTrue(index.intersects(42.0, 2.9, 41.9, 2.7))
+        self.assertTrue(index.intersects(41.6, 2.5, 41.5, 2.4))
+        self.assertFalse(index.intersects(48.9, 2.4, 48.8, 2.3))
+
+    def test_handler_index(self):
+        """
+        Tests that the index of the handler is rebuilt when the tags change
+        :return: None
+        """
+        handler = ChangeHandler()
+        handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        handler.set_tags("default", ".*", ".*", ["node"])
+        handler.set_tags("barcelona", ".*", ".*", ["node"], 1, (41.4695, 2.2280, 41.3170, 2.0524))
+        self.assertEqual(handler.get_bbox_index().query(41.98268, 2.81372), {"default"})
+        handler.set_tags("all", ".*", ".*", ["node"], 2, (90, 180, -90, -180))
+        self.assertEqual(handler.get_bbox_index().query(41.98268, 2.81372), {"default", "all"})
+        self.assertEqual(
+            handler.tags_in_bbox([(41.3851, 2.1734), (41.98268, 2.81372)], ["default", "barcelona"]),
+            ["default", "barcelona"]
+        )
+
+
+class GeometryTest(unittest.TestCase):
+    """
+    Test suite for the vectorized bounding box tests
+    """
+
+    def test_coordinates(self):
+        """
+        Tests the conversion of the locations to arrays
+        :return: None
+        """
+        expected = [[41.98, 2.81], [41.5, 2.5]]
+        self.assertEqual(geometry.coordinates([(41.98, 2.81), (41.5, 2.5)]).tolist(), expected)
+        self.assertEqual(geometry.coordinates([{"lat": 41.98, "lon": 2.81}, {"data": {"lat": 41.5, "lon": 2.5}}]).tolist(), expected)
+        self.assertEqual(geometry.coordinates([[(41.98, 2.81)], [(41.5, 2.5)]]).tolist(), expected)
+        self.assertEqual(geometry.coordinates([]).shape, (0, 2))
+
+    def test_bboxes_hit(self):
+        """
+        Tests the containment of the points in several bounding boxes, the
+        points on the border are outside
+        :return: None
+        """
+        points = geometry.coordinates([(41.98268, 2.81372), (41.3851, 2.1734), (41.9933, 2.81)])
+        bboxes = geometry.bboxes_array([
+            (41.9933, 2.8576, 41.9623, 2.7847),
+            (41.4695, 2.2280, 41.3170, 2.0524),
+            (48.9, 2.4, 48.8, 2.3)
+        ])
+        self.assertEqual(geometry.in_bbox(points, bboxes[0]).tolist(), [True, False, False])
+        self.assertEqual(geometry.bboxes_hit(points, bboxes).tolist(), [True, True, False])
+        self.assertEqual(geometry.bboxes_hit(points, bboxes, chunk_size=1).tolist(), [True, True, False])
+        self.assertFalse(geometry.any_in_bbox(points, (48.9, 2.4, 48.8, 2.3)))
+
+    def test_line_intersects_bbox(self):
+        """
+        Tests the intersection of the pending elements of the cache with a
+        bounding box, the border is inside
+        :return: None
+        """
+        bbox = (42.0, 3.0, 41.0, 2.0)
+        self.assertTrue(geometry.line_intersects_bbox([(41.5, 2.5)], bbox))
+        self.assertTrue(geometry.line_intersects_bbox([(42.0, 2.5)], bbox))
+        self.assertFalse(geometry.line_intersects_bbox([(10.0, 10.0)], bbox))
+        self.assertTrue(geometry.line_intersects_bbox([(40.0, 2.5), (43.0, 2.5)], bbox))
+        self.assertFalse(geometry.line_intersects_bbox([(40.0, 2.5), (40.5, 2.5)], bbox))
+
+    def test_tags_in_bbox(self):
+        """
+        Tests that the long lists of locations give the same tags as the
+        lookup on the index
+        :return: None
+        """
+        handler = ChangeHandler()
+        handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+        handler.set_tags("default", ".*", ".*", ["way"])
+        handler.set_tags("barcelona", ".*", ".*", ["way"], 1, (41.4695, 2.2280, 41.3170, 2.0524))
+        handler.set_tags("paris", ".*", ".*", ["way"], 2, (48.9, 2.4, 48.8, 2.3))
+        locations = [(41.9, 2.1 + i * 0.001) for i in range(200)] + [(41.3851, 2.1734), (41.98268, 2.81372)]
+        names = ["paris", "default", "barcelona"]
+        self.assertEqual(handler.tags_in_bbox(locations, names), ["default", "barcelona"])
+        self.assertEqual(handler.tags_in_bbox(iter(locations), names), ["default", "barcelona"])
+
+
+class AreaTest(unittest.TestCase):
+    """
+    Test suite for the polygon areas
+    """
+
+    # Bounding box of Girona without the block of the changes of test1.osc
+    HOLE = {
+        "type": "Polygon",
+        "coordinates": [
+            [[2.7847, 41.9623], [2.8576, 41.9623], [2.8576, 41.9933], [2.7847, 41.9933], [2.7847, 41.9623]],
+            [[2.81, 41.975], [2.81, 41.99], [2.83, 41.99], [2.83, 41.975], [2.81, 41.975]]
+        ]
+    }
+
+    def process(self, area=None, tag_area=None):
+        """
+        Processes test1.osc watching all the tags
+
+        :param area: Default area, if not set the bbox of Girona is used
+        :param tag_area: Area of the user tags
+        :return: Bard
+        """
+        bard = girona_bard()
+        if area is not None:
+            bard.handler.set_area(area)
+        if tag_area is not None:
+            bard.handler.set_tags("all", ".*", ".*", ["node", "way"], area=tag_area)
+        bard.process_file("test/test1.osc")
+        return bard
+
+    def test_load(self):
+        """
+        Tests the load of the GeoJSON and the points inside the polygon
+        :return: None
+        """
+        area = load_area("test/girona.geojson")
+        self.assertEqual(area.bbox, (41.992, 2.855, 41.964, 2.79))
+        self.assertTrue(area.contains(41.98268, 2.81372))
+        self.assertFalse(area.contains(41.965, 2.795))
+        self.assertFalse(area.contains(48.8566, 2.3522))
+        points = geometry.coordinates([(41.965, 2.795), (48.8566, 2.3522)])
+        self.assertFalse(area.contains_any(points))
+        self.assertTrue(area.contains_any(geometry.coordinates([(41.965, 2.795), (41.98268, 2.81372)])))
+        self.assertTrue(area.intersects([(41.965, 2.795), (41.98268, 2.81372)]))
+        self.assertFalse(area.intersects([(48.8566, 2.3522)]))
+        self.assertTrue(area.latlon_wkt().startswith("POLYGON ((41.9"))
+        self.assertEqual(load_geojson(json.dumps(self.HOLE)).geom_type, "Polygon")
+        with self.assertRaises(ValueError):
+            Area(load_geojson({"type": "Point", "coordinates": [2.8, 41.9]}))
+
+    def test_without_vectorized(self):
+        """
+        Tests that the points are checked one by one on the prepared polygon
+        when the vectorized tests of shapely 2.0 aren't available
+        :return: None
+        """
+        import bard.areas as areas_module
+
+        vectorized = areas_module.VECTORIZED
+        areas_module.VECTORIZED = False
+        try:
+            area = load_area("test/girona.geojson")
+            self.assertTrue(area.contains(41.98268, 2.81372))
+            self.assertFalse(area.contains(41.965, 2.795))
+            self.assertFalse(area.contains_any(geometry.coordinates([(41.965, 2.795), (48.8566, 2.3522)])))
+            self.assertTrue(area.contains_any(geometry.coordinates([(41.965, 2.795), (41.98268, 2.81372)])))
+        finally:
+            areas_module.VECTORIZED = vectorized
+
+    def test_process(self):
+        """
+        Tests that the changes outside the polygon are not reported
+        :return: None
+        """
+        expected = self.process()
+        self.assertTrue(expected.changesets)
+        inside = self.process(load_area("test/girona.geojson"))
+        self.assertEqual(inside.changesets, expected.changesets)
+        self.assertEqual(inside.stats, expected.stats)
+        self.assertEqual(self.process(load_area(self.HOLE)).changesets, {})
+        self.assertEqual(self.process(tag_area=load_area(self.HOLE)).changesets, {})
+
+    def test_tags_in_bbox(self):
+        """
+        Tests the polygons of the tags on the lookup of the locations
+        :return: None
+        """
+        handler = ChangeHandler()
+        handler.set_tags("hole", ".*", ".*", ["way"], 1, area=load_area(self.HOLE))
+        handler.set_tags("girona", ".*", ".*", ["way"], 2, area=load_area("test/girona.geojson"))
+        inside = (41.98268, 2.81372)
+        locations = [(41.9, 2.1 + i * 0.001) for i in range(100)]
+        self.assertEqual(handler.tags_in_bbox([inside], ["hole", "girona"]), ["girona"])
+        self.assertEqual(handler.tags_in_bbox(locations + [inside], ["hole", "girona"]), ["girona"])
+        self.assertEqual(handler.tags_in_bbox(locations + [(41.966, 2.795)], ["hole", "girona"]), ["hole"])
+
+
+class ChangesetIndexTest(unittest.TestCase):
+    """
+    Test suite for the changesets pre-pass
+    """
+
+    CHANGESETS = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <changeset id="49033608" created_at="2017-05-31T16:24:00Z" closed_at="2017-05-31T16:25:00Z" open="false"
+  num_changes="51" user="test" uid="1" min_lat="{}" min_lon="{}" max_lat="{}" max_lon="{}" comments_count="0"/>
+ <changeset id="2" created_at="2017-05-31T16:24:00Z" open="true" num_changes="3" user="test" uid="1"
+  min_lat="10" min_lon="10" max_lat="11" max_lon="11" comments_count="0"/>
+</osm>
+"""
+
+    def process(self, bbox):
+        """
+        Processes test1.osc with a changeset index where the changeset of the
+        file has the bounding box
+
+        :param bbox: Bounding box of the changeset as north, east, south, west or None to not use the index
+        :return: Bard
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            bard = girona_bard(["node", "way", "relation"])
+            bard.handler.prefilter = False
+            if bbox is not None:
+                filename = os.path.join(tmp_dir, "changesets.osm")
+                with open(filename, "w") as f:
+                    f.write(self.CHANGESETS.format(bbox[2], bbox[3], bbox[0], bbox[1]))
+                bard.set_changesets(filename)
+            bard.process_file("test/test1.osc")
+            return bard
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_load(self):
+        """
+        Tests that only the closed changesets with bounds are indexed
+        :return: None
+        """
+        index = ChangesetIndex()
+        data = self.CHANGESETS.format(41.9, 2.7, 42.0, 2.9).encode("utf-8")
+        self.assertEqual(index.load(data, "osm"), 2)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get_bbox(49033608), (42.0, 2.9, 41.9, 2.7))
+        self.assertEqual(index.get_num_changes(49033608), 51)
+        self.assertIsNone(index.get_bbox(2))
+        self.assertFalse(index.is_outside(49033608))
+        state = "---\nlast_run: 2017-05-31 16:25:01.123456789 +00:00\nsequence: 2405010\n"
+        self.assertEqual(parse_changeset_state(state), 2405010)
+        self.assertEqual(parse_changeset_time(state), datetime(2017, 5, 31, 16, 25, 1, tzinfo=timezone.utc))
+
+    def test_watched_bboxes(self):
+        """
+        Tests that the changesets outside the watched bounding boxes only
+        keep their id
+        :return: None
+        """
+        index = ChangesetIndex()
+        index.set_bboxes([(41.9933, 2.8576, 41.9623, 2.7847)])
+        index.load(self.CHANGESETS.format(48.8, 2.3, 48.9, 2.4).encode("utf-8"), "osm")
+        self.assertEqual(len(index), 1)
+        self.assertTrue(index.is_outside(49033608))
+        self.assertIsNone(index.get_bbox(49033608))
+        index.load(self.CHANGESETS.format(41.9, 2.7, 42.0, 2.9).encode("utf-8"), "osm")
+        self.assertEqual(len(index), 1)
+        self.assertFalse(index.is_outside(49033608))
+        self.assertEqual(index.get_bbox(49033608), (42.0, 2.9, 41.9, 2.7))
+
+    def test_replication(self):
+        """
+        Tests that the sequences published since the start of the change
+        file are downloaded once
+        :return: None
+        """
+        tmp_dir = tempfile.mkdtemp()
+        server = ReplicationServer(tmp_dir, 1)
+        try:
+            directory = os.path.join(tmp_dir, "changesets")
+            content = gzip.compress(self.CHANGESETS.format(41.9, 2.7, 42.0, 2.9).encode("utf-8"))
+            for sequence in range(1, 31):
+                path = os.path.join(directory, OSC.sequence_path(sequence) + ".osm.gz")
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, "wb") as f:
+                    f.write(content)
+            with open(os.path.join(directory, "state.yaml"), "w") as f:
+                f.write("---\nlast_run: 2017-05-31 16:30:01.123456789 +00:00\nsequence: 30\n")
+            replication = ChangesetReplication(server.url + "/changesets")
+            start = datetime(2017, 5, 31, 16, 20, 1, tzinfo=timezone.utc)
+            self.assertEqual(replication.update(ChangesetIndex(), start=start), 22)
+            self.assertEqual(replication.last_sequence, 30)
+            self.assertEqual(replication.update(ChangesetIndex(), start=start), 0)
+        finally:
+            server.close()
+            shutil.rmtree(tmp_dir)
+
+    def test_skip(self):
+        """
+        Tests that the elements of the changesets outside the bounding boxes
+        are skipped and the ones inside give the same changes
+        :return: None
+        """
+        expected = self.process(None)
+        self.assertTrue(expected.changesets)
+        inside = self.process((42.0, 2.9, 41.9, 2.7))
+        self.assertEqual(inside.changesets, expected.changesets)
+        self.assertEqual(inside.stats, expected.stats)
+        self.assertNotIn("changeset_skipped", inside.get_metrics()["counters"])
+        outside = self.process((48.9, 2.4, 48.8, 2.3))
+        self.assertEqual(outside.changesets, {})
+        self.assertEqual(outside.get_metrics()["counters"]["changeset_skipped"], 51)
+
+
+class PrefilterTest(unittest.TestCase):
+    """
+    Test suite for the osmium filters applied before the callbacks
+    """
+
+    def process(self, prefilter, types, store=None):
+        """
+        Processes test1.osc watching all the tags of the element types
+
+        :param prefilter: Use the osmium filters
+        :param types: Element types of the watched tags
+        :param store: History store of the elements
+        :return: Bard
+        """
+        bard = girona_bard(types, FakeHistory(), store=store)
+        bard.handler.prefilter = prefilter
+        bard.process_file("test/test1.osc")
+        return bard
+
+    def test_same_changes(self):
+        """
+        Tests that the filtered elements don't change the results and don't
+        reach the callbacks
+        :return: None
+        """
+        expected = self.process(False, ["node", "way"])
+        filtered = self.process(True, ["node", "way"])
+        self.assertTrue(expected.changesets)
+        self.assertEqual(filtered.changesets, expected.changesets)
+        self.assertEqual(filtered.stats, expected.stats)
+        self.assertTrue(filtered.handler.num_nodes < expected.handler.num_nodes)
+        nodes = self.process(True, ["node"])
+        self.assertEqual(nodes.handler.num_ways, 0)
+        self.assertTrue(nodes.handler.num_nodes > 0)
+
+    def test_store(self):
+        """
+        Tests that all the elements are processed when they are stored
+        :return: None
+        """
+        expected = self.process(False, ["node"])
+        bard = self.process(True, ["node"], SqliteHistory(":memory:"))
+        self.assertEqual(bard.handler.get_filters(), [])
+        self.assertEqual(bard.handler.num_nodes, expected.handler.num_nodes)
+        self.assertEqual(bard.handler.num_ways, expected.handler.num_ways)
+
+    def test_without_filters(self):
+        """
+        Tests that the elements reach the callbacks when the osmium filters
+        aren't available
+        :return: None
+        """
+        import bard.bard as handler_module
+
+        expected = self.process(False, ["node", "way"])
+        entity_bits = handler_module.ENTITY_BITS
+        handler_module.ENTITY_BITS = None
+        try:
+            bard = self.process(True, ["node", "way"])
+            self.assertEqual(bard.handler.get_filters(), [])
+        finally:
+            handler_module.ENTITY_BITS = entity_bits
+        self.assertEqual(bard.changesets, expected.changesets)
+        self.assertEqual(bard.handler.num_nodes, expected.handler.num_nodes)
+
+
+    def test_location(self):
+        """
+        Tests that the tags of the ways far from the watched bounding boxes
+        aren't matched and the results don't change
+        :return: None
+        """
+        expected = girona_bard(["way"])
+        expected.handler.near_watched_bboxes = lambda locations: True
+        expected.process_file("test/test1.osc")
+        bard = self.process(False, ["way"])
+        self.assertTrue(expected.changesets)
+        self.assertEqual(bard.changesets, expected.changesets)
+        self.assertTrue(bard.get_metrics()["counters"]["location_skipped"] < bard.handler.num_ways)
+        handler = bard.handler
+        self.assertTrue(handler.near_watched_bboxes([(41.98, 2.80), (41.99, 2.81)]))
+        self.assertTrue(handler.near_watched_bboxes([(41.0, 2.8), (42.5, 2.8)]))
+        self.assertFalse(handler.near_watched_bboxes([(48.85, 2.35), (48.86, 2.36)]))
+        self.assertFalse(handler.near_watched_bboxes([(48.85 + i * 0.001, 2.35) for i in range(100)]))
+        self.assertFalse(handler.near_watched_bboxes([]))
+        outside = girona_bard(["way"])
+        outside.handler.set_bbox(48.9, 2.4, 48.8, 2.3)
+        outside.process_file("test/test1.osc")
+        self.assertEqual(outside.changesets, {})
+        self.assertEqual(outside.get_metrics()["counters"]["location_skipped"], outside.handler.num_ways)
+
+
+class MatcherTest(unittest.TestCase):
+    """
+    Test suite for the compiled tag matcher
+    """
+
+    def test_match(self):
+        """
+        Tests that the matcher gives the same result than matching each
+        watched tag with its regular expressions
+        :return: None
+        """
+        if sys.version_info[0] == 2:
+            tag = mock.MagicMock
+        else:
+            tag = MagicMock
+        watches = {
+            "all": (".*", ".*"),
+            "highway": ("highway", ".*"),
+            "residential": ("highway", "residential"),
+            "public": ("building", "public"),
+            "address": ("addr:(housenumber|street)", ".*"),
+            "names": ("name|alt_name", "^Carrer"),
+            "lanes": ("highway:lanes$", "[0-9]+")
+        }
+        elements = [
+            [],
+            [tag(k="highway", v="residential")],
+            [tag(k="highway:lanes", v="2"), tag(k="name", v="Carrer Major")],
+            [tag(k="building", v="public_school"), tag(k="addr:street", v="Major")],
+            [tag(k="alt_name", v="Plaça"), tag(k="building", v="yes")],
+            [tag(k="addr:city", v="Girona")]
+        ]
+        handler = ChangeHandler()
+        for name, (key, value) in watches.items():
+            handler.set_tags(name, key, value, ["node", "way"])
+        handler.set_tags("relations", ".*", ".*", ["relation"])
+        matcher = handler.matcher
+        for tags in elements:
+            expected = set(
+                name for name, (key, value) in watches.items()
+                if handler.has_tag(tags, re.compile(key), re.compile(value))
+            )
+            self.assertEqual(matcher.match(tags, "node"), expected)
+            self.assertEqual(
+                matcher.match(tags, "way", ["highway", "public", "relations"]),
+                expected.intersection(["highway", "public"])
+            )
+        self.assertEqual(matcher.match(elements[1], "relation"), {"relations"})
+
+        other = TagMatcher()
+        other.add("ways", "highway", ".*", ["way"])
+        self.assertEqual(other.match(elements[1], "node"), set())
+
+
+class HistoryTest(unittest.TestCase):
+    """
+    Test suite for the providers of previous versions
+    """
+
+    def test_sqlite(self):
+        """
+        Tests the storage of tags on the SQLite store
+        :return: None
+        """
+        store = SqliteHistory(":memory:")
+        store.store("way", 1, 1, {"highway": "residential"})
+        store.store("way", 1, 2, {})
+        store.commit()
+        self.assertEqual(store.get_tags("way", 1, 1), {"highway": "residential"})
+        self.assertEqual(store.get_tags("way", 1, 2), {})
+        self.assertIsNone(store.get_tags("node", 1, 1))
+
+    def test_chain(self):
+        """
+        Tests the fallback between providers and its stats
+        :return: None
+        """
+        store = SqliteHistory(":memory:")
+        store.store("way", 360662139, 2, {"surface": "paved"})
+        chain = HistoryChain([store, FakeHistory({"surface": "asphalt"}, "api")])
+        self.assertEqual(chain.get_tags("way", 360662139, 2), {"surface": "paved"})
+        self.assertEqual(chain.get_tags("way", 360662139, 1), {"surface": "asphalt"})
+        self.assertEqual(
+            chain.get_stats(),
+            {"requests": 2, "hits": {"sqlite": 1, "api": 1}, "misses": 0, "hit_rate": 0.5}
+        )
+
+        handler = ChangeHandler()
+        handler.set_history(chain)
+        self.assertTrue(handler.has_tag_changed(360662139, {"surface": "asphalt"}, "surface", 3, "way"))
+        self.assertFalse(handler.has_tag_changed(360662139, {"surface": "asphalt"}, "surface", 2, "way"))
+
+    def test_store_from_file(self):
+        """
+        Tests that the elements of the processed file are stored and used as
+        previous versions
+        :return: None
+        """
+        store = SqliteHistory(":memory:")
+        bard = girona_bard(store=store)
+        bard.process_file("test/test1.osc")
+        self.assertIsNotNone(store.get_tags("node", 4880791637, 1))
+        stats = bard.run_stats["history"]
+        self.assertTrue(stats["requests"] > 0)
+        self.assertEqual(stats["requests"], stats["hits"]["sqlite"] + stats["misses"])
+
+
+class LocationsTest(unittest.TestCase):
+    """
+    Test suite for the location index of the two pass processing
+    """
+
+    def test_load(self):
+        """
+        Tests that the missing nodes of the ways are read from the cache
+        :return: None
+        """
+
+        class Cache(object):
+            requested = []
+
+            def get_node_locations(self, identifiers):
+                self.requested.extend(identifiers)
+                return dict((identifier, (41.98, 2.82)) for identifier in identifiers)
+
+        index = LocationIndex()
+        index.load("test/test1.osc")
+        self.assertEqual(index.get(4880791637), (41.9820449, 2.8229217))
+        self.assertIsNone(index.get(1))
+        missing = index.missing_nodes()
+        self.assertTrue(missing)
+        self.assertIsNone(index.way_locations(61946626))
+
+        cache = Cache()
+        index = LocationIndex()
+        index.load("test/test1.osc", cache)
+        self.assertEqual(cache.requested, missing)
+        self.assertEqual(index.missing_nodes(), [])
+        self.assertEqual(len(index.way_locations(61946626)), len(index.way_nodes[61946626]))
+        with self.assertRaises(ValueError):
+            LocationIndex("sparse_mem_array")
+
+    def test_process_file(self):
+        """
+        Tests that the two pass processing finds the same changes
+        :return: None
+        """
+        results = []
+        for locations in (None, "sparse_mem_map"):
+            bard = girona_bard()
+            bard.process_file("test/test1.osc", locations)
+            results.append((bard.changesets, bard.stats))
+        self.assertEqual(results[0], results[1])
+        self.assertTrue(results[0][0])
+
+
+class CompactionTest(unittest.TestCase):
+    """
+    Test suite for the compaction of the cache
+    """
+
+    def test_id_ranges(self):
+        """
+        Tests that the ranges are aligned to its size and cover all the ids
+        :return: None
+        """
+        self.assertEqual(list(id_ranges(15, 35, 10)), [(10, 20), (20, 30), (30, 40)])
+        self.assertEqual(list(id_ranges(20, 20, 10)), [(20, 30)])
+        with self.assertRaises(ValueError):
+            CacheCompactor(None, 0)
+
+    def test_policy(self):
+        """
+        Tests that the cache is compacted every number of processed files
+        with the bounding boxes of the area, the tags and the user tags of
+        the database that aren't loaded
+        :return: None
+        """
+
+        class Cache(object):
+            compactions = []
+
+            def compact(self, versions, bboxes, range_size, vacuum):
+                self.compactions.append((versions, bboxes, range_size, vacuum))
+                return {"cache_node": {"pruned_versions": 1}}
+
+            def commit(self):
+                pass
+
+        bard = Bard()
+        bard.conf = {"cache": {"keep_versions": "3", "compact_outside": "true"}}
+        bard.compact_every = 2
+        bard.handler.cache = Cache()
+        bard.handler.cache.elements = ElementCache()
+        bard.handler.cache.metrics = Metrics()
+        bard.handler.cache_enabled = True
+        bard.handler.set_bbox(42.0, 3.0, 41.0, 2.0)
+        bard.handler.set_tags("a", ".*", ".*", ["node"])
+        bard.handler.set_tags("b", ".*", ".*", ["node"], 1, (1.0, 1.0, 0.0, 0.0))
+        bard.handler.set_history(HistoryChain([]))
+        bard.handler.get_subscription_bboxes = lambda: [(1.0, 1.0, 0.0, 0.0), (5.0, 5.0, 4.0, 4.0)]
+        empty = b'<?xml version="1.0" encoding="UTF-8"?><osmChange version="0.6"></osmChange>'
+        bard.process_buffer(empty, "osc")
+        self.assertEqual(Cache.compactions, [])
+        bard.process_buffer(empty, "osc")
+        self.assertEqual(
+            Cache.compactions,
+            [(3, [(42.0, 3.0, 41.0, 2.0), (1.0, 1.0, 0.0, 0.0), (5.0, 5.0, 4.0, 4.0)], 1000000, True)]
+        )
+        self.assertEqual(bard.run_stats["compaction"], {"cache_node": {"pruned_versions": 1}})
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    Test suite for the metrics of the runs
+    """
+
+    def test_process(self):
+        """
+        Tests that the stages and counters are collected from the workers
+        :return: None
+        """
+        results = []
+        for workers in (1, 2):
+            bard = girona_bard(history=FakeHistory(remote=True))
+            bard.process_file("test/test1.osc", workers=workers)
+            metrics = bard.get_metrics()
+            self.assertTrue({"process", "node", "way", "history"}.issubset(metrics["stages"]))
+            self.assertTrue(metrics["elements_per_second"] > 0)
+            self.assertEqual(metrics["history"], bard.run_stats["history"])
+            results.append(metrics["counters"])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0]["nodes"], bard.handler.num_nodes)
+        self.assertTrue(results[0]["changesets"] > 0)
+
+    def test_prometheus(self):
+        """
+        Tests the text format of Prometheus
+        :return: None
+        """
+        metrics = Metrics()
+        metrics.add_time("process", 2.0)
+        metrics.add_time("process", 1.0)
+        metrics.count("nodes", 30)
+        data = metrics.to_dict()
+        self.assertEqual(data, {"stages": {"process": {"seconds": 3.0, "calls": 2}}, "counters": {"nodes": 30}})
+        data["elements_per_second"] = 10.0
+        data["cache"] = None
+        data["history"] = {"hit_rate": 0.5}
+        lines = prometheus_text(data).splitlines()
+        self.assertIn('bard_stage_seconds_total{stage="process"} 3.0', lines)
+        self.assertIn('bard_stage_calls_total{stage="process"} 2', lines)
+        self.assertIn("bard_nodes_total 30", lines)
+        self.assertIn("bard_elements_per_second 10.0", lines)
+        self.assertIn("bard_history_hit_rate 0.5", lines)
+        self.assertFalse([line for line in lines if "cache" in line])
+
+
+class ProfilerTest(unittest.TestCase):
+    """
+    Test suite for the profiling of the runs
+    """
+
+    def test_summary(self):
+        """
+        Tests that the statistics are saved and the hottest methods of the
+        handler and the database calls are summarized
+        :return: None
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            bard = Bard()
+            bard.handler.set_bbox(41.9933, 2.8576, 41.9623, 2.7847)
+            store = SqliteHistory(":memory:")
+            bard.handler.set_history_store(store)
+            bard.handler.set_history(HistoryChain([store]))
+            bard.handler.set_tags("all", ".*", ".*", ["node", "way"])
+            filename = os.path.join(tmp_dir, "run.pstats")
+            with RunProfiler(filename, 5) as profiler:
+                bard.process_file("test/test1.osc")
+            self.assertTrue(os.path.getsize(filename) > 0)
+            summary = profiler.summary(ChangeHandler)
+            self.assertTrue(len(summary["handler"]) <= 5)
+            self.assertIn("node", [function["function"].split("(")[-1][:-1] for function in summary["handler"]])
+            self.assertTrue(summary["database"])
+            self.assertEqual(summary["osmapi"], [])
+            self.assertIn("handler (top 5)", profiler.format_summary(ChangeHandler))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+class ReportTest(unittest.TestCase):
+    """
+    Test suite for the rendering of the reports
+    """
+
+    def setUp(self):
+        self.bard = Bard()
+        self.bard.load_config({
+            'area': {
+                'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']
+            },
+            'tags': {
+                'all': {
+                    'tags': ".*=.*",
+                    'type': 'node,way'
+                }
+            },
+            "url_locales": "locales"
+        })
+
+    def test_select(self):
+        """
+        Tests that the changesets with more changes are selected in the order of the file
+        :return: None
+        """
+        changesets = {}
+        for changeset, changes in ((1, 2), (2, 5), (3, 1), (4, 5), (5, 3)):
+            changesets[changeset] = ChangesetRecord(changeset, "user", 1)
+            for identifier in range(changes):
+                changesets[changeset].add("nids", "all", identifier)
+        self.assertEqual([record.changeset for record in select_changesets(changesets, 3)], [2, 4, 5])
+        self.assertEqual(len(select_changesets(changesets, 10)), 5)
+
+        self.bard.changesets = changesets
+        self.bard.stats = {"all": [1, 1, 2], "total": 5}
+        self.bard.report_limit = 2
+        data = self.bard.generate_report_data()
+        self.assertEqual([record.changeset for record in data["changesets"]], [2, 4])
+        self.assertEqual(data["stats"], {"all": 2, "total": 5})
+        self.assertIn("2 changesets", data["limit_exceed"])
+
+    def test_fragments(self):
+        """
+        Tests that the fragments are rendered once and rendered again when the changeset changes
+        :return: None
+        """
+        self.bard.handler.set_history(HistoryChain([]))
+        self.bard.process_file("test/test1.osc")
+        data = self.bard.generate_report_data()
+        renderer = self.bard.get_renderer()
+        html = renderer.render("html", data)
+        text = renderer.render("text", data)
+        self.assertIn("#49033608", html)
+        self.assertIn("--- Changeset #49033608 ---", text)
+        misses = renderer.cache.misses
+        self.assertEqual(misses, 2 * len(data["changesets"]))
+        self.assertEqual(renderer.render("html", data), html)
+        self.assertEqual(renderer.cache.misses, misses)
+
+        record = data["changesets"][0]
+        record.add("nids", "all", 123456789)
+        self.assertIn("node/123456789", renderer.render("html", data))
+        self.assertEqual(renderer.cache.misses, misses + 1)
+
+
+class RegistryTest(unittest.TestCase):
+    """
+    Test suite for the registry of compiled templates
+    """
+
+    def test_languages(self):
+        """
+        Tests that each language has its own translations and the templates are compiled once
+        :return: None
+        """
+        registry = TemplateRegistry("locales")
+        summaries = dict(
+            (language, registry.get_template("html_template.html", language)[0].render(stats={}, tags=[]))
+            for language in ("ca", "es", "en"))
+        self.assertIn("Resum", summaries["ca"])
+        self.assertIn("Summary", summaries["en"])
+        self.assertNotEqual(summaries["ca"], summaries["es"])
+        self.assertIs(
+            registry.get_template("html_template.html", "ca")[0], registry.get_template("html_template.html", "ca")[0])
+        self.assertEqual(
+            registry.get_template("html_template.html", "ca")[1], registry.get_template("html_template.html", "es")[1])
+        self.assertIs(get_registry("locales"), get_registry("locales"))
+
+    def test_concurrent(self):
+        """
+        Tests that the reports of several languages are rendered at the same time
+        :return: None
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        first = Bard()
+        first.load_config({
+            'area': {'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']},
+            'tags': {'all': {'tags': ".*=.*", 'type': 'node,way'}},
+            'email': {'language': 'ca', 'url_locales': 'locales'}
+        })
+        second = Bard()
+        second.load_config({
+            'area': {'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']},
+            'tags': {'all': {'tags': ".*=.*", 'type': 'node,way'}},
+            'email': {'language': 'es', 'url_locales': 'locales'}
+        })
+        self.assertIs(first.registry, second.registry)
+        self.assertIs(first.get_template("text_template.txt", "en"), second.get_template("text_template.txt", "en"))
+        first.handler.set_history(HistoryChain([]))
+        first.process_file("test/test1.osc")
+        data = first.generate_report_data()
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            reports = dict(executor.map(
+                lambda language: (language, first.get_renderer(language).render("html", data)),
+                ["ca", "es", "en"] * 3))
+        self.assertIn("Conjunt de canvis", reports["ca"])
+        self.assertIn("Changeset", reports["en"])
+        self.assertEqual(first.get_renderer().language, "ca")
+
+
+class ParallelTest(unittest.TestCase):
+    """
+    Test suite for the processing of the shards of a file on several processes
+    """
+
+    def test_merge(self):
+        """
+        Tests that the merged results of the shards are the ones of a single handler
+        :return: None
+        """
+        for filename in ("test/test1.osc", "test/test2.osc"):
+            results = []
+            for workers in (1, 3):
+                bard = girona_bard(history=FakeHistory(even_missing=True, remote=True))
+                bard.handler.set_tags("highway", "highway", ".*", ["way"], 7)
+                bard.process_file(filename, workers=workers)
+                results.append((
+                    bard.changesets, bard.tag_changesets, bard.stats, bard.run_stats["history"],
+                    bard.handler.num_nodes, bard.handler.num_ways
+                ))
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(repr(results[0][0]), repr(results[1][0]))
+
+    def test_store(self):
+        """
+        Tests that the elements of the workers are written on the history
+        store by the parent and that the counters of the runs before the
+        fork aren't counted again
+        :return: None
+        """
+        results = []
+        for workers in (1, 2):
+            store = SqliteHistory(":memory:")
+            bard = girona_bard(store=store)
+            bard.handler.set_history(HistoryChain([store, FakeHistory(remote=True)]))
+            bard.process_file("test/test1.osc", workers=workers)
+            bard.handler.clear_changes()
+            bard.process_file("test/test1.osc", workers=workers)
+            self.assertIsNotNone(store.get_tags("node", 4880791637, 1))
+            self.assertFalse(store.read_only)
+            rows = store.connection.execute("SELECT count(*) FROM history").fetchone()[0]
+            results.append((bard.changesets, bard.run_stats["history"], rows))
+        self.assertEqual(results[0], results[1])
+
+    def test_workers(self):
+        """
+        Tests that the workers are only used when the history is remote
+        :return: None
+        """
+        bard = girona_bard()
+        bard.workers = 3
+        self.assertEqual(bard.get_workers(), 1)
+        self.assertEqual(bard.get_workers(2), 1)
+        bard.handler.set_history(HistoryChain([SqliteHistory(":memory:")]))
+        self.assertEqual(bard.get_workers(), 1)
+        bard.handler.set_history(HistoryChain([SqliteHistory(":memory:"), ApiHistory()]))
+        self.assertEqual(bard.get_workers(), 3)
+        self.assertEqual(bard.get_workers(1), 1)
+
+
+class ReplicationServer(object):
+    """
+    Local HTTP server with the layout of the replication system, every
+    sequence is test1.osc. The server runs on another process and its log
+    tells the downloaded sequences.
+    """
+
+    def __init__(self, directory, sequence, periodicity="minute"):
+        self.root = directory
+        self.directory = os.path.join(directory, periodicity)
+        self.set_sequence(sequence)
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.log = open(os.path.join(directory, "server.log"), "w+")
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "http.server", str(port), "--bind", "127.0.0.1", "--directory", self.root],
+            stdout=subprocess.DEVNULL, stderr=self.log)
+        self.url = "http://127.0.0.1:{}".format(port)
+        for attempt in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port), 1).close()
+                break
+            except socket.error:
+                sleep(0.1)
+
+    def set_sequence(self, sequence):
+        with open("test/test1.osc", "rb") as f:
+            content = gzip.compress(f.read())
+        for number in range(1, sequence + 1):
+            path = os.path.join(self.directory, OSC.sequence_path(number) + ".osc.gz")
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(content)
+        with open(os.path.join(self.directory, "state.txt"), "w") as f:
+            f.write("#Sun May 28 20:00:02 UTC 2017\nsequenceNumber={}\n".format(sequence))
+
+    def requested(self):
+        """
+        Returns the sequences downloaded since the last call
+        """
+        self.log.seek(0)
+        sequences = [
+            int("".join(match)) for match in re.findall(r"GET /\w+/(\d{3})/(\d{3})/(\d{3})\.osc\.gz", self.log.read())
+        ]
+        self.log.seek(0)
+        self.log.truncate()
+        return sequences
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+        self.log.close()
+
+
+class ReplicationTest(unittest.TestCase):
+    """
+    Test suite for the replication follower
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmp_dir, "state.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_state(self):
+        """
+        Tests the persistence of the last processed sequence
+        :return: None
+        """
+        state = SequenceState(self.state_file)
+        self.assertIsNone(state.load())
+        state.save(4230, "2017-05-28T20:00:00Z")
+        self.assertEqual(state.load(), 4230)
+        self.assertEqual(OSC.sequence_path(2345678), "002/345/678")
+        self.assertEqual(parse_timestamp("2017-05-28T20:00:00Z"), datetime(2017, 5, 28, 20, tzinfo=timezone.utc))
+
+    def test_follow(self):
+        """
+        Tests that the missed sequences are processed once
+        :return: None
+        """
+        bard = girona_bard()
+
+        server = ReplicationServer(self.tmp_dir, 12)
+        server.requested()
+        try:
+            osc = OSC(server.url)
+            osc.periodicty = OSC.MINUTELY
+            self.assertEqual(bard.follow(self.state_file, osc, iterations=1), 12)
+            self.assertEqual(server.requested(), [12])
+            SequenceState(self.state_file).save(10)
+            server.set_sequence(13)
+            server.requested()
+            self.assertEqual(bard.follow(self.state_file, osc, iterations=1), 13)
+            self.assertEqual(server.requested(), [11, 12, 13])
+            self.assertEqual(SequenceState(self.state_file).load(), 13)
+            self.assertTrue(49033608 in bard.changesets)
+            server.requested()
+            bard.follow(self.state_file, osc, iterations=1)
+            self.assertEqual(server.requested(), [])
+        finally:
+            server.close()
+
+    def test_stream(self):
+        """
+        Tests that the streamed diff finds the same changes as the file and
+        that the failed and truncated downloads raise IOError
+        :return: None
+        """
+        server = ReplicationServer(self.tmp_dir, 3)
+        try:
+            osc = OSC(server.url)
+            osc.periodicty = OSC.MINUTELY
+            results = []
+            for sequence, locations in ((None, None), (3, None), (3, "sparse_mem_map")):
+                bard = girona_bard()
+                if sequence is None:
+                    bard.process_file("test/test1.osc")
+                else:
+                    bard.process_sequence(osc, sequence, locations)
+                results.append((bard.changesets, bard.stats))
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[0], results[2])
+            for locations in (None, "sparse_mem_map"):
+                with self.assertRaises(IOError):
+                    bard.process_sequence(osc, 4, locations)
+            with open(os.path.join(server.directory, OSC.sequence_path(3) + ".osc.gz"), "rb") as f:
+                content = f.read()
+            with open(os.path.join(server.directory, OSC.sequence_path(4) + ".osc.gz"), "wb") as f:
+                f.write(content[:len(content) // 2])
+            for locations in (None, "sparse_mem_map"):
+                with self.assertRaises(IOError):
+                    bard.process_sequence(osc, 4, locations)
+            self.assertEqual(osc.stream(3).read(), content)
+        finally:
+            server.close()
+
+
+class FakeMailgun(object):
+    """
+    Local server with the messages endpoint of Mailgun, it records the
+    posted messages and answers the first requests with the failure statuses
+    """
+
+    def __init__(self, failures=None):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs
+        import base64
+        import threading
+
+        server = self
+        self.messages = []
+        self.failures = list(failures or [])
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                auth = base64.b64decode(self.headers["Authorization"].split()[1]).decode("utf-8")
+                with server.lock:
+                    status = server.failures.pop(0) if server.failures else 200
+                    if status == 200:
+                        message = parse_qs(body.decode("utf-8"))
+                        message["auth"] = auth
+                        server.messages.append(message)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(b'{"message": "Queued. Thank you."}')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/v3/test/messages".format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MailTest(unittest.TestCase):
+    """
+    Test suite for the delivery of the reports
+    """
+
+    def setUp(self):
+        self.server = FakeMailgun()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_batches(self):
+        """
+        Tests that the recipients are sent in batches with its recipient variables
+        :return: None
+        """
+        client = MailgunClient("test", "key", self.server.url, workers=3, batch_size=100)
+        recipients = dict(("user{}@example.com".format(i), {"id": i}) for i in range(250))
+        futures = client.send("Subject", "text", "<p>html</p>", recipients)
+        self.assertEqual(len(futures), 3)
+        self.assertEqual(len(client.wait()), 3)
+        client.close()
+        self.assertEqual(len(self.server.messages), 3)
+        sent = {}
+        for message in self.server.messages:
+            variables = json.loads(message["recipient-variables"][0])
+            self.assertEqual(sorted(message["to"]), sorted(variables))
+            self.assertEqual(message["auth"], "api:key")
+            self.assertEqual(message["from"], ["OSM Changes <mailgun@test>"])
+            sent.update(variables)
+        self.assertEqual(sent, recipients)
+        self.assertEqual(client.get_stats()["sent"], 250)
+
+    def test_retry(self):
+        """
+        Tests that the server errors are retried and the rejected messages are not
+        :return: None
+        """
+        self.server.failures = [500, 429]
+        client = MailgunClient("test", "key", self.server.url, retries=2, backoff=0.01)
+        client.send("Subject", "text", "html", ["a@example.com"])
+        self.assertEqual(client.wait()[0].status_code, 200)
+        self.assertEqual(client.get_stats()["failed_requests"], 2)
+        self.assertEqual(len(self.server.messages), 1)
+
+        self.server.failures = [503, 503, 503]
+        client.send("Subject", "text", "html", ["a@example.com"])
+        with self.assertRaises(MailError):
+            client.wait()
+        self.server.failures = [400]
+        client.send("Subject", "text", "html", ["a@example.com"])
+        with self.assertRaises(MailError):
+            client.wait()
+        self.assertEqual(client.get_stats()["requests"], 7)
+        client.close()
+
+    def test_report(self):
+        """
+        Tests that the report is sent in the background to the recipients of the configuration
+        :return: None
+        """
+        tmp_dir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            bard = Bard()
+            bard.load_config({
+                'area': {'bbox': ['41.9933', '2.8576', '41.9623', '2.7847']},
+                'tags': {'all': {'tags': ".*=.*", 'type': 'node,way'}},
+                'email': {'recipients': 'a@example.com b@example.com', 'language': 'ca'},
+                'mailgun': {'domain': 'test', 'api_key': 'key', 'api_url': self.server.url}
+            })
+            bard.handler.set_history(HistoryChain([]))
+            bard.process_file("test/test1.osc")
+            os.chdir(tmp_dir)
+            bard.report()
+            self.assertEqual(len(bard.wait_mail()), 1)
+            self.assertEqual(sorted(self.server.messages[0]["to"]), ["a@example.com", "b@example.com"])
+            self.assertIn("49033608", self.server.messages[0]["html"][0])
+            metrics = bard.get_metrics()
+            self.assertEqual(metrics["stages"]["send"]["calls"], 1)
+            self.assertEqual(metrics["counters"]["mails_sent"], 2)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmp_dir)
+
+
 class ChangesWithinTest(unittest.TestCase):
     """
     Initest for changeswithin using osmium
@@ -440,9 +2127,23 @@ class ChangesWithinTest(unittest.TestCase):
         :return: None
         """
         self.cw.has_cache = True
-        self.cw.cache = DbCache("localhost", "bard", "postgres", "postgres")
+        self.cw.handler.cache = DbCache("localhost", "bard", "postgres", "postgres")
         self.cw.initialize_db()
 
+    def test_initialize_cache(self):
+        """
+        Tests that initialize_db initializes the cache of the handler
+        :return: None
+        """
+        if sys.version_info[0] == 2:
+            cache = mock.MagicMock()
+        else:
+            cache = MagicMock()
+        self.cw.has_cache = True
+        self.cw.handler.cache = cache
+        self.cw.initialize_db()
+        cache.initialize.assert_called_once_with()
+
     def test_osc1(self):
         """
         Tests load of test1.osc
@@ -551,7 +2252,7 @@ class ChangesWithinTest(unittest.TestCase):
             {'date': date,
              'tags': sorted(['building', 'housenumber', 'highway']),
              'changesets': [],
-             'stats': []
+             'stats': {}
              }
         )
 
@@ -587,7 +2288,7 @@ class ChangesWithinTest(unittest.TestCase):
         self.assertEqual(self.cw.handler.east, 2.8576)
         self.assertEqual(self.cw.handler.south, 41.9623)
         self.assertEqual(self.cw.handler.west, 2.7847)
-        self.cw.handler.set_tags("all", ".*", ".*", ["node", "way"])
+        self.cw.handler.set_tags("all", ".*", ".*", ["node", "way", "relation"])
         self.cw.process_file("test/test_rel.osc")
         self.assertTrue(41928815 in self.cw.changesets)
         self.assertTrue(343535 in self.cw.changesets[41928815]["rids"]["all"])
@@ -620,7 +2321,7 @@ class ChangesWithinTest(unittest.TestCase):
             node=True,
             way=True,
             relation=True,
-            bbox=",".join(['41.9933', '2.8576', '41.9623', '2.7847']),
+            bbox=",".join(['2.8576', '41.9623', '2.7847', '41.9933']),
             user=user.id
         )
         commit()
@@ -633,14 +2334,15 @@ class ChangesWithinTest(unittest.TestCase):
         self.assertEqual(self.cw.handler.south, 41.9623)
         self.assertEqual(self.cw.handler.west, 2.7847)
         self.cw.process_file("test/test_rel.osc")
-        self.assertTrue(41928815 in self.cw.changesets)
-        self.assertTrue(343535 in self.cw.changesets[41928815]["rids"]["all"])
+        self.assertTrue(41928815 in self.cw.tag_changesets[ut_all.id])
+        self.assertTrue(343535 in self.cw.tag_changesets[ut_all.id][41928815]["rids"]["all"])
+        self.assertEqual(self.cw.changesets, {})
         self.cw.save_results()
 
         rt = ResultTags.get(user_tags=ut_all.id)
 
-        self.assertEqual(41928815, rt.changesets.get("changeset"))
-        self.assertTrue(343535 in rt.changesets.get("rids")["all"])
+        self.assertEqual(41928815, rt.changesets[0].get("changeset"))
+        self.assertTrue(343535 in rt.changesets[0].get("rids")["all"])
 
 
 if __name__ == '__main__':